@@ -0,0 +1,225 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Datastore backends.
+
+The datastore and IPAM clients store their data through a backend with the
+interface of the python-etcd client, etcd.Client: keys are read, written
+with compare-and-swap conditions and deleted with etcd v2 semantics, and
+results and errors are etcd.EtcdResults and etcd.EtcdExceptions.  An
+etcd.Client is used by default.  Other backends subclass DatastoreBackend:
+
+  - MemoryEtcdClient (pycalico.memory_etcd) keeps the data in memory, for
+    simulation and testing
+  - Etcd3Backend (pycalico.etcdv3) uses the etcd v3 API.
+
+Backends may also support transactions, which write or delete several keys
+atomically, if all their conditions hold.
+
+A failed compare-and-swap raises etcd.EtcdCompareFailed with the payload of
+the etcd v2 error, so that callers can find the version of the key that
+their write conflicted with; see compare_failed().
+"""
+import re
+
+from etcd import EtcdCompareFailed
+
+COMPARE_FAILED_ERROR_CODE = 101
+
+_PREV_INDEX_CAUSE_RE = re.compile(r"^\[(\d+) != (\d+)\]$")
+
+
+class DatastoreBackend(object):
+    """
+    Base class for datastore backends other than etcd.Client.
+    """
+
+    transactional = False
+    """
+    Whether the backend supports transaction().
+    """
+
+    def read(self, key, recursive=False, wait=False, waitIndex=None,
+             timeout=None, **kwargs):
+        """
+        Read a key, or the contents of a directory.
+
+        :param key: The key.
+        :param recursive: (optional) For a directory, whether to read its
+        whole subtree rather than just its immediate children.
+        :param wait: (optional) Whether to wait for the next change to the
+        key (or to the subtree, if recursive) instead, and return that.
+        :param waitIndex: (optional) With wait, the index to wait for changes
+        from, which may be in the past.
+        :param timeout: (optional) With wait, the maximum number of seconds
+        to wait.
+        :raises EtcdKeyNotFound: The key does not exist.
+        :raises EtcdWatchTimedOut: Timed out waiting for a change.
+        :return: etcd.EtcdResult
+        """
+        raise NotImplementedError()  # pragma: no cover
+
+    def write(self, key, value, ttl=None, dir=False, append=False,
+              prevExist=None, prevIndex=None, prevValue=None, **kwargs):
+        """
+        Write a key, with the same arguments as etcd.Client.write().
+
+        :raises EtcdAlreadyExist: prevExist is False and the key exists.
+        :raises EtcdKeyNotFound: prevExist, prevIndex or prevValue is set and
+        the key does not exist.
+        :raises EtcdCompareFailed: prevIndex or prevValue does not match.
+        :return: etcd.EtcdResult
+        """
+        raise NotImplementedError()  # pragma: no cover
+
+    def delete(self, key, recursive=None, dir=None, prevIndex=None,
+               prevValue=None, **kwargs):
+        """
+        Delete a key, with the same arguments as etcd.Client.delete().
+
+        :raises EtcdKeyNotFound: The key does not exist.
+        :raises EtcdCompareFailed: prevIndex or prevValue does not match.
+        :return: etcd.EtcdResult
+        """
+        raise NotImplementedError()  # pragma: no cover
+
+    def transaction(self, ops):
+        """
+        Apply several writes and deletes atomically.  Either all of them are
+        applied, or, if the condition of any of them does not hold, none are.
+
+        :param ops: List of TxnWrite and TxnDelete operations.  Each key may
+        only appear once.
+        :raises EtcdCompareFailed: A condition does not hold.
+        :return: List of etcd.EtcdResult, one for each operation.
+        """
+        raise NotImplementedError()  # pragma: no cover
+
+    def update(self, obj):
+        """
+        Update a key read previously, if it has not changed since.
+
+        :param obj: The etcd.EtcdResult read previously, with a new value.
+        :return: etcd.EtcdResult
+        """
+        kwargs = {"dir": obj.dir, "ttl": obj.ttl, "prevExist": True}
+        if not obj.dir:
+            kwargs["prevIndex"] = obj.modifiedIndex
+        return self.write(obj.key, obj.value, **kwargs)
+
+    def get(self, key):
+        return self.read(key)
+
+    def watch(self, key, index=None, timeout=None, recursive=None):
+        """
+        Wait for the next change to a key, as etcd.Client.watch().
+
+        :param key: The key.
+        :param index: (optional) The index to wait for changes from.
+        :param timeout: (optional) The maximum number of seconds to wait.
+        :param recursive: (optional) Whether to watch the whole subtree.
+        :return: etcd.EtcdResult for the change.
+        """
+        return self.read(key, wait=True, waitIndex=index, timeout=timeout,
+                         recursive=recursive)
+
+
+class TxnWrite(object):
+    """
+    A write in a transaction.
+    """
+
+    def __init__(self, key, value, prevExist=None, prevIndex=None):
+        """
+        :param key: The key.
+        :param value: The value to write.
+        :param prevExist: (optional) True to only update an existing key,
+        False to only create a new one.
+        :param prevIndex: (optional) Only update the key if it was last
+        modified at this index.
+        """
+        self.key = key
+        self.value = value
+        self.prevExist = prevExist
+        self.prevIndex = prevIndex
+
+
+class TxnDelete(object):
+    """
+    A delete in a transaction.  The key must exist.
+    """
+
+    def __init__(self, key, prevIndex=None):
+        """
+        :param key: The key.
+        :param prevIndex: (optional) Only delete the key if it was last
+        modified at this index.
+        """
+        self.key = key
+        self.prevIndex = prevIndex
+
+
+def is_transactional(backend):
+    """
+    :return: True if the backend supports transactions.
+    """
+    return isinstance(backend, DatastoreBackend) and backend.transactional
+
+
+def compare_failed(cause, index=None, nodes=None):
+    """
+    :param cause: The cause of the failure.  For a prevIndex condition,
+    etcd v2 gives "[<prevIndex> != <modifiedIndex>]", where modifiedIndex is
+    the key's current modifiedIndex.
+    :param index: (optional) The etcd index when the condition was checked.
+    :param nodes: (optional) Dict of the current nodes of the keys involved,
+    in the form returned by the etcd API, keyed by key.  etcd v2 doesn't
+    return these, but backends that can include them at no extra cost do,
+    so that callers needn't read the keys again.
+    :return: EtcdCompareFailed with the payload of the etcd v2 error.
+    """
+    payload = {"errorCode": COMPARE_FAILED_ERROR_CODE,
+               "message": "Compare failed",
+               "cause": cause}
+    if index is not None:
+        payload["index"] = index
+    if nodes is not None:
+        payload["nodes"] = nodes
+    return EtcdCompareFailed("Compare failed : %s" % cause, payload)
+
+
+def current_node(error, key):
+    """
+    :param error: An EtcdCompareFailed.
+    :param key: The key.
+    :return: The current node of the key included in the error, or None if
+    it wasn't included or the key doesn't exist.
+    """
+    payload = error.payload if isinstance(error.payload, dict) else {}
+    return payload.get("nodes", {}).get(key)
+
+
+def compare_failed_indexes(error):
+    """
+    :param error: An EtcdCompareFailed for a write with a prevIndex
+    condition.
+    :return: Tuple of the prevIndex of the write, and the key's modifiedIndex
+    when the condition was checked, from the cause of the error, or None if
+    the cause doesn't give them.
+    """
+    payload = error.payload if isinstance(error.payload, dict) else {}
+    match = _PREV_INDEX_CAUSE_RE.match(str(payload.get("cause", "")))
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
@@ -12,16 +12,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from array import array
+import base64
+from collections import deque
 from netaddr import IPAddress, IPNetwork
 import json
 import logging
+import random
 from pycalico import PyCalicoError
 
 _log = logging.getLogger(__name__)
 _log.addHandler(logging.NullHandler())
 
 BITS_BY_VERSION = {4: 32, 6: 128}
+
+# The default block size, as the number of host bits in the block CIDR.  IP
+# pools may use a different block size, within the range given by
+# MIN_BLOCK_SIZE_BITS and MAX_BLOCK_SIZE_BITS.
 BLOCK_SIZE_BITS = 6
+MIN_BLOCK_SIZE_BITS = 0
+MAX_BLOCK_SIZE_BITS = 12
 BLOCK_PREFIXLEN = {4: 32 - BLOCK_SIZE_BITS,
                    6: 128 - BLOCK_SIZE_BITS}
 BLOCK_SIZE = 2 ** BLOCK_SIZE_BITS
@@ -29,6 +39,31 @@ PREFIX_MASK = {4: (IPAddress("255.255.255.255") ^ (BLOCK_SIZE - 1)),
                6: (IPAddress("ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff") ^
                    (BLOCK_SIZE - 1))}
 
+# Attribute index stored for an unallocated address.
+UNALLOCATED = -1
+
+# Encodings for writing blocks to the datastore.  Blocks in either encoding
+# are read, so clients using different encodings can share a datastore.
+ENCODING_JSON = "json"
+ENCODING_COMPACT = "compact"
+
+# Compact encoded blocks are stored as this prefix followed by the base64
+# encoding of the binary block.  The digits before the colon are the version
+# of the binary format.
+COMPACT_PREFIX = "cb"
+COMPACT_VERSION = 1
+
+# Validation levels for blocks read from the datastore.  VALIDATE_SAMPLED
+# checks a random VALIDATION_SAMPLE_RATE fraction of the blocks decoded.
+VALIDATE_OFF = "off"
+VALIDATE_SAMPLED = "sampled"
+VALIDATE_FULL = "full"
+VALIDATION_SAMPLE_RATE = 0.01
+
+# Flags in the first byte of a compact block.
+_COMPACT_STRICT_AFFINITY = 0x01
+_COMPACT_NATURAL_ORDER = 0x02
+
 
 class AllocationBlock(object):
     """
@@ -63,11 +98,32 @@ class AllocationBlock(object):
         assert isinstance(cidr_prefix, IPNetwork)
         assert cidr_prefix.cidr == cidr_prefix
 
-        # Make sure the block is the right size.
-        assert cidr_prefix.prefixlen == (BLOCK_PREFIXLEN[cidr_prefix.version])
+        # Make sure the block is a valid size.
+        assert validate_block_size_bits(
+                BITS_BY_VERSION[cidr_prefix.version] - cidr_prefix.prefixlen)
         self.cidr = cidr_prefix
         self.db_result = None
 
+        self.from_cache = False
+        """
+        Whether the block was served from a client side cache or by a
+        serializable read, instead of read from the datastore at quorum, in
+        which case it may be out of date.  A successful compare-and-swap
+        confirms the block was up to date.
+        """
+
+        self.size = cidr_prefix.size
+        """
+        The number of addresses in the block.
+        """
+
+        self._first = cidr_prefix.first
+        """
+        The integer value of the first address in the block.  Addresses are
+        handled as integer offsets from this value (ordinals) internally, and
+        only converted to IPAddress objects when returned to the caller.
+        """
+
         self.host_affinity = host_affinity
         """
         Both to minimize collisions, where multiple hosts attempt to change a
@@ -88,27 +144,48 @@ class AllocationBlock(object):
         have affinity to that host.
         """
 
-        self.allocations = [None] * BLOCK_SIZE
+        self._attr_indexes = array('l', [UNALLOCATED]) * self.size
         """
         A fixed length array with one entry for every address in the block.
-        None means unallocated.  A non-negative integer indicates the address
-        is allocated, and is the index into the `attributes` array for the
-        attributes assigned to the allocation.
+        UNALLOCATED means unallocated.  A non-negative integer indicates the
+        address is allocated, and is the index into the `attributes` array for
+        the attributes assigned to the allocation.
         """
 
-        self.unallocated = list(range(BLOCK_SIZE))
+        self._used = 0
         """
-        An array of unallocated addresses, with most recently de-allocated
-        addresses at the end of the list.  Each entry contains an address
+        Bitmap of allocated addresses.  Bit n is set if the address with
+        ordinal n is allocated.
+        """
+
+        self._num_free = self.size
+        """
+        The number of unallocated addresses in the block.
+        """
+
+        self._free_order = deque(xrange(self.size))
+        """
+        Queue of unallocated addresses, with most recently de-allocated
+        addresses at the end of the queue.  Each entry contains an address
         ordinal (that is the index into the CIDR for the actual IP address).
 
         When auto-assigning addresses, addresses are preferentially chosen
-        from the start of the list so that addresses are not re-used
+        from the start of the queue so that addresses are not re-used
         automatically after de-allocation, except when there are no other
         free addresses.
+
+        Explicitly assigned addresses are not removed from the queue
+        immediately.  Instead, the entry is marked as stale in `_stale` and
+        skipped when it reaches the head of the queue.
+        """
+
+        self._stale = array('l', [0]) * self.size
+        """
+        The number of stale entries in `_free_order` for each ordinal.  Stale
+        entries for an ordinal always precede its live entry (if any).
         """
 
-        self.attributes = []
+        self._attributes = []
         """
         List of dictionaries of attributes for allocations.
 
@@ -119,10 +196,70 @@ class AllocationBlock(object):
         }
         """
 
+        self._pending = None
+        """
+        For a block read lazily from the datastore, a tuple of (decode
+        function, validation level) for the allocations and attributes that
+        have not been decoded yet.  See _decode().
+        """
+
+        # Indexes over the attributes and allocations.  These are built on
+        # first use (see _ensure_indexes) and then kept up to date as the
+        # block is modified.  They are not part of the stored block.
+        self._attr_ordinals = None
+        """
+        List of sets, one per entry in `attributes`, containing the ordinals
+        of the addresses allocated with those attributes.
+        """
+
+        self._handle_attrs = None
+        """
+        Dictionary mapping handle ID to the set of indexes into `attributes`
+        for attributes with that handle ID.
+        """
+
+        self._attr_keys = None
+        """
+        Dictionary mapping the canonical JSON encoding of an attributes
+        dictionary to its index into `attributes`.
+        """
+
+    @property
+    def attributes(self):
+        """
+        List of dictionaries of attributes for allocations.
+        """
+        self._decode()
+        return self._attributes
+
+    @property
+    def allocations(self):
+        """
+        A fixed length list with one entry for every address in the block.
+        None means unallocated.  A non-negative integer indicates the address
+        is allocated, and is the index into the `attributes` array for the
+        attributes assigned to the allocation.
+        """
+        self._decode()
+        return [None if idx == UNALLOCATED else idx
+                for idx in self._attr_indexes]
+
+    @property
+    def unallocated(self):
+        """
+        A list of unallocated addresses, with most recently de-allocated
+        addresses at the end of the list.  Each entry contains an address
+        ordinal.
+        """
+        self._decode()
+        return list(self._iter_unallocated())
+
     def to_json(self):
         """
         Convert to a JSON representation for writing to etcd.
         """
+        self._decode()
+
         # Convert a host value of None to an empty string.
         affinity = AllocationBlock.HOST_AFFINITY_T % self.host_affinity \
                      if self.host_affinity \
@@ -136,62 +273,160 @@ class AllocationBlock(object):
                      AllocationBlock.UNALLOCATED: self.unallocated}
         return json.dumps(json_dict)
 
-    @classmethod
-    def from_etcd_result(cls, etcd_result):
+    def to_compact(self):
         """
-        Convert a JSON representation into an instance of AllocationBlock.
+        Convert to the compact representation for writing to etcd.
+
+        The binary block is base64 encoded, since etcd v2 values are strings.
         """
-        json_dict = json.loads(etcd_result.value)
-        cidr_prefix = IPNetwork(json_dict[AllocationBlock.CIDR])
+        return "%s%d:%s" % (COMPACT_PREFIX, COMPACT_VERSION,
+                            base64.b64encode(str(self._pack())))
 
-        # Parse out the host.  For now, it's in the form host:<host id>.  An
-        # empty host ID is converted to None to indicate the block has no
-        # specific host affinity.
-        affinity = json_dict[AllocationBlock.AFFINITY]
-        if not affinity:
-            host_affinity = None
-        else:
-            assert affinity[:5] == "host:"
-            host_affinity = affinity[5:]
+    def encode(self, encoding=ENCODING_JSON):
+        """
+        Convert to the requested representation for writing to etcd.
+        :param encoding: ENCODING_JSON or ENCODING_COMPACT.
+        """
+        if encoding == ENCODING_COMPACT:
+            return self.to_compact()
+        assert encoding == ENCODING_JSON, "Unknown encoding %s" % encoding
+        return self.to_json()
 
-        # Parse out the strict_affinity flag.  If this does not exist
-        # assume False.
-        strict_affinity = json_dict.get(AllocationBlock.STRICT_AFFINITY,
-                                        False)
+    @classmethod
+    def from_etcd_result(cls, etcd_result, validation=VALIDATE_FULL,
+                         lazy=False):
+        """
+        Convert a JSON or compact representation into an instance of
+        AllocationBlock.  The representation is detected from the value.
+
+        :param etcd_result: The EtcdResult containing the block.
+        :param validation: VALIDATE_OFF, VALIDATE_SAMPLED or VALIDATE_FULL;
+        whether to check the consistency of the allocations when they are
+        decoded.  An inconsistent block raises an InvalidBlockError.
+        :param lazy: If True, only the CIDR, affinity and free address count
+        are decoded now.  The allocations and attributes are decoded (and
+        validated) when they are first used.
+        """
+        value = etcd_result.value
+        if value.startswith(COMPACT_PREFIX):
+            (cidr_prefix, host_affinity, strict_affinity, num_free,
+             decode) = _unpack_compact(value)
+        else:
+            (cidr_prefix, host_affinity, strict_affinity, num_free,
+             decode) = _parse_json(value)
 
         block = cls(cidr_prefix, host_affinity, strict_affinity)
         block.db_result = etcd_result
-
-        # Process & check allocations
-        allocations = json_dict[AllocationBlock.ALLOCATIONS]
-        assert len(allocations) == BLOCK_SIZE
-        block.allocations = allocations
-
-        # Process & check attributes
-        attributes = json_dict[AllocationBlock.ATTRIBUTES]
-        block.attributes = attributes
-        assert (block._verify_attributes())
-
-        # Process unallocated addresses.  If this does not exist, assign based
-        # on the unallocated entries.
-        unallocated = json_dict.get(AllocationBlock.UNALLOCATED)
-        if unallocated is None:
-            unallocated = [o for o in range(BLOCK_SIZE)
-                                 if allocations[o] is None]
-        block.unallocated = unallocated
-        assert (block._verify_unallocated())
+        block._num_free = num_free
+        block._pending = (decode, validation)
+        if not lazy:
+            block._decode()
 
         return block
 
-    def update_result(self):
+    def update_result(self, encoding=ENCODING_JSON):
         """
         Return the EtcdResult with any changes to the object written to
         result.value.
+        :param encoding: ENCODING_JSON or ENCODING_COMPACT.
         :return:
         """
-        self.db_result.value = self.to_json()
+        self.db_result.value = self.encode(encoding)
         return self.db_result
 
+    def _decode(self):
+        """
+        Decode the allocations and attributes of a lazily read block, if not
+        done already.
+        """
+        if self._pending is None:
+            return
+        decode, validation = self._pending
+        self._pending = None
+
+        # Process & check allocations and attributes.  The unallocated list
+        # may not exist, in which case it is derived from the allocations.
+        allocations, attributes, unallocated = decode()
+        if len(allocations) != self.size:
+            raise InvalidBlockError("Block %s has %d allocations" %
+                                    (self.cidr, len(allocations)))
+        self._load(allocations, attributes, unallocated)
+        if validation == VALIDATE_FULL or (
+                validation == VALIDATE_SAMPLED and
+                random.random() < VALIDATION_SAMPLE_RATE):
+            self._verify_attributes()
+            self._verify_unallocated()
+
+    def _pack(self):
+        """
+        Pack the block into the binary format used by the compact encoding.
+
+        The format (version 1) is:
+          - flags byte
+          - IP version byte, prefix length byte and the network address
+          - varint length prefixed host affinity (empty for no affinity)
+          - bitmap of allocated ordinals, little endian
+          - table of distinct handle IDs, each a varint length prefixed string
+          - table of distinct secondary attributes, each a varint length
+            prefixed JSON string
+          - table of attributes, each a pair of varint references into the
+            handle table (0 for no handle) and secondary table
+          - varint attribute index for each allocated ordinal, in order
+          - unless the unallocated ordinals are in ascending order, a varint
+            count followed by the varint unallocated ordinals.
+        :return: bytearray.
+        """
+        self._decode()
+        buf = bytearray()
+        unallocated = self.unallocated
+        flags = 0
+        if self.strict_affinity:
+            flags |= _COMPACT_STRICT_AFFINITY
+        if unallocated == sorted(unallocated):
+            flags |= _COMPACT_NATURAL_ORDER
+        buf.append(flags)
+        buf.append(self.cidr.version)
+        buf.append(self.cidr.prefixlen)
+        buf.extend(self.cidr.ip.packed)
+        _pack_string(buf, self.host_affinity or "")
+
+        used = self._used
+        for _ in xrange((self.size + 7) // 8):
+            buf.append(used & 0xff)
+            used >>= 8
+
+        handle_refs = {}
+        secondary_refs = {}
+        attr_refs = []
+        for attr in self.attributes:
+            handle_id = attr[AllocationBlock.ATTR_HANDLE_ID]
+            if handle_id is None:
+                handle_ref = 0
+            else:
+                handle_ref = handle_refs.setdefault(handle_id,
+                                                    len(handle_refs) + 1)
+            secondary = json.dumps(attr[AllocationBlock.ATTR_SECONDARY],
+                                   sort_keys=True, separators=(",", ":"))
+            secondary_ref = secondary_refs.setdefault(secondary,
+                                                      len(secondary_refs))
+            attr_refs.append((handle_ref, secondary_ref))
+        _pack_table(buf, handle_refs)
+        _pack_table(buf, secondary_refs)
+        _pack_varint(buf, len(attr_refs))
+        for handle_ref, secondary_ref in attr_refs:
+            _pack_varint(buf, handle_ref)
+            _pack_varint(buf, secondary_ref)
+
+        for attr_index in self._attr_indexes:
+            if attr_index != UNALLOCATED:
+                _pack_varint(buf, attr_index)
+
+        if not flags & _COMPACT_NATURAL_ORDER:
+            _pack_varint(buf, len(unallocated))
+            for o in unallocated:
+                _pack_varint(buf, o)
+        return buf
+
     def auto_assign(self, num, handle_id, attributes, host,
                     affinity_check=True):
         """
@@ -220,25 +455,18 @@ class AllocationBlock(object):
             raise NoHostAffinityError("Block host affinity is %s (not %s)" %
                                         (self.host_affinity, host))
 
-        ordinals = []
-        # Walk the allocations until we find enough.
-        while self.unallocated and len(ordinals) < num:
-            o = self.unallocated.pop(0)
-            assert self.allocations[o] is None
-            ordinals.append(o)
-
         ips = []
-        if ordinals:
-            # We found some addresses, now we need to set up attributes.
+        if num and self._num_free:
+            # There are some free addresses, set up the attributes before
+            # taking them so that a failure leaves the block unchanged.
+            self._decode()
             attr_index = self._find_or_add_attrs(handle_id, attributes)
 
             # Perform the allocation.
+            ordinals = self._next_free_ordinals(num)
             for o in ordinals:
-                self.allocations[o] = attr_index
-
-                # Convert ordinal to IP.
-                ip = IPAddress(self.cidr.first + o, version=self.cidr.version)
-                ips.append(ip)
+                self._allocate(o, attr_index)
+            ips = self._ordinals_to_ips(ordinals)
         return ips
 
     def assign(self, address, handle_id, attributes, host):
@@ -264,28 +492,30 @@ class AllocationBlock(object):
             raise NoHostAffinityError("Block host affinity is %s (not %s)" %
                                       (self.host_affinity, host))
 
-        # Convert to an ordinal
-        ordinal = int(address - self.cidr.first)
-        assert 0 <= ordinal <= BLOCK_SIZE, "Address not in block."
+        ordinal = self._ip_to_ordinal(address)
 
         # Check if allocated
-        if self.allocations[ordinal] is not None:
+        self._decode()
+        if self._used >> ordinal & 1:
             raise AlreadyAssignedError("%s is already assigned in block %s" %
                                        (address, self.cidr))
 
         # Set up attributes
         attr_index = self._find_or_add_attrs(handle_id, attributes)
-        self.allocations[ordinal] = attr_index
-        self.unallocated.remove(ordinal)
+        self._allocate(ordinal, attr_index)
+
+        # The ordinal is still queued as free; mark the entry as stale rather
+        # than searching the queue for it.
+        self._stale[ordinal] += 1
+        if len(self._free_order) > 2 * self.size:
+            self._compact_free_order()
 
     def count_free_addresses(self):
         """
         Count the number of free addresses in this block.
         :return: Number of free addresses.
         """
-        # Simply return the length of the unallocated list since we have
-        # an entry for each free address.
-        return len(self.unallocated)
+        return self._num_free
 
     def is_empty(self):
         """
@@ -293,7 +523,7 @@ class AllocationBlock(object):
         assignments in the block.
         :return: True if empty, False otherwise.
         """
-        return (self.count_free_addresses() == BLOCK_SIZE)
+        return self._num_free == self.size
 
     def release(self, addresses):
         """
@@ -309,26 +539,24 @@ class AllocationBlock(object):
             caller can decrement the affected handles.
         """
         assert isinstance(addresses, (set, frozenset))
-        deleting_ref_counts = {}
+        self._decode()
+        self._ensure_indexes()
+        released_attr_indexes = set()
         ordinals = []
         unallocated = set()
         handles_with_counts = {}
         for address in addresses:
-            assert isinstance(address, IPAddress)
-            # Convert to an ordinal
-            ordinal = int(address - self.cidr.first)
-            assert 0 <= ordinal <= BLOCK_SIZE, "Address not in block."
+            ordinal = self._ip_to_ordinal(address)
 
             # Check if allocated
-            attr_idx = self.allocations[ordinal]
-            if attr_idx is None:
+            attr_idx = self._attr_indexes[ordinal]
+            if attr_idx == UNALLOCATED:
                 _log.warning("Asked to release %s in block %s, but it was not "
                              "allocated.", address, self.cidr)
                 unallocated.add(address)
                 continue
             ordinals.append(ordinal)
-            old_count = deleting_ref_counts.get(attr_idx, 0)
-            deleting_ref_counts[attr_idx] = old_count + 1
+            released_attr_indexes.add(attr_idx)
 
             # Increment our count of addresses by handle.
             handle_id = self.\
@@ -337,24 +565,16 @@ class AllocationBlock(object):
             handle_count += 1
             handles_with_counts[handle_id] = handle_count
 
-        # Compute which attributes need to be cleaned up.  We do this by
-        # reference counting.  If we're deleting all the references, then it
-        # needs to be cleaned up.
-        attr_indexes_to_delete = set()
-        ref_counts = self._get_attribute_ref_counts()
-        for idx, refs in deleting_ref_counts.iteritems():
-            if ref_counts[idx] == refs:
-                attr_indexes_to_delete.add(idx)
+        # Release all the requested addresses.
+        for ordinal in ordinals:
+            self._unallocate(ordinal)
 
-        # Delete attributes if necessary
+        # Finally, delete attributes that are no longer referenced by any
+        # allocation.
+        attr_indexes_to_delete = set(idx for idx in released_attr_indexes
+                                     if not self._attr_ordinals[idx])
         if attr_indexes_to_delete:
-            self._delete_attributes(attr_indexes_to_delete, ordinals)
-
-        # All attributes updated.  Finally, release all the requested
-        # addresses.
-        for ordinal in ordinals:
-            self.allocations[ordinal] = None
-            self.unallocated.append(ordinal)
+            self._delete_attributes(attr_indexes_to_delete)
 
         return unallocated, handles_with_counts
 
@@ -368,18 +588,15 @@ class AllocationBlock(object):
 
         if attr_indexes_to_delete:
             # Get the ordinals of IPs to release
-            ordinals = []
-            for o in xrange(BLOCK_SIZE):
-                if self.allocations[o] in attr_indexes_to_delete:
-                    ordinals.append(o)
-
-            # Clean and renumber remaining attributes.
-            self._delete_attributes(attr_indexes_to_delete, ordinals)
+            ordinals = self._get_ordinals_by_attr_indexes(
+                                                    attr_indexes_to_delete)
 
             # Release the addresses.
             for ordinal in ordinals:
-                self.allocations[ordinal] = None
-                self.unallocated.append(ordinal)
+                self._unallocate(ordinal)
+
+            # Clean and renumber remaining attributes.
+            self._delete_attributes(attr_indexes_to_delete)
             return len(ordinals)
         else:
             # Nothing to release.
@@ -392,13 +609,8 @@ class AllocationBlock(object):
         :return: List of IPAddress objects.
         """
         attr_indexes = self._get_attr_indexes_by_handle(handle_id)
-        ips = []
-        for o in xrange(BLOCK_SIZE):
-                if self.allocations[o] in attr_indexes:
-                    ip = IPAddress(self.cidr.first + o,
-                                   version=self.cidr.version)
-                    ips.append(ip)
-        return ips
+        return self._ordinals_to_ips(
+                            self._get_ordinals_by_attr_indexes(attr_indexes))
 
     def get_attributes_for_ip(self, address):
         """
@@ -407,14 +619,12 @@ class AllocationBlock(object):
         :param address: The IPAddress object to query.
         :return: (handle_id, attributes)
         """
-        assert isinstance(address, IPAddress)
-        # Convert to an ordinal
-        ordinal = int(address - self.cidr.first)
-        assert 0 <= ordinal <= BLOCK_SIZE, "Address not in block."
+        ordinal = self._ip_to_ordinal(address)
 
         # Check if allocated
-        attr_index = self.allocations[ordinal]
-        if attr_index is None:
+        self._decode()
+        attr_index = self._attr_indexes[ordinal]
+        if attr_index == UNALLOCATED:
             raise AddressNotAssignedError("%s is not assigned in block %s" % (
                 address, self.cidr))
         else:
@@ -424,148 +634,507 @@ class AllocationBlock(object):
             return (attr[AllocationBlock.ATTR_HANDLE_ID],
                     attr[AllocationBlock.ATTR_SECONDARY])
 
+    def _ip_to_ordinal(self, address):
+        """
+        Convert an address in the block to its ordinal.
+        :param address: IPAddress in the block.
+        :return: The ordinal of the address.
+        """
+        assert isinstance(address, IPAddress)
+        ordinal = int(address) - self._first
+        assert 0 <= ordinal < self.size, "Address not in block."
+        return ordinal
+
+    def _ordinals_to_ips(self, ordinals):
+        """
+        Convert ordinals in the block to addresses.
+        :param ordinals: Iterable of ordinals.
+        :return: List of IPAddress objects.
+        """
+        first = self._first
+        version = self.cidr.version
+        return [IPAddress(first + o, version=version) for o in ordinals]
+
     def _get_attr_indexes_by_handle(self, handle_id):
         """
         Get the attribute indexes for a given handle.
         :param handle_id: The handle ID to search for.
         :return: List of attribute indexes.
         """
-        attr_indexes = []
-        for ii, attr in enumerate(self.attributes):
-            if attr[AllocationBlock.ATTR_HANDLE_ID] == handle_id:
-                attr_indexes.append(ii)
-        return attr_indexes
+        self._ensure_indexes()
+        return sorted(self._handle_attrs.get(handle_id, ()))
 
-    def _delete_attributes(self, attr_indexes_to_delete, ordinals):
+    def _get_ordinals_by_attr_indexes(self, attr_indexes):
+        """
+        Get the ordinals of the addresses allocated with any of the given
+        attributes.
+        :param attr_indexes: Iterable of attribute indexes.
+        :return: Sorted list of ordinals.
+        """
+        self._ensure_indexes()
+        ordinals = []
+        for idx in attr_indexes:
+            ordinals.extend(self._attr_ordinals[idx])
+        ordinals.sort()
+        return ordinals
+
+    def _delete_attributes(self, attr_indexes_to_delete):
         """
         Delete some attributes (used during release processing).
 
-        This removes the attributes from the self.attributes list, and updates
-        the allocation list with the new indexes.
+        Each attribute is removed by moving the last entry in the
+        self.attributes list into its slot, so only the allocations using the
+        moved attributes need to be updated.  The addresses allocated with the
+        deleted attributes must already have been released.
 
         :param attr_indexes_to_delete: set of indexes of attributes to delete
-        :param ordinals: list of ordinals of IPs to release (for debugging)
         :return: None.
         """
-        new_indexes = range(len(self.attributes))
-        new_attributes = []
-        y = 0  # next free slot in new attributes list.
-        for x in xrange(len(self.attributes)):
-            if x in attr_indexes_to_delete:
-                # current attr at x being deleted.
-                new_indexes[x] = None
+        self._ensure_indexes()
+
+        # Delete from the highest index down so that the entry moved into a
+        # deleted slot is never itself due for deletion.
+        for x in sorted(attr_indexes_to_delete, reverse=True):
+            assert not self._attr_ordinals[x], "Deleting attributes in use."
+            self._unindex_attrs(x)
+
+            last = len(self.attributes) - 1
+            if x != last:
+                # Move the last attributes into the deleted slot.
+                self._unindex_attrs(last)
+                self.attributes[x] = self.attributes[last]
+                self._attr_ordinals[x] = self._attr_ordinals[last]
+                for o in self._attr_ordinals[x]:
+                    self._attr_indexes[o] = x
+                self._index_attrs(x, self.attributes[x])
+            self.attributes.pop()
+            self._attr_ordinals.pop()
+
+    def _load(self, allocations, attributes, unallocated=None):
+        """
+        Populate the allocation state from its JSON representation.
+
+        :param allocations: List with one entry per address in the block,
+        either None or the index of the attributes for the allocation.
+        :param attributes: List of attribute dictionaries.
+        :param unallocated: List of unallocated ordinals in allocation order,
+        or None to derive the order from the allocations.
+        """
+        self._attributes = attributes
+        self._attr_ordinals = None
+        self._handle_attrs = None
+        self._attr_keys = None
+        self._used = 0
+        self._num_free = 0
+        for o, attr_index in enumerate(allocations):
+            if attr_index is None:
+                self._attr_indexes[o] = UNALLOCATED
+                self._num_free += 1
             else:
-                # current attr at x is kept.
-                new_indexes[x] = y
-                y += 1
-                new_attributes.append(self.attributes[x])
-        self.attributes = new_attributes
-
-        # Spin through all the allocations and update indexes
-        for i in xrange(BLOCK_SIZE):
-            if self.allocations[i] is not None:
-                new_index = new_indexes[self.allocations[i]]
-                self.allocations[i] = new_index
-                # If the new index is None, we better be releasing that
-                # address
-                assert new_index is not None or i in ordinals
-
-    def _get_attribute_ref_counts(self):
-        """
-        Walk the allocations and get a dictionary of reference counts to each
-        set of attributes.
-        """
-        ref_counts = {}
-        for a in self.allocations:
-            old_counts = ref_counts.get(a, 0)
-            ref_counts[a] = old_counts + 1
-        return ref_counts
+                self._attr_indexes[o] = attr_index
+                self._used |= 1 << o
+        if unallocated is None:
+            unallocated = [o for o in xrange(self.size)
+                                 if allocations[o] is None]
+        self._free_order = deque(unallocated)
+        self._stale = array('l', [0]) * self.size
+
+    def _allocate(self, ordinal, attr_index):
+        """
+        Mark an unallocated ordinal as allocated with the given attributes.
+
+        This does not update the free queue, callers are responsible for
+        either popping or marking stale the queued entry.
+        """
+        assert not self._used >> ordinal & 1
+        self._attr_indexes[ordinal] = attr_index
+        self._used |= 1 << ordinal
+        self._num_free -= 1
+        if self._attr_ordinals is not None:
+            self._attr_ordinals[attr_index].add(ordinal)
+
+    def _unallocate(self, ordinal):
+        """
+        Mark an allocated ordinal as unallocated, queueing it at the end of the
+        free queue.
+        """
+        assert self._used >> ordinal & 1
+        if self._attr_ordinals is not None:
+            self._attr_ordinals[self._attr_indexes[ordinal]].discard(ordinal)
+        self._attr_indexes[ordinal] = UNALLOCATED
+        self._used &= ~(1 << ordinal)
+        self._num_free += 1
+        self._free_order.append(ordinal)
+
+    def _next_free_ordinals(self, num):
+        """
+        Pop up to num ordinals from the head of the free queue.
+
+        The ordinals are not marked as allocated.
+        :param num: The maximum number of ordinals to return.
+        :return: List of unallocated ordinals.
+        """
+        ordinals = []
+        num = min(num, self._num_free)
+        while len(ordinals) < num:
+            o = self._free_order.popleft()
+            if self._stale[o]:
+                # Entry for an address that was explicitly assigned.
+                self._stale[o] -= 1
+                continue
+            assert not self._used >> o & 1
+            ordinals.append(o)
+        return ordinals
+
+    def _iter_unallocated(self):
+        """
+        Iterate through the unallocated ordinals in allocation order.
+        """
+        skip = array('l', self._stale)
+        for o in self._free_order:
+            if skip[o]:
+                skip[o] -= 1
+                continue
+            yield o
+
+    def _compact_free_order(self):
+        """
+        Remove stale entries from the free queue.
+        """
+        self._free_order = deque(self._iter_unallocated())
+        self._stale = array('l', [0]) * self.size
+
+    def _ensure_indexes(self):
+        """
+        Build the attribute and handle indexes if they have not been built
+        since the block was created or loaded.
+        """
+        self._decode()
+        if self._attr_ordinals is not None:
+            return
+        self._attr_ordinals = [set() for _ in self.attributes]
+        self._handle_attrs = {}
+        self._attr_keys = {}
+        for index, attr in enumerate(self.attributes):
+            self._index_attrs(index, attr)
+        for o, index in enumerate(self._attr_indexes):
+            if index != UNALLOCATED:
+                self._attr_ordinals[index].add(o)
+
+    def _index_attrs(self, index, attr):
+        """
+        Add a single attributes entry to the handle and attribute indexes.
+        """
+        handle_id = attr[AllocationBlock.ATTR_HANDLE_ID]
+        self._handle_attrs.setdefault(handle_id, set()).add(index)
+        self._attr_keys[_canonical_attrs(attr)] = index
+
+    def _unindex_attrs(self, index):
+        """
+        Remove a single attributes entry from the handle and attribute
+        indexes.
+        """
+        attr = self.attributes[index]
+        handle_id = attr[AllocationBlock.ATTR_HANDLE_ID]
+        attr_indexes = self._handle_attrs[handle_id]
+        attr_indexes.discard(index)
+        if not attr_indexes:
+            del self._handle_attrs[handle_id]
+        key = _canonical_attrs(attr)
+        if self._attr_keys.get(key) == index:
+            del self._attr_keys[key]
 
     def _find_or_add_attrs(self, primary_key, attributes):
         """
         Check if the key and attributes match existing and return the index, or
         if they don't exist, add them and return the index.
         """
-        assert json.dumps(attributes), \
-            "Attributes aren't JSON serializable."
         attr = {AllocationBlock.ATTR_HANDLE_ID: primary_key,
                 AllocationBlock.ATTR_SECONDARY: attributes}
-        attr_index = None
-        for index, exist_attr in enumerate(self.attributes):
-            if cmp(attr, exist_attr) == 0:
-                attr_index = index
-                break
+        # This raises a TypeError if the attributes aren't JSON serializable.
+        key = _canonical_attrs(attr)
+        self._ensure_indexes()
+        attr_index = self._attr_keys.get(key)
         if attr_index is None:
             # Attributes are new, add them.
             attr_index = len(self.attributes)
             self.attributes.append(attr)
+            self._attr_ordinals.append(set())
+            self._index_attrs(attr_index, attr)
         return attr_index
 
     def _verify_attributes(self):
         """
         Verify the integrity of attribute & allocations.
 
-        This is a debug-only function to detect errors.
+        Raises InvalidBlockError if every attribute isn't used by at least one
+        allocation, or an allocation refers to a missing attribute.
         """
-        attr_indexes = set(self.allocations)
-        max_attr = max(attr_indexes)
-        if max_attr is None:
-            # Empty block.  Just assert empty attrs and exit.
-            assert len(self.attributes) == 0
-            return True
-
-        # All attributes present?
-        assert len(self.attributes) == max_attr + 1
-
-        # All attributes actually used?
-        for x in xrange(max_attr + 1):
-            assert x in attr_indexes
-
-        # All assignments point to attributes or None.
-        for assignment in self.allocations:
-            assert assignment is None or isinstance(assignment, int)
+        self._decode()
+        attr_indexes = set(self._attr_indexes)
+        attr_indexes.discard(UNALLOCATED)
+        if attr_indexes != set(xrange(len(self._attributes))):
+            raise InvalidBlockError("Block %s allocations refer to attributes "
+                                    "%s, but has %d attributes" %
+                                    (self.cidr, sorted(attr_indexes),
+                                     len(self._attributes)))
         return True
 
     def _verify_unallocated(self):
         """
         Verify the integrity of the unallocated array.
 
-        This is a debug-only function to detect errors.
+        Raises InvalidBlockError if the unallocated ordinals are not exactly
+        the unassigned entries in the allocations array.
         """
+        self._decode()
+        for ordinal in self._free_order:
+            if not 0 <= ordinal < self.size:
+                raise InvalidBlockError("Block %s has invalid unallocated "
+                                        "ordinal %s" % (self.cidr, ordinal))
+
         # Check that there are no duplicate ordinals in the unallocated array.
-        ordinals = set(self.unallocated)
-        assert len(ordinals) == len(self.unallocated)
+        unallocated = self.unallocated
+        ordinals = set(unallocated)
+        if len(ordinals) != len(unallocated):
+            raise InvalidBlockError("Block %s has duplicate unallocated "
+                                    "ordinals" % self.cidr)
 
         # Check each ordinal corresponds to an unassigned entry in the
-        # allocations array.
-        for ordinal in ordinals:
-            assert self.allocations[ordinal] is None
-
-        # Check that the number of free allocations is the same as the length
-        # of the unallocated array.
-        assert len(self.unallocated) == len([o for o in self.allocations
-                                                    if o is None])
+        # allocations array, and that the number of free allocations is the
+        # same as the length of the unallocated array.
+        if (any(self._used >> ordinal & 1 for ordinal in ordinals) or
+                len(unallocated) != self._num_free):
+            raise InvalidBlockError("Block %s unallocated ordinals do not "
+                                    "match allocations" % self.cidr)
 
         return True
 
 
-def get_block_cidr_for_address(address):
+def _parse_json(value):
+    """
+    Parse the JSON representation of a block.
+    :return: Tuple of (cidr, host affinity, strict affinity, free address
+    count, decode function).  The decode function returns a tuple of
+    (allocations, attributes, unallocated).
+    """
+    json_dict = json.loads(value)
+    cidr_prefix = IPNetwork(json_dict[AllocationBlock.CIDR])
+
+    # Parse out the host.  For now, it's in the form host:<host id>.  An
+    # empty host ID is converted to None to indicate the block has no
+    # specific host affinity.
+    affinity = json_dict[AllocationBlock.AFFINITY]
+    if not affinity:
+        host_affinity = None
+    else:
+        if affinity[:5] != "host:":
+            raise InvalidBlockError("Block %s has invalid affinity %s" %
+                                    (cidr_prefix, affinity))
+        host_affinity = affinity[5:]
+
+    # Parse out the strict_affinity flag.  If this does not exist
+    # assume False.
+    strict_affinity = json_dict.get(AllocationBlock.STRICT_AFFINITY,
+                                    False)
+
+    allocations = json_dict[AllocationBlock.ALLOCATIONS]
+    attributes = json_dict[AllocationBlock.ATTRIBUTES]
+    unallocated = json_dict.get(AllocationBlock.UNALLOCATED)
+    if unallocated is not None:
+        num_free = len(unallocated)
+    else:
+        num_free = allocations.count(None)
+
+    return (cidr_prefix, host_affinity, strict_affinity, num_free,
+            lambda: (allocations, attributes, unallocated))
+
+
+def _unpack_compact(value):
+    """
+    Parse the compact representation of a block.  See AllocationBlock._pack
+    for the format.
+    :return: Tuple of (cidr, host affinity, strict affinity, free address
+    count, decode function).  The decode function returns a tuple of
+    (allocations, attributes, unallocated).
+    """
+    version, _, encoded = value[len(COMPACT_PREFIX):].partition(":")
+    if version != str(COMPACT_VERSION):
+        raise BlockError("Unsupported compact block version %s" % version)
+    data = bytearray(base64.b64decode(encoded))
+
+    flags = data[0]
+    ip_version = data[1]
+    prefixlen = data[2]
+    addr_len = BITS_BY_VERSION[ip_version] // 8
+    pos = 3 + addr_len
+    addr = 0
+    for byte in data[3:pos]:
+        addr = (addr << 8) | byte
+    cidr_prefix = IPNetwork((addr, prefixlen), version=ip_version)
+
+    host_affinity, pos = _unpack_string(data, pos)
+    host_affinity = host_affinity or None
+
+    size = cidr_prefix.size
+    num_bytes = (size + 7) // 8
+    used = 0
+    for ii, byte in enumerate(data[pos:pos + num_bytes]):
+        used |= byte << (8 * ii)
+    pos += num_bytes
+    num_free = size - bin(used).count("1")
+
+    return (cidr_prefix, host_affinity,
+            bool(flags & _COMPACT_STRICT_AFFINITY), num_free,
+            lambda: _unpack_compact_allocations(data, pos, flags, used, size))
+
+
+def _unpack_compact_allocations(data, pos, flags, used, size):
+    """
+    Parse the attributes and allocations of the compact representation of a
+    block, following the bitmap.
+    :return: Tuple of (allocations, attributes, unallocated)
+    """
+    handle_ids = [None]
+    num, pos = _unpack_varint(data, pos)
+    for _ in xrange(num):
+        handle_id, pos = _unpack_string(data, pos)
+        handle_ids.append(handle_id)
+    secondaries = []
+    num, pos = _unpack_varint(data, pos)
+    for _ in xrange(num):
+        secondary, pos = _unpack_string(data, pos)
+        secondaries.append(secondary)
+    attributes = []
+    num, pos = _unpack_varint(data, pos)
+    for _ in xrange(num):
+        handle_ref, pos = _unpack_varint(data, pos)
+        secondary_ref, pos = _unpack_varint(data, pos)
+        # Decode the secondary attributes separately for each entry, so that
+        # the attributes don't share mutable state.
+        attributes.append({
+            AllocationBlock.ATTR_HANDLE_ID: handle_ids[handle_ref],
+            AllocationBlock.ATTR_SECONDARY:
+                json.loads(secondaries[secondary_ref])})
+
+    allocations = [None] * size
+    for o in xrange(size):
+        if used >> o & 1:
+            allocations[o], pos = _unpack_varint(data, pos)
+
+    if flags & _COMPACT_NATURAL_ORDER:
+        unallocated = None
+    else:
+        unallocated = []
+        num, pos = _unpack_varint(data, pos)
+        for _ in xrange(num):
+            o, pos = _unpack_varint(data, pos)
+            unallocated.append(o)
+    if pos != len(data):
+        raise InvalidBlockError("Trailing data in compact block.")
+
+    return allocations, attributes, unallocated
+
+
+def _pack_varint(buf, value):
+    """
+    Append an unsigned LEB128 varint to a bytearray.
+    """
+    assert value >= 0
+    while value >= 0x80:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _unpack_varint(data, pos):
+    """
+    Read an unsigned LEB128 varint from a bytearray.
+    :return: Tuple of (value, position after the varint)
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _pack_string(buf, string):
+    """
+    Append a varint length prefixed UTF-8 string to a bytearray.
+    """
+    if isinstance(string, unicode):
+        string = string.encode("utf-8")
+    _pack_varint(buf, len(string))
+    buf.extend(string)
+
+
+def _unpack_string(data, pos):
+    """
+    Read a varint length prefixed UTF-8 string from a bytearray.
+    :return: Tuple of (unicode string, position after the string)
+    """
+    length, pos = _unpack_varint(data, pos)
+    end = pos + length
+    return data[pos:end].decode("utf-8"), end
+
+
+def _pack_table(buf, refs):
+    """
+    Append a table of strings to a bytearray.
+    :param refs: Dictionary of string to its (sequential) reference.  The
+    references may start at 0 or 1.
+    """
+    _pack_varint(buf, len(refs))
+    for string, _ in sorted(refs.items(), key=lambda item: item[1]):
+        _pack_string(buf, string)
+
+
+def _canonical_attrs(attr):
+    """
+    Return a canonical string encoding of an attributes dictionary, such that
+    equal dictionaries have equal encodings.
+    """
+    return json.dumps(attr, sort_keys=True)
+
+
+def get_block_cidr_for_address(address, block_size_bits=BLOCK_SIZE_BITS):
     """
     Get the block ID to which a given address belongs.
     :param address: IPAddress
+    :param block_size_bits: The block size of the pool containing the
+    address, as the number of host bits.
     """
-    prefix = PREFIX_MASK[address.version] & address
-    block_id = "%s/%s" % (prefix, BLOCK_PREFIXLEN[address.version])
-    return IPNetwork(block_id)
+    width = BITS_BY_VERSION[address.version]
+    prefix = int(address) & ~((1 << block_size_bits) - 1)
+    return IPNetwork((prefix, width - block_size_bits),
+                     version=address.version)
 
 
-def validate_block_size(cidr):
+def validate_block_size(cidr, block_size_bits=BLOCK_SIZE_BITS):
     """
     Check that the CIDR block size is valid.  This checks that it is at least
-    as large as the minimum block size.
+    as large as the block size.
+    :param cidr: IPNetwork
+    :param block_size_bits: The block size of the pool containing the CIDR,
+    as the number of host bits.
     """
     assert isinstance(cidr, IPNetwork)
-    return cidr.prefixlen <= BLOCK_PREFIXLEN[cidr.version]
+    return cidr.prefixlen <= BITS_BY_VERSION[cidr.version] - block_size_bits
+
+
+def validate_block_size_bits(block_size_bits):
+    """
+    Check that a block size, as the number of host bits, is in the supported
+    range.
+    """
+    return (isinstance(block_size_bits, (int, long)) and
+            not isinstance(block_size_bits, bool) and
+            MIN_BLOCK_SIZE_BITS <= block_size_bits <= MAX_BLOCK_SIZE_BITS)
 
 
 class BlockError(PyCalicoError):
@@ -595,3 +1164,10 @@ class AddressNotAssignedError(BlockError):
     Tried to query an address that isn't assigned.
     """
     pass
+
+
+class InvalidBlockError(BlockError):
+    """
+    A block read from the datastore is inconsistent.
+    """
+    pass
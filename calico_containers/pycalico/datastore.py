@@ -23,8 +23,11 @@ from netaddr import IPNetwork, IPAddress, AddrFormatError
 
 from pycalico.datastore_datatypes import Rules, BGPPeer, IPPool, \
     Endpoint, Profile, Rule, IF_PREFIX, IPAMConfig, Policy
+from pycalico.block import BITS_BY_VERSION
 from pycalico.datastore_errors import DataStoreError, \
-    ProfileNotInEndpoint, ProfileAlreadyInEndpoint, MultipleEndpointsMatch
+    ProfileNotInEndpoint, ProfileAlreadyInEndpoint, MultipleEndpointsMatch, \
+    InvalidBlockSizeError
+from pycalico.metrics import MetricsRegistry, InstrumentedBackend
 from pycalico.util import get_hostname, validate_hostname_port
 
 ETCD_AUTHORITY_DEFAULT = "127.0.0.1:2379"
@@ -115,6 +118,7 @@ IPAM_HOST_PATH = IPAM_HOSTS_PATH + "/%(host)s"
 IPAM_HOST_AFFINITY_PATH = IPAM_HOST_PATH + "/ipv%(version)d/block/"
 IPAM_BLOCK_PATH = IPAM_V_PATH + "assignment/ipv%(version)d/block/"
 IPAM_HANDLE_PATH = IPAM_V_PATH + "handle/"
+IPAM_ATTRIBUTES_PATH = IPAM_V_PATH + "attributes/"
 
 
 def handle_errors(fn):
@@ -125,12 +129,22 @@ def handle_errors(fn):
     :return: The decorated function.
     """
     def wrapped(*args, **kwargs):
+        # Record the call if the client has metrics enabled.
+        metrics = getattr(args[0], "metrics", None) if args else None
+        if metrics is not None:
+            operation = metrics.start(fn.__name__)
+        succeeded = False
         try:
-            return fn(*args, **kwargs)
+            result = fn(*args, **kwargs)
+            succeeded = True
+            return result
         except EtcdException as e:
             # Don't leak out etcd exceptions.
             raise DataStoreError("%s: Error accessing etcd (%s).  Is etcd "
                                  "running?" % (fn.__name__, e.message))
+        finally:
+            if metrics is not None:
+                metrics.finish(operation, succeeded)
     return wrapped
 
 
@@ -140,7 +154,22 @@ class DatastoreClient(object):
     calico CLI.
     """
 
-    def __init__(self):
+    metrics = None
+    """
+    The MetricsRegistry recording the client's operations, or None if
+    metrics are not enabled.
+    """
+
+    def __init__(self, backend=None):
+        """
+        :param backend: (optional) The datastore backend, for example a
+        MemoryEtcdClient or an Etcd3Backend.  Defaults to an etcd v2 client
+        configured from the ETCD_* environment variables.
+        """
+        if backend is not None:
+            self.etcd_client = backend
+            return
+
         etcd_endpoints = os.getenv(ETCD_ENDPOINTS_ENV, '')
         etcd_authority = os.getenv(ETCD_AUTHORITY_ENV, ETCD_AUTHORITY_DEFAULT)
         etcd_scheme = os.getenv(ETCD_SCHEME_ENV, ETCD_SCHEME_DEFAULT)
@@ -252,6 +281,24 @@ class DatastoreClient(object):
                                            cert=key_pair,
                                            ca_cert=etcd_ca)
 
+    def enable_metrics(self, registry=None):
+        """
+        Record the latency and etcd requests of each of the client's
+        operations.
+
+        :param registry: (optional) The MetricsRegistry to record in, which
+        may be shared with other clients.  Defaults to a new registry.
+        :return: The MetricsRegistry.
+        """
+        if registry is None:
+            registry = MetricsRegistry()
+        if self.metrics is None:
+            self.etcd_client = InstrumentedBackend(self.etcd_client, registry)
+        else:
+            self.etcd_client.registry = registry
+        self.metrics = registry
+        return registry
+
     @handle_errors
     def ensure_global_config(self):
         """
@@ -629,6 +676,12 @@ class DatastoreClient(object):
         """
         Set the IP pool configuration.
 
+        The block size of a Calico IPAM pool may not be changed whilst there
+        are allocation blocks in the pool, since the block of an address is
+        found from the block size of its pool.  An InvalidBlockSizeError is
+        raised if the pool is smaller than a block, or its block size differs
+        from that of the existing blocks in the pool.
+
         :param version: 4 for IPv4, 6 for IPv6
         :param pool: IPPool object to configure in the datastore.
         :return: None
@@ -636,11 +689,52 @@ class DatastoreClient(object):
         assert version in (4, 6)
         assert isinstance(pool, IPPool)
 
+        if pool.ipam:
+            block_size_bits = pool.block_size_bits
+            if block_size_bits is None:
+                block_size_bits = self.get_ipam_config().block_size_bits
+            pool.check_block_size_bits(block_size_bits)
+            self._check_pool_blocks(version, pool, block_size_bits)
+
         # Now write the pool configuration.
         key = IP_POOL_KEY % {"version": str(version),
                              "pool": str(pool.cidr).replace("/", "-")}
         self.etcd_client.write(key, pool.to_json())
 
+    def _check_pool_blocks(self, version, pool, block_size_bits):
+        """
+        Check the existing allocation blocks that overlap a pool all have the
+        given block size.
+
+        :param version: 4 for IPv4, 6 for IPv6
+        :param pool: IPPool object.
+        :param block_size_bits: The block size of the pool, as the number of
+        host bits.
+        :raises InvalidBlockSizeError: A block has a different size.
+        """
+        try:
+            result = self.etcd_client.read(IPAM_BLOCK_PATH %
+                                           {"version": version},
+                                           quorum=True,
+                                           recursive=True)
+        except EtcdKeyNotFound:
+            return
+
+        block_prefixlen = BITS_BY_VERSION[version] - block_size_bits
+        for leaf in result.leaves:
+            # When there are no blocks the recursive read returns the parent
+            # directory, which has no value.
+            if not leaf.value:
+                continue
+            block_id = leaf.key.rsplit("/", 1)[-1]
+            block_cidr = IPNetwork(block_id.replace("-", "/"))
+            if (block_cidr.first <= pool.cidr.last and
+                    pool.cidr.first <= block_cidr.last and
+                    block_cidr.prefixlen != block_prefixlen):
+                raise InvalidBlockSizeError("Unable to change the block size "
+                    "of pool %s due to existing allocation block %s." %
+                    (pool.cidr, block_cidr))
+
     @handle_errors
     def add_ip_pool(self, version, pool):
         """
@@ -670,6 +764,21 @@ class DatastoreClient(object):
         # Now write the pool configuration.
         self.set_ip_pool_config(version, pool)
 
+    @handle_errors
+    def get_ipam_config(self):
+        """
+        Return the deployment specific IPAM configuration.
+
+        :return: An IPAMConfig object.
+        """
+        try:
+            result = self.etcd_client.read(IPAM_CONFIG_PATH)
+        except EtcdKeyNotFound:
+            # No IPAM config stored, so return the default.
+            return IPAMConfig()
+        else:
+            return IPAMConfig.from_json(result.value)
+
     @handle_errors
     def remove_ip_pool(self, version, cidr):
         """
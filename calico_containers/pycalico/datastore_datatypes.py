@@ -24,7 +24,10 @@ from netaddr import IPAddress, IPNetwork
 
 from pycalico.util import generate_cali_interface_name, validate_characters, \
     validate_ports, validate_icmp_type
-from pycalico.block import BLOCK_PREFIXLEN
+from pycalico.block import (BITS_BY_VERSION,
+                            BLOCK_SIZE_BITS as DEFAULT_BLOCK_SIZE_BITS,
+                            MIN_BLOCK_SIZE_BITS, MAX_BLOCK_SIZE_BITS,
+                            validate_block_size_bits)
 from pycalico.datastore_errors import InvalidBlockSizeError
 
 
@@ -132,34 +135,60 @@ class IPPool(object):
     Class encapsulating an IPPool.
     """
 
-    def __init__(self, cidr, ipip=False, masquerade=False, ipam=True, disabled=False):
+    def __init__(self, cidr, ipip=False, masquerade=False, ipam=True,
+                 disabled=False, block_size_bits=None):
         """
         Constructor.
         :param cidr: IPNetwork object (or CIDR string) representing the pool.
             NOTE: When used by Calico IPAM, an IPPool's cidr prefix must have a
             length equal to or smaller than an IPAM block, such as /24 if the
-            IPAM block size is /26.
+            IPAM block size is /26.  Pools that use the default block size
+            are checked against the standard block size here, and against the
+            IPAM config when they are configured.
         :param ipip: Use IP-IP for this pool.
         :param masquerade: Enable masquerade (outgoing NAT) for this pool.
         :param ipam: Whether this IPPool is used by Calico IPAM.
         :param disabled: Whether this IPPool is disabled.  If disabled, the pool
         is not used by the IPAM client for new allocation blocks.
+        :param block_size_bits: The size of the IPAM blocks in this pool, as
+        the number of host bits in a block (e.g. 6 for a /26 IPv4 block).  If
+        None, the pool uses the default block size from the IPAM config.
         """
         # Normalize the CIDR (e.g. 1.2.3.4/16 -> 1.2.0.0/16)
         self.cidr = IPNetwork(cidr).cidr
         self.ipam = bool(ipam)
+        if (block_size_bits is not None and
+                not validate_block_size_bits(block_size_bits)):
+            raise InvalidBlockSizeError("The block size for a pool must be "
+                "between %s and %s bits. Given: %s" %
+                (MIN_BLOCK_SIZE_BITS, MAX_BLOCK_SIZE_BITS, block_size_bits))
+        self.block_size_bits = block_size_bits
         if self.ipam:
-            if self.cidr.prefixlen > BLOCK_PREFIXLEN[self.cidr.version]:
-                raise InvalidBlockSizeError("The CIDR block size for an "
-                    "IPv%s pool when using Calico IPAM must have a prefix "
-                    "length of %s or lower. Given: %s" %
-                    (self.cidr.version,
-                     BLOCK_PREFIXLEN[self.cidr.version],
-                     self.cidr.prefixlen))
+            # Pools that use the IPAM config default are validated against
+            # the standard block size.
+            self.check_block_size_bits(DEFAULT_BLOCK_SIZE_BITS
+                                       if block_size_bits is None
+                                       else block_size_bits)
         self.ipip = bool(ipip)
         self.masquerade = bool(masquerade)
         self.disabled = bool(disabled)
 
+    def check_block_size_bits(self, block_size_bits):
+        """
+        Check the pool holds at least one block of the given size.
+
+        :param block_size_bits: The block size, as the number of host bits.
+        :raises InvalidBlockSizeError: The pool is smaller than a block.
+        """
+        max_prefixlen = BITS_BY_VERSION[self.cidr.version] - block_size_bits
+        if self.cidr.prefixlen > max_prefixlen:
+            raise InvalidBlockSizeError("The CIDR block size for an "
+                "IPv%s pool when using Calico IPAM must have a prefix "
+                "length of %s or lower. Given: %s" %
+                (self.cidr.version,
+                 max_prefixlen,
+                 self.cidr.prefixlen))
+
     def to_json(self):
         """
         Convert the IPPool to a JSON string.
@@ -177,6 +206,8 @@ class IPPool(object):
             json_dict["ipam"] = False
         if self.disabled:
             json_dict["disabled"] = True
+        if self.block_size_bits is not None:
+            json_dict["block_size_bits"] = self.block_size_bits
         return json.dumps(json_dict)
 
     @classmethod
@@ -186,14 +217,16 @@ class IPPool(object):
         :param json_str: The JSON string representing an IPPool.
         :return: An IPPool object.
         """
-        # The fields "ipam" and "disabled" may not be present in older versions
-        # of the data, so use default values if not present.
+        # The fields "ipam", "disabled" and "block_size_bits" may not be
+        # present in older versions of the data, so use default values if not
+        # present.
         json_dict = json.loads(json_str)
         return cls(json_dict["cidr"],
                    ipip=json_dict.get("ipip"),
                    masquerade=json_dict.get("masquerade"),
                    ipam=json_dict.get("ipam", True),
-                   disabled=json_dict.get("disabled", False))
+                   disabled=json_dict.get("disabled", False),
+                   block_size_bits=json_dict.get("block_size_bits"))
 
     def __eq__(self, other):
         if not isinstance(other, IPPool):
@@ -202,7 +235,8 @@ class IPPool(object):
                 self.ipip == other.ipip and
                 self.masquerade == other.masquerade and
                 self.ipam == other.ipam and
-                self.disabled == other.disabled)
+                self.disabled == other.disabled and
+                self.block_size_bits == other.block_size_bits)
 
     def __contains__(self, item):
         """
@@ -529,8 +563,10 @@ class IPAMConfig(object):
     """
     AUTO_ALLOCATE_BLOCKS = "auto_allocate_blocks"
     STRICT_AFFINITY = "strict_affinity"
+    BLOCK_SIZE_BITS = "block_size_bits"
 
-    def __init__(self, auto_allocate_blocks=True, strict_affinity=False):
+    def __init__(self, auto_allocate_blocks=True, strict_affinity=False,
+                 block_size_bits=DEFAULT_BLOCK_SIZE_BITS):
         self.auto_allocate_blocks = auto_allocate_blocks
         """
         Whether Calico IPAM module is allowed to auto-allocate affine blocks
@@ -542,6 +578,16 @@ class IPAMConfig(object):
         Whether strict affinity should be observed for affine blocks.
         """
 
+        if not validate_block_size_bits(block_size_bits):
+            raise InvalidBlockSizeError("The default block size must be "
+                "between %s and %s bits. Given: %s" %
+                (MIN_BLOCK_SIZE_BITS, MAX_BLOCK_SIZE_BITS, block_size_bits))
+        self.block_size_bits = block_size_bits
+        """
+        The block size, as the number of host bits, used by IP pools that do
+        not specify their own block size.
+        """
+
     def to_json(self):
         """
         Convert the IPAMConfig object to a JSON string.
@@ -559,7 +605,8 @@ class IPAMConfig(object):
         """
         return {
             IPAMConfig.AUTO_ALLOCATE_BLOCKS: self.auto_allocate_blocks,
-            IPAMConfig.STRICT_AFFINITY: self.strict_affinity
+            IPAMConfig.STRICT_AFFINITY: self.strict_affinity,
+            IPAMConfig.BLOCK_SIZE_BITS: self.block_size_bits
         }
 
     @classmethod
@@ -573,14 +620,17 @@ class IPAMConfig(object):
         json_dict = json.loads(json_str)
         return IPAMConfig(
             auto_allocate_blocks=json_dict[IPAMConfig.AUTO_ALLOCATE_BLOCKS],
-            strict_affinity=json_dict[IPAMConfig.STRICT_AFFINITY]
+            strict_affinity=json_dict[IPAMConfig.STRICT_AFFINITY],
+            block_size_bits=json_dict.get(IPAMConfig.BLOCK_SIZE_BITS,
+                                          DEFAULT_BLOCK_SIZE_BITS)
         )
 
     def __eq__(self, other):
         if not isinstance(other, IPAMConfig):
             return NotImplemented
         return (self.auto_allocate_blocks == other.auto_allocate_blocks and
-                self.strict_affinity == other.strict_affinity)
+                self.strict_affinity == other.strict_affinity and
+                self.block_size_bits == other.block_size_bits)
 
     def __ne__(self, other):
         result = self.__eq__(other)
@@ -0,0 +1,570 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+etcd v3 datastore backend.
+
+Etcd3Backend stores the datastore in an etcd v3 cluster, using the JSON
+gateway to the v3 API, so needs no libraries beyond those python-etcd
+already uses.  It provides the etcd v2 semantics the datastore and IPAM
+clients expect on top of the flat v3 keyspace:
+
+  - directories are implied by the keys under them: reading a directory
+    reads the range of keys with its prefix, and deleting one deletes the
+    range.  Creating a directory writes a marker key, the directory's key
+    with a trailing "/", so that empty directories exist too
+  - etcd indexes are v3 revisions, so a key's modifiedIndex is its
+    mod_revision and prevIndex compares against it
+  - compare-and-swap writes and deletes are single v3 transactions.  When
+    the condition fails, the transaction reads the key instead, and the
+    EtcdCompareFailed includes its current node.
+
+It also supports transactions across several keys, which the IPAM client
+uses to write a block and its handle together.
+"""
+import base64
+import json
+import logging
+import posixpath
+
+from etcd import (EtcdResult, EtcdException, EtcdKeyNotFound,
+                  EtcdAlreadyExist, EtcdNotFile, EtcdConnectionFailed,
+                  EtcdEventIndexCleared, EtcdWatchTimedOut)
+import urllib3
+from urllib3.exceptions import HTTPError, ReadTimeoutError
+
+from pycalico.backend import DatastoreBackend, TxnWrite, compare_failed
+
+_log = logging.getLogger(__name__)
+_log.addHandler(logging.NullHandler())
+
+DEFAULT_API_PATH = "/v3"
+"""
+The path of the v3 JSON gateway.  etcd 3.3 serves it at /v3beta.
+"""
+
+DIR_END = "0"
+"""
+The character after "/", so that the keys under a directory "/a" are in the
+range ["/a/", "/a0").
+"""
+
+
+class Etcd3Backend(DatastoreBackend):
+    """
+    Datastore backend for an etcd v3 cluster.
+    """
+
+    transactional = True
+
+    def __init__(self, host="127.0.0.1", port=2379, protocol="http",
+                 cert=None, ca_cert=None, api_path=DEFAULT_API_PATH,
+                 read_timeout=60):
+        """
+        Takes the same connection arguments as etcd.Client.
+
+        :param host: The etcd host, or a tuple of (host, port) tuples for
+        a cluster.  Requests fail over to the next host on connection errors.
+        :param port: The etcd port, if host is a single host.
+        :param protocol: "http" or "https".
+        :param cert: (optional) Client certificate file, or a tuple of
+        (certificate, key) files.
+        :param ca_cert: (optional) Certificate authority file.
+        :param api_path: (optional) The path of the v3 JSON gateway.
+        :param read_timeout: (optional) Timeout for requests, in seconds.
+        """
+        if isinstance(host, tuple):
+            self.hosts = list(host)
+        else:
+            self.hosts = [(host, port)]
+        self.protocol = protocol
+        self.api_path = api_path
+        self.read_timeout = read_timeout
+
+        kwargs = {}
+        if protocol == "https":
+            if isinstance(cert, tuple):
+                kwargs["cert_file"], kwargs["key_file"] = cert
+            elif cert:
+                kwargs["cert_file"] = cert
+            if ca_cert:
+                kwargs["ca_certs"] = ca_cert
+                kwargs["cert_reqs"] = "CERT_REQUIRED"
+        self._http = urllib3.PoolManager(num_pools=10, **kwargs)
+
+    def read(self, key, recursive=False, wait=False, waitIndex=None,
+             timeout=None, quorum=False, **kwargs):
+        key = _normalize_key(key)
+        if wait:
+            return self._watch(key, recursive, waitIndex, timeout)
+
+        # Quorum reads are linearizable.
+        serializable = not quorum
+        response = self._post("/kv/range", {"key": _encode(key),
+                                            "serializable": serializable})
+        kvs = _kvs(response)
+        if kvs:
+            return self._result("get", _node(kvs[0]), response)
+
+        # The key doesn't exist, so read the directory under it.
+        range_request = {"key": _encode(_dir_prefix(key)),
+                         "range_end": _encode(_dir_end(key)),
+                         "serializable": serializable}
+        if recursive:
+            response = self._post("/kv/range", range_request)
+            kvs = _kvs(response)
+        else:
+            # Only the immediate children are needed, so list the keys
+            # without their values, and then read just the children that
+            # are keys rather than directories.
+            range_request["keys_only"] = True
+            response = self._post("/kv/range", range_request)
+            kvs = _kvs(response)
+            prefix = _dir_prefix(key)
+            children = [kv["key"] for kv in kvs
+                        if kv["key"] != prefix and
+                        "/" not in kv["key"][len(prefix):]]
+            if children:
+                child_ranges = self._txn([], [{"request_range": {
+                                                "key": _encode(child)}}
+                                              for child in children], [])
+                values = dict((kv["key"], kv["value"])
+                              for r in child_ranges.get("responses", [])
+                              for kv in _kvs(r["response_range"]))
+                # Skip children deleted since they were listed.
+                kvs = [dict(kv, value=values.get(kv["key"], ""))
+                       for kv in kvs
+                       if kv["key"] not in children or kv["key"] in values]
+        if not kvs:
+            raise EtcdKeyNotFound("Key not found", key)
+        return self._result("get", _dir_node(key, kvs, recursive),
+                            response)
+
+    def write(self, key, value, ttl=None, dir=False, append=False,
+              prevExist=None, prevIndex=None, prevValue=None, **kwargs):
+        key = _normalize_key(key)
+        if append:
+            raise EtcdException("Append is not supported for etcd v3")
+        if dir:
+            if value:
+                raise EtcdException("Cannot create a directory with a value")
+            return self._write_dir(key)
+
+        put = {"key": _encode(key), "value": _encode(_to_value(value)),
+               "prev_kv": True}
+        if ttl is not None:
+            response = self._post("/lease/grant", {"TTL": ttl})
+            put["lease"] = response["ID"]
+
+        compares = _compares(key, prevExist, prevIndex, prevValue)
+        if not compares:
+            response = self._post("/kv/put", put)
+            return self._put_result("set", key, value, response,
+                                    response["header"])
+
+        response = self._txn(compares, [{"request_put": put}],
+                             [{"request_range": {"key": _encode(key)}}])
+        if not response.get("succeeded"):
+            current = _kvs(response["responses"][0]["response_range"])
+            if not current:
+                raise EtcdKeyNotFound("Key not found", key)
+            if prevExist is False:
+                raise EtcdAlreadyExist("Key already exists", key)
+            raise _compare_failed(key, prevIndex, prevValue, current[0],
+                                  response)
+        put_response = response["responses"][0]["response_put"]
+        if prevExist is False:
+            action = "create"
+        elif prevIndex is not None or prevValue is not None:
+            action = "compareAndSwap"
+        else:
+            action = "update"
+        return self._put_result(action, key, value, put_response,
+                                response["header"])
+
+    def delete(self, key, recursive=None, dir=None, prevIndex=None,
+               prevValue=None, **kwargs):
+        key = _normalize_key(key)
+        delete = {"key": _encode(key), "prev_kv": True}
+        requests = [{"request_delete_range": delete}]
+        if recursive:
+            requests.append({"request_delete_range": {
+                "key": _encode(_dir_prefix(key)),
+                "range_end": _encode(_dir_end(key))}})
+        elif dir:
+            # Delete the directory's marker.
+            requests.append({"request_delete_range": {
+                "key": _encode(_dir_prefix(key))}})
+
+        compares = _compares(key, None, prevIndex, prevValue)
+        response = self._txn(compares, requests,
+                             [{"request_range": {"key": _encode(key)}}])
+        if not response.get("succeeded"):
+            current = _kvs(response["responses"][0]["response_range"])
+            if not current:
+                raise EtcdKeyNotFound("Key not found", key)
+            raise _compare_failed(key, prevIndex, prevValue, current[0],
+                                  response)
+
+        deleted = [int(r["response_delete_range"].get("deleted", 0))
+                   for r in response["responses"]]
+        if not any(deleted):
+            raise EtcdKeyNotFound("Key not found", key)
+        revision = int(response["header"]["revision"])
+        prev_kvs = _kvs(response["responses"][0]["response_delete_range"],
+                        "prev_kvs")
+        prev_node = _node(prev_kvs[0]) if prev_kvs else None
+        result = EtcdResult("delete",
+                            {"key": key, "dir": not prev_kvs,
+                             "modifiedIndex": revision},
+                            prevNode=prev_node)
+        result.etcd_index = revision
+        return result
+
+    def transaction(self, ops):
+        compares = []
+        requests = []
+        ranges = []
+        for op in ops:
+            key = _normalize_key(op.key)
+            ranges.append({"request_range": {"key": _encode(key)}})
+            if isinstance(op, TxnWrite):
+                compares.extend(_compares(key, op.prevExist, op.prevIndex,
+                                          None))
+                requests.append({"request_put": {
+                    "key": _encode(key),
+                    "value": _encode(_to_value(op.value))}})
+            else:
+                compares.extend(_compares(key, True, op.prevIndex, None))
+                requests.append({"request_delete_range": {
+                    "key": _encode(key)}})
+
+        response = self._txn(compares, requests, ranges)
+        if not response.get("succeeded"):
+            nodes = {}
+            for r in response.get("responses", []):
+                for kv in _kvs(r["response_range"]):
+                    nodes[kv["key"]] = _node(kv)
+            raise compare_failed(",".join(op.key for op in ops),
+                                 _revision(response), nodes)
+        revision = int(response["header"]["revision"])
+        results = []
+        for op in ops:
+            node = {"key": _normalize_key(op.key), "modifiedIndex": revision}
+            if isinstance(op, TxnWrite):
+                node["value"] = _to_value(op.value)
+                if op.prevExist is False:
+                    action = "create"
+                elif op.prevExist or op.prevIndex is not None:
+                    action = "compareAndSwap"
+                else:
+                    action = "set"
+            else:
+                action = "delete"
+            result = EtcdResult(action, node)
+            result.etcd_index = revision
+            results.append(result)
+        return results
+
+    def _write_dir(self, key):
+        """
+        Create a directory by writing its marker key.
+
+        :raises EtcdNotFile: The directory already exists.
+        """
+        marker = _encode(_dir_prefix(key))
+        response = self._txn([{"key": marker, "target": "CREATE",
+                               "result": "EQUAL", "create_revision": 0}],
+                             [{"request_put": {"key": marker, "value": ""}}],
+                             [])
+        if not response.get("succeeded"):
+            raise EtcdNotFile("Not a file", key)
+        revision = int(response["header"]["revision"])
+        result = EtcdResult("set", {"key": key, "dir": True,
+                                    "modifiedIndex": revision,
+                                    "createdIndex": revision})
+        result.etcd_index = revision
+        return result
+
+    def _watch(self, key, recursive, wait_index, timeout):
+        """
+        Wait for the next change to a key, or to the subtree under it.
+        """
+        create = {"key": _encode(key)}
+        if recursive:
+            create["range_end"] = _encode(_dir_end(key))
+        if wait_index is not None:
+            create["start_revision"] = wait_index
+        response = self._request("/watch", {"create_request": create},
+                                 timeout=timeout, stream=True)
+        try:
+            for line in _lines(response):
+                result = json.loads(line).get("result", {})
+                if result.get("compact_revision"):
+                    raise EtcdEventIndexCleared("The event in requested "
+                                                "index is outdated and "
+                                                "cleared", wait_index)
+                for event in result.get("events", []):
+                    kv = _decode_kv(event["kv"])
+                    if recursive and not (kv["key"] == key or
+                                          kv["key"].startswith(
+                                              _dir_prefix(key))):
+                        continue
+                    prev_kv = event.get("prev_kv")
+                    prev_node = (_node(_decode_kv(prev_kv))
+                                 if prev_kv else None)
+                    if event.get("type") == "DELETE":
+                        return EtcdResult("delete",
+                                          {"key": kv["key"],
+                                           "modifiedIndex":
+                                               kv["mod_revision"]},
+                                          prevNode=prev_node)
+                    return EtcdResult("set", _node(kv), prevNode=prev_node)
+        except ReadTimeoutError:
+            raise EtcdWatchTimedOut("Watch timed out", key)
+        finally:
+            # Close the connection rather than reusing it, as the rest of
+            # the stream has not been read.
+            response.close()
+            response.release_conn()
+        raise EtcdConnectionFailed("Watch ended without a change")
+
+    def _txn(self, compares, success, failure):
+        return self._post("/kv/txn", {"compare": compares,
+                                      "success": success,
+                                      "failure": failure})
+
+    def _post(self, path, body):
+        """
+        Make a request to the JSON gateway.
+
+        :return: The decoded JSON response.
+        """
+        response = self._request(path, body)
+        return json.loads(response.data)
+
+    def _request(self, path, body, timeout=None, stream=False):
+        """
+        Make a request to the JSON gateway, trying each host in turn until
+        one can be connected to.
+
+        :return: The urllib3 response.
+        """
+        data = json.dumps(body)
+        error = None
+        for _ in range(len(self.hosts)):
+            host, port = self.hosts[0]
+            url = "%s://%s:%s%s%s" % (self.protocol, host, port,
+                                      self.api_path, path)
+            try:
+                response = self._http.request(
+                    "POST", url, body=data,
+                    headers={"Content-Type": "application/json"},
+                    timeout=timeout or self.read_timeout,
+                    preload_content=not stream,
+                    retries=False)
+            except ReadTimeoutError:
+                if stream:
+                    raise EtcdWatchTimedOut("Watch timed out", path)
+                raise EtcdConnectionFailed("Request to %s timed out" % url)
+            except HTTPError as e:
+                _log.warning("Failed to connect to etcd at %s:%s: %s",
+                             host, port, e)
+                error = e
+                # Fail over to the next host.
+                self.hosts.append(self.hosts.pop(0))
+                continue
+            if response.status != 200:
+                raise EtcdException("etcd request %s failed: %s %s" %
+                                     (path, response.status,
+                                      response.data))
+            return response
+        raise EtcdConnectionFailed("Failed to connect to etcd", cause=error)
+
+    def _result(self, action, node, response):
+        result = EtcdResult(action, node)
+        result.etcd_index = int(response["header"]["revision"])
+        return result
+
+    def _put_result(self, action, key, value, put_response, header):
+        revision = int(header["revision"])
+        node = {"key": key, "value": _to_value(value),
+                "modifiedIndex": revision, "createdIndex": revision}
+        prev_kv = put_response.get("prev_kv")
+        prev_node = None
+        if prev_kv:
+            prev_node = _node(_decode_kv(prev_kv))
+            node["createdIndex"] = prev_node["createdIndex"]
+        result = EtcdResult(action, node, prevNode=prev_node)
+        result.etcd_index = revision
+        return result
+
+
+def _compares(key, prev_exist, prev_index, prev_value):
+    """
+    :return: List of v3 transaction compares for the etcd v2 compare-and-swap
+    conditions on a key.
+    """
+    compares = []
+    if prev_exist is False:
+        compares.append({"key": _encode(key), "target": "CREATE",
+                         "result": "EQUAL", "create_revision": 0})
+    elif (prev_exist or prev_index is not None or
+            prev_value is not None):
+        compares.append({"key": _encode(key), "target": "VERSION",
+                         "result": "GREATER", "version": 0})
+    if prev_index is not None:
+        compares.append({"key": _encode(key), "target": "MOD",
+                         "result": "EQUAL", "mod_revision": int(prev_index)})
+    if prev_value is not None:
+        compares.append({"key": _encode(key), "target": "VALUE",
+                         "result": "EQUAL",
+                         "value": _encode(_to_value(prev_value))})
+    return compares
+
+
+def _compare_failed(key, prev_index, prev_value, kv, response):
+    """
+    :param kv: The decoded current key-value of the key.
+    :return: EtcdCompareFailed for a failed compare-and-swap on a key, with
+    the cause etcd v2 gives, and the key's current node.
+    """
+    if prev_index is not None and int(prev_index) != kv["mod_revision"]:
+        cause = "[%s != %s]" % (prev_index, kv["mod_revision"])
+    elif prev_value is not None:
+        cause = "[%s != %s]" % (prev_value, kv["value"])
+    else:
+        cause = key
+    return compare_failed(cause, _revision(response), {key: _node(kv)})
+
+
+def _revision(response):
+    """
+    :return: The revision in the header of a response, or None.
+    """
+    revision = response.get("header", {}).get("revision")
+    return int(revision) if revision is not None else None
+
+
+def _kvs(response, field="kvs"):
+    """
+    :return: List of the decoded key-values in a response.
+    """
+    return [_decode_kv(kv) for kv in response.get(field, [])]
+
+
+def _decode_kv(kv):
+    return {"key": base64.b64decode(kv["key"]),
+            "value": base64.b64decode(kv.get("value", "")),
+            "create_revision": int(kv.get("create_revision", 0)),
+            "mod_revision": int(kv.get("mod_revision", 0))}
+
+
+def _node(kv):
+    """
+    :return: The etcd v2 node for a decoded key-value, which is a directory
+    if the key is a directory marker.
+    """
+    if kv["key"].endswith("/"):
+        return {"key": kv["key"][:-1],
+                "dir": True,
+                "modifiedIndex": kv["mod_revision"],
+                "createdIndex": kv["create_revision"]}
+    return {"key": kv["key"],
+            "value": kv["value"],
+            "modifiedIndex": kv["mod_revision"],
+            "createdIndex": kv["create_revision"]}
+
+
+def _dir_node(key, kvs, recursive):
+    """
+    Build the etcd v2 node for a directory from the keys under it.
+
+    :param key: The directory key.
+    :param kvs: The decoded key-values under the directory, including
+    directory markers.
+    :param recursive: Whether to include the whole subtree, or only the
+    immediate children.
+    :return: The directory node.
+    """
+    root = {"key": key, "dir": True, "nodes": [], "modifiedIndex": 0}
+    dirs = {key: root}
+    prefix = _dir_prefix(key)
+    for kv in sorted(kvs, key=lambda kv: kv["key"]):
+        # A directory was last modified when the last key under it was.
+        root["modifiedIndex"] = max(root["modifiedIndex"], kv["mod_revision"])
+        parts = kv["key"][len(prefix):].split("/")
+        parent = root
+        path = key
+        for part in parts[:-1]:
+            path = posixpath.join(path, part)
+            node = dirs.get(path)
+            if node is None:
+                node = {"key": path, "dir": True, "modifiedIndex": 0}
+                if recursive:
+                    node["nodes"] = []
+                dirs[path] = node
+                parent["nodes"].append(node)
+            node["modifiedIndex"] = max(node["modifiedIndex"],
+                                        kv["mod_revision"])
+            if not recursive:
+                # Only the immediate children are included.
+                break
+            parent = node
+        else:
+            # Directory markers only imply their directories.
+            if parts[-1]:
+                parent["nodes"].append(_node(kv))
+    return root
+
+
+def _lines(response):
+    """
+    Generate the lines of a streamed response.
+    """
+    buf = ""
+    for chunk in response.stream(1024):
+        buf += chunk
+        while "\n" in buf:
+            line, buf = buf.split("\n", 1)
+            if line.strip():
+                yield line
+    if buf.strip():
+        yield buf
+
+
+def _normalize_key(key):
+    return "/" + key.strip("/")
+
+
+def _dir_prefix(key):
+    return key.rstrip("/") + "/"
+
+
+def _dir_end(key):
+    return key.rstrip("/") + DIR_END
+
+
+def _encode(value):
+    return base64.b64encode(value)
+
+
+def _to_value(value):
+    """
+    Convert a value to the string etcd stores.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
@@ -0,0 +1,231 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Non-blocking access to the datastore and IPAM clients.
+
+A ClientExecutor runs the operations of a DatastoreClient or IPAMClient on a
+fixed number of worker threads, and returns a Future for each operation.  At
+most that many operations run at once; the rest wait in a queue until a
+worker is free.  The workers share the keep-alive connections of the
+client's etcd connection pool.
+"""
+import logging
+import Queue
+import threading
+
+from pycalico import PyCalicoError
+
+_log = logging.getLogger(__name__)
+_log.addHandler(logging.NullHandler())
+
+DEFAULT_WORKERS = 10
+"""
+The default number of worker threads.  This matches the number of
+connections python-etcd keeps open to each etcd host.
+"""
+
+_SHUTDOWN = object()
+"""
+Queued to stop a worker thread.
+"""
+
+
+class OperationTimeout(PyCalicoError):
+    """
+    Timed out waiting for an operation to complete.
+    """
+    pass
+
+
+class ExecutorShutdown(PyCalicoError):
+    """
+    Tried to submit an operation to an executor that has been shut down.
+    """
+    pass
+
+
+class Future(object):
+    """
+    The result of an operation submitted to a ClientExecutor.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        """
+        :return: True if the operation has completed.
+        """
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the operation to complete, and return its result.
+
+        :param timeout: (optional) The maximum number of seconds to wait, or
+        None to wait indefinitely.
+        :return: The value returned by the operation.  If the operation raised
+        an exception, that exception is raised.
+        """
+        self._wait(timeout)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Wait for the operation to complete, and return the exception it
+        raised.
+
+        :param timeout: (optional) The maximum number of seconds to wait, or
+        None to wait indefinitely.
+        :return: The exception raised by the operation, or None.
+        """
+        self._wait(timeout)
+        return self._error
+
+    def add_done_callback(self, fn):
+        """
+        Call a function with this future once the operation completes.  If it
+        has already completed, the function is called immediately.
+
+        Callbacks are called on the worker thread that ran the operation, so
+        they should not block.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        self._call(fn)
+
+    def _wait(self, timeout):
+        # Event.wait() can't be interrupted without a timeout on Python 2.
+        if not self._done.wait(timeout):
+            raise OperationTimeout("Operation did not complete in %s "
+                                   "seconds" % timeout)
+
+    def _complete(self, result, error):
+        with self._lock:
+            self._result = result
+            self._error = error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            self._call(fn)
+
+    def _call(self, fn):
+        try:
+            fn(self)
+        except Exception:
+            _log.exception("Exception in future callback %s", fn)
+
+
+class ClientExecutor(object):
+    """
+    Runs the operations of a datastore or IPAM client on a pool of worker
+    threads.
+
+    Calling a public method of the client on the executor queues the call,
+    and returns a Future for its result.  For example:
+
+        executor = ClientExecutor(IPAMClient())
+        future = executor.auto_assign_ips(1, 0, handle_id, {})
+        (v4_addresses, v6_addresses) = future.result()
+
+    The client must be safe to use from several threads at once, which the
+    datastore and IPAM clients are, as they only change the datastore using
+    compare-and-swap.
+    """
+
+    def __init__(self, client, workers=DEFAULT_WORKERS):
+        """
+        :param client: The DatastoreClient or IPAMClient to run operations on.
+        :param workers: (optional) The number of worker threads, which is the
+        maximum number of operations that run at once.
+        """
+        assert workers > 0
+        self.client = client
+        self._queue = Queue.Queue()
+        self._shutdown = False
+        self._shutdown_lock = threading.Lock()
+        self._threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._work,
+                                      name="ClientExecutor-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue a call of a function.
+
+        :param fn: The function to call.
+        :return: A Future for the result of the call.
+        """
+        future = Future()
+        with self._shutdown_lock:
+            if self._shutdown:
+                raise ExecutorShutdown("Executor has been shut down")
+            self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        """
+        Stop the worker threads once the queued operations have completed.
+
+        :param wait: (optional) Whether to wait for the threads to stop.
+        """
+        with self._shutdown_lock:
+            if not self._shutdown:
+                self._shutdown = True
+                for _ in self._threads:
+                    self._queue.put(_SHUTDOWN)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def __getattr__(self, name):
+        """
+        Get a function that queues a call of a public method of the client.
+        """
+        if name.startswith("_"):
+            raise AttributeError(name)
+        method = getattr(self.client, name)
+        if not callable(method):
+            raise AttributeError(name)
+
+        def submit(*args, **kwargs):
+            return self.submit(method, *args, **kwargs)
+        submit.__name__ = name
+        submit.__doc__ = method.__doc__
+        return submit
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is _SHUTDOWN:
+                return
+            future, fn, args, kwargs = item
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                _log.debug("Operation %s failed", fn, exc_info=True)
+                future._complete(None, e)
+            else:
+                future._complete(result, None)
@@ -0,0 +1,263 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Coordination between the IPAM clients on one host, through files in a
+runtime directory.
+
+Without it, several processes assigning addresses on the same host race each
+other through etcd: they read the same affine blocks, claim the same new
+blocks, and retry the compare-and-swaps they lose.  A HostCoordinator lets
+them take turns instead:
+
+  - lock(host, version) takes an flock-based lease on a lock file for the
+    host and IP version, so only one client at a time claims and writes that
+    host's blocks.  The lease is released if the process holding it exits.
+
+  - publish() records the version of a block a client has just written in a
+    shared, memory-mapped table, and lookup() returns it, so the next client
+    to write the block can use it rather than reading the block from etcd.
+    Published versions are treated like cached blocks: they are only used
+    where a compare-and-swap confirms them.
+
+Both are optimizations; correctness still comes from the compare-and-swaps.
+"""
+from contextlib import contextmanager
+import errno
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import urllib
+
+_log = logging.getLogger(__name__)
+_log.addHandler(logging.NullHandler())
+
+DEFAULT_RUNTIME_DIR = "/var/run/calico/ipam"
+
+LOCK_TIMEOUT = 30
+"""
+The default number of seconds to wait for a lease.  If another process holds
+it for longer, for example because it is stuck, the client goes ahead
+without it.
+"""
+
+BLOCKS_FILE = "blocks"
+
+NUM_SLOTS = 1024
+SLOT_SIZE = 4096
+"""
+The published blocks table holds NUM_SLOTS slots of SLOT_SIZE bytes.  Each
+block key maps to a single slot, and a block replaces whichever block was
+published in its slot before.  Blocks that don't fit in a slot aren't
+published.
+"""
+
+FILE_MODE = 0o600
+
+_SLOT_HEADER = struct.Struct("!16sQI")
+"""
+The header of a slot: the MD5 digest of the block key, the modifiedIndex of
+the block, and the length of its value.  An empty slot is all zeros.
+"""
+
+_MIN_POLL_INTERVAL = 0.001
+_MAX_POLL_INTERVAL = 0.02
+
+
+class HostCoordinator(object):
+    """
+    Coordinates the IPAM clients on this host.  Share one between the
+    clients in a process, or create one in each; either way, clients using
+    the same runtime directory are coordinated.  Safe to use from several
+    threads at once.
+    """
+
+    def __init__(self, runtime_dir=DEFAULT_RUNTIME_DIR,
+                 lock_timeout=LOCK_TIMEOUT):
+        """
+        Opens the published blocks table, creating the runtime directory and
+        table if they don't exist.
+
+        :param runtime_dir: (optional) The directory for the lock files and
+        the published blocks table.  This should be on a local filesystem
+        that is emptied on reboot, such as a tmpfs.
+        :param lock_timeout: (optional) The number of seconds to wait for a
+        lease before going ahead without it.
+        """
+        self.runtime_dir = runtime_dir
+        self.lock_timeout = lock_timeout
+        try:
+            os.makedirs(runtime_dir, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self._table_lock = threading.Lock()
+        """
+        Serializes access to the table by the threads of this process; the
+        flock on the table file serializes access by processes.
+        """
+
+        self._table_fd = os.open(os.path.join(runtime_dir, BLOCKS_FILE),
+                                 os.O_RDWR | os.O_CREAT, FILE_MODE)
+        size = NUM_SLOTS * SLOT_SIZE
+        if os.fstat(self._table_fd).st_size < size:
+            os.ftruncate(self._table_fd, size)
+        self._table = mmap.mmap(self._table_fd, size, mmap.MAP_SHARED,
+                                mmap.PROT_READ | mmap.PROT_WRITE)
+
+    @contextmanager
+    def lock(self, host, *versions):
+        """
+        Hold the leases for a host and one or more IP versions.
+
+        Leases are taken in order of version, so holders of several can't
+        deadlock.  Each call opens the lock files afresh, so calls from
+        different threads of a process exclude each other too; don't nest
+        calls for the same lease on one thread.
+
+        :param host: The host ID.
+        :param versions: The IP versions, 4 and/or 6.
+        :return: A context manager, whose value is whether all the leases
+        were taken before the timeout.
+        """
+        fds = []
+        acquired = True
+        try:
+            for version in sorted(set(versions)):
+                path = os.path.join(self.runtime_dir, "%s-v%d.lock" %
+                                    (urllib.quote(host, safe=""), version))
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, FILE_MODE)
+                fds.append(fd)
+                if not _flock_with_timeout(fd, self.lock_timeout):
+                    _log.warning("Timed out waiting for the IPv%d lease for "
+                                 "host %s; continuing without it",
+                                 version, host)
+                    acquired = False
+            yield acquired
+        finally:
+            # Closing the files releases the leases.
+            for fd in fds:
+                os.close(fd)
+
+    def publish(self, key, value, modified_index):
+        """
+        Publish the version of a block that has just been written.
+
+        A version is not published over a later version of the same block.
+
+        :param key: The block's datastore key.
+        :param value: The block's value.
+        :param modified_index: The block's modifiedIndex.
+        """
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        digest, offset = _slot(key)
+        if _SLOT_HEADER.size + len(value) > SLOT_SIZE:
+            # Too large to publish, but don't leave an old version behind.
+            self.unpublish(key)
+            return
+        with self._locked(fcntl.LOCK_EX):
+            slot_digest, slot_index, _ = self._header(offset)
+            if slot_digest == digest and slot_index > modified_index:
+                return
+            self._table[offset:offset + _SLOT_HEADER.size + len(value)] = (
+                _SLOT_HEADER.pack(digest, modified_index, len(value)) + value)
+
+    def lookup(self, key):
+        """
+        :param key: The block's datastore key.
+        :return: The latest published version of the block, as a tuple of
+        (value, modifiedIndex), or None if no version is published.
+        """
+        digest, offset = _slot(key)
+        with self._locked(fcntl.LOCK_SH):
+            slot_digest, modified_index, length = self._header(offset)
+            if slot_digest != digest:
+                return None
+            start = offset + _SLOT_HEADER.size
+            return self._table[start:start + length], modified_index
+
+    def unpublish(self, key):
+        """
+        Remove any published version of a block, for example because it has
+        been deleted.
+
+        :param key: The block's datastore key.
+        """
+        digest, offset = _slot(key)
+        with self._locked(fcntl.LOCK_EX):
+            if self._header(offset)[0] == digest:
+                self._table[offset:offset + _SLOT_HEADER.size] = (
+                    "\0" * _SLOT_HEADER.size)
+
+    def close(self):
+        """
+        Close the published blocks table.  Leases are released as each lock()
+        exits.
+        """
+        with self._table_lock:
+            if self._table is not None:
+                self._table.close()
+                os.close(self._table_fd)
+                self._table = None
+
+    @contextmanager
+    def _locked(self, operation):
+        with self._table_lock:
+            fcntl.flock(self._table_fd, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._table_fd, fcntl.LOCK_UN)
+
+    def _header(self, offset):
+        return _SLOT_HEADER.unpack(
+                            self._table[offset:offset + _SLOT_HEADER.size])
+
+
+def _slot(key):
+    """
+    :return: Tuple of the digest of a block key, and the offset of its slot
+    in the table.
+    """
+    digest = hashlib.md5(key).digest()
+    slot = struct.unpack("!I", digest[:4])[0] % NUM_SLOTS
+    return digest, slot * SLOT_SIZE
+
+
+def _flock_with_timeout(fd, timeout):
+    """
+    Take an exclusive flock on a file, polling until the timeout.
+
+    :return: True if the lock was taken, False if the timeout expired.
+    """
+    deadline = time.time() + timeout
+    interval = _MIN_POLL_INTERVAL
+    while True:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, _MAX_POLL_INTERVAL)
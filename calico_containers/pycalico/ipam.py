@@ -11,14 +11,21 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from collections import deque
+from collections import deque, defaultdict
 
-from etcd import EtcdKeyNotFound, EtcdAlreadyExist, EtcdCompareFailed
+from etcd import (EtcdKeyNotFound, EtcdAlreadyExist, EtcdCompareFailed,
+                  EtcdResult, EtcdException)
 
 from netaddr import IPAddress, IPNetwork
+import hashlib
+import json
 import logging
 import random
+import threading
+import time
 
+from pycalico.backend import (TxnWrite, is_transactional, current_node,
+                              compare_failed_indexes)
 from pycalico.datastore_datatypes import IPPool, IPAMConfig
 from pycalico.datastore import DatastoreClient, handle_errors
 from pycalico.datastore import (IPAM_HOSTS_PATH,
@@ -26,18 +33,24 @@ from pycalico.datastore import (IPAM_HOSTS_PATH,
                                 IPAM_HOST_AFFINITY_PATH,
                                 IPAM_BLOCK_PATH,
                                 IPAM_HANDLE_PATH,
+                                IPAM_ATTRIBUTES_PATH,
                                 IPAM_CONFIG_PATH)
 from pycalico.datastore_errors import (DataStoreError,
                                        PoolNotFound,
                                        InvalidBlockSizeError)
 from pycalico.block import (AllocationBlock,
+                            ENCODING_JSON,
+                            VALIDATE_FULL,
                             get_block_cidr_for_address,
                             validate_block_size,
-                            BLOCK_PREFIXLEN,
+                            BITS_BY_VERSION,
                             AddressNotAssignedError,
+                            AlreadyAssignedError,
                             NoHostAffinityError)
 from pycalico.handle import (AllocationHandle,
                              AddressCountTooLow)
+from pycalico.metrics import bind_operations
+from pycalico.retry import RetryPolicy
 from pycalico.util import get_hostname
 
 _log = logging.getLogger(__name__)
@@ -47,6 +60,40 @@ RETRIES = 100
 
 KEY_ERROR_RETRIES = 3
 
+ATTRIBUTES_REF = "$ref"
+"""
+Key used in place of assignment attributes that are held in the shared
+attribute store.  The value is the SHA-256 digest of the attributes.
+"""
+
+ATTRIBUTES_CACHE_SIZE = 4096
+
+BLOCK_CACHE_SIZE = 1024
+
+CONFLICT_WATCH_TIMEOUT = 1
+"""
+The maximum number of seconds to wait for the write a compare-and-swap
+conflicted with.  The write has already happened, so the wait normally
+returns straight away.
+"""
+
+DELETE_ACTIONS = ("delete", "compareAndDelete", "expire")
+
+SUMMARY_FREE = "free"
+SUMMARY_GENERATION = "generation"
+"""
+Keys of the free-space summary stored as the value of a host affinity key.
+The generation is the modifiedIndex of the block the summary describes.
+"""
+
+CONSISTENCY_QUORUM = "quorum"
+CONSISTENCY_SERIALIZABLE = "serializable"
+"""
+Read consistency levels.  Quorum reads go through the etcd leader and always
+see the latest data.  Serializable reads may be served by any etcd member,
+and so may be stale.
+"""
+
 
 class BlockHandleReaderWriter(DatastoreClient):
     """
@@ -57,6 +104,113 @@ class BlockHandleReaderWriter(DatastoreClient):
     class.
     """
 
+    def __init__(self, block_encoding=ENCODING_JSON,
+                 block_validation=VALIDATE_FULL, dedup_attributes=False,
+                 cache_blocks=False, block_summaries=False,
+                 retry_policy=None, backend=None,
+                 read_consistency=CONSISTENCY_QUORUM, host_coordinator=None):
+        """
+        :param block_encoding: The encoding used when writing allocation
+        blocks, ENCODING_JSON or ENCODING_COMPACT.  Blocks are read in either
+        encoding, but only use ENCODING_COMPACT once all clients sharing the
+        datastore are able to read it.
+        :param block_validation: How thoroughly allocation blocks read from
+        the datastore are checked for consistency, VALIDATE_OFF,
+        VALIDATE_SAMPLED or VALIDATE_FULL.
+        :param dedup_attributes: Whether to write assignment attributes to the
+        shared, content-addressed attribute store, so that blocks only hold a
+        reference to them.  Referenced attributes are always resolved on read,
+        but only set this once all clients sharing the datastore are able to
+        resolve them.
+        :param cache_blocks: Whether to cache blocks this client reads and
+        writes, and compare-and-swap against the cached version instead of
+        reading the block again.  The cached version of a block is discarded
+        when a compare-and-swap fails, or when a decision that is not
+        confirmed by a compare-and-swap would be based on it.
+        :param block_summaries: Whether to publish a summary of the free space
+        in a block on its host affinity key each time the block is written, so
+        that the host can try its emptiest blocks first.  Summaries are always
+        used when present, but are best-effort: a block summarised as full is
+        only deferred, never skipped.
+        :param retry_policy: (optional) The RetryPolicy for compare-and-swap
+        loops, which also records the keys that are retried.  Defaults to
+        exponential backoff with jitter.
+        :param backend: (optional) The datastore backend.  If it supports
+        transactions, each block is written in the same transaction as the
+        handles of the addresses assigned from it.
+        :param read_consistency: The consistency of reads that are confirmed
+        by a compare-and-swap, CONSISTENCY_QUORUM or CONSISTENCY_SERIALIZABLE.
+        Serializable reads let etcd followers serve them, and are treated
+        like cached blocks: a key is read at quorum after a compare-and-swap
+        on it fails, or when a decision that is not confirmed by a
+        compare-and-swap would be based on it.  Reads that aren't confirmed by
+        a compare-and-swap are always at quorum.
+        :param host_coordinator: (optional) A HostCoordinator, to coordinate
+        with the other IPAM clients on this host.  Assignments for a host take
+        its lease for the IP version, so clients on the host claim and write
+        its blocks in turn rather than racing, and blocks this client writes
+        are published for the others.  Published blocks are treated like
+        cached blocks.
+        """
+        super(BlockHandleReaderWriter, self).__init__(backend)
+        self.block_encoding = block_encoding
+        self.block_validation = block_validation
+        self.dedup_attributes = dedup_attributes
+        self.cache_blocks = cache_blocks
+        self.block_summaries = block_summaries
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.read_consistency = read_consistency
+        self.host_coordinator = host_coordinator
+
+        self._block_cache = {}
+        """
+        Cached blocks, as (value, modifiedIndex) tuples keyed by block CIDR.
+        """
+
+        self._quorum_keys = set()
+        """
+        Keys whose next read must be at quorum, with serializable reads.
+        """
+
+        self._unpublished_reads = set()
+        """
+        Block CIDRs whose next read must not use the version published by the
+        host coordinator, because a compare-and-swap against it failed.
+        """
+
+        self._conflicting_blocks = {}
+        """
+        The versions of blocks that compare-and-swaps conflicted with, as
+        (value, modifiedIndex) tuples keyed by block CIDR.  The next read of
+        the block uses this version rather than reading the block again, but
+        treats it as unconfirmed, like a cached block.
+        """
+
+        self.new_block_probes = 0
+        """
+        The total number of candidate blocks checked when looking for a free
+        block to claim, for monitoring.
+        """
+
+        self._attributes_cache = {}
+        """
+        Attributes read from or written to the attribute store, as JSON
+        strings keyed by digest.  Entries in the store never change, so the
+        cache never needs invalidating.
+        """
+
+        self._ipam_pools = {}
+        """
+        The Calico IPAM pools, as lists of (first, last, block_size_bits,
+        disabled) tuples keyed by IP version, read when first needed.  Used
+        to find the block of an address.
+        """
+
+        self._ipam_config = None
+        """
+        The IPAMConfig, read when first needed, or None.
+        """
+
     def _read_block(self, block_cidr):
         """
         Read the block from the data store.
@@ -64,15 +218,179 @@ class BlockHandleReaderWriter(DatastoreClient):
         :return: An AllocationBlock object
         """
         key = _block_datastore_key(block_cidr)
+        conflicting = self._conflicting_blocks.pop(block_cidr, None)
+        cached = self._block_cache.get(block_cidr)
+        published = self._lookup_published(block_cidr)
+        if published is not None and (cached is None or
+                                      published[1] > cached[1]):
+            # Another client on this host has written the block since.
+            cached = published
+        if conflicting is not None:
+            # This version was current when the compare-and-swap failed,
+            # but may be out of date by now, so treat it like a cached
+            # block: only a compare-and-swap confirms it.
+            value, modified_index = conflicting
+            result = EtcdResult(node={"key": key,
+                                      "value": value,
+                                      "modifiedIndex": modified_index})
+            if self.cache_blocks:
+                self._cache_block(block_cidr, value, modified_index)
+            confirmed = False
+        elif cached is not None:
+            value, modified_index = cached
+            result = EtcdResult(node={"key": key,
+                                      "value": value,
+                                      "modifiedIndex": modified_index})
+            confirmed = False
+        else:
+            try:
+                result, confirmed = self._read(key)
+            except EtcdKeyNotFound:
+                raise KeyError(str(block_cidr))
+            if self.cache_blocks:
+                self._cache_block(block_cidr, result.value,
+                                  result.modifiedIndex)
+
+        # Decode lazily; callers often only need the affinity or free count.
+        block = AllocationBlock.from_etcd_result(
+                                            result,
+                                            validation=self.block_validation,
+                                            lazy=True)
+        block.from_cache = not confirmed
+        return block
+
+    def _fetch_conflicting_block(self, block, error):
+        """
+        After a compare-and-swap of a block fails, get the version of the
+        block it conflicted with, for the next read of the block.
+
+        The backend may include the version in the error.  Otherwise, etcd
+        gives the block's current modifiedIndex in the cause of the error,
+        and the version is fetched by waiting for the change at that index,
+        which is still in etcd's event history, rather than with a quorum
+        read.  If the history has been compacted, or the block has been
+        deleted, the next read of the block reads it as normal.
+
+        :param block: The AllocationBlock, read from the datastore.
+        :param error: The EtcdCompareFailed.
+        """
+        key = _block_datastore_key(block.cidr)
+        node = current_node(error, key)
+        if node is None:
+            indexes = compare_failed_indexes(error)
+            if (indexes is None or
+                    indexes[0] != block.db_result.modifiedIndex):
+                return
+            index = indexes[1]
+            try:
+                result = self.etcd_client.watch(
+                                            key, index=index,
+                                            timeout=CONFLICT_WATCH_TIMEOUT)
+            except EtcdException as e:
+                _log.debug("Failed to fetch block %s at index %d: %r",
+                           block.cidr, index, e)
+                return
+            if (result.action in DELETE_ACTIONS or
+                    result.modifiedIndex != index):
+                return
+            node = {"value": result.value, "modifiedIndex": index}
+        self._store_conflicting_block(block.cidr, node)
+
+    def _store_conflicting_block(self, block_cidr, node):
+        """
+        Record the version of a block that a compare-and-swap conflicted
+        with, for the next read of the block.
+
+        :param node: The block's node, with its value and modifiedIndex.
+        """
+        if len(self._conflicting_blocks) >= BLOCK_CACHE_SIZE:
+            self._conflicting_blocks.clear()
+        self._conflicting_blocks[block_cidr] = (node["value"],
+                                                node["modifiedIndex"])
+
+    def _read(self, key, quorum=False, **kwargs):
+        """
+        Read a key at the configured consistency.
+
+        The read is at quorum if read_consistency is CONSISTENCY_QUORUM, if
+        quorum is set, or if the key was passed to _require_quorum() since it
+        was last read.  A serializable read that doesn't find the key is
+        repeated at quorum; without this we allow many subtle race
+        conditions, such as creating a block, then later reading it and
+        finding it doesn't exist.
+
+        :param key: The key.
+        :param quorum: (optional) Whether the read must be at quorum, because
+        it isn't confirmed by a compare-and-swap.
+        :param kwargs: Passed to the etcd client's read().
+        :return: Tuple of the EtcdResult, and whether it was read at quorum.
+        """
+        if self.read_consistency == CONSISTENCY_QUORUM:
+            quorum = True
+        elif key in self._quorum_keys:
+            self._quorum_keys.discard(key)
+            quorum = True
         try:
-            # Use quorum=True to ensure we don't get stale reads.  Without this
-            # we allow many subtle race conditions, such as creating a block,
-            # then later reading it and finding it doesn't exist.
-            result = self.etcd_client.read(key, quorum=True)
+            return self.etcd_client.read(key, quorum=quorum, **kwargs), quorum
         except EtcdKeyNotFound:
-            raise KeyError(str(block_cidr))
-        block = AllocationBlock.from_etcd_result(result)
-        return block
+            if quorum:
+                raise
+        _log.debug("%s not found, confirming with a quorum read", key)
+        return self.etcd_client.read(key, quorum=True, **kwargs), True
+
+    def _require_quorum(self, key):
+        """
+        Make the next read of a key be at quorum, for example because a
+        compare-and-swap on it failed.
+        """
+        if self.read_consistency == CONSISTENCY_QUORUM:
+            return
+        if len(self._quorum_keys) >= BLOCK_CACHE_SIZE:
+            self._quorum_keys.clear()
+        self._quorum_keys.add(key)
+
+    def _lookup_published(self, block_cidr):
+        """
+        :return: The version of the block last published by a client on this
+        host, as a (value, modifiedIndex) tuple, or None.
+        """
+        if self.host_coordinator is None:
+            return None
+        if block_cidr in self._unpublished_reads:
+            self._unpublished_reads.discard(block_cidr)
+            return None
+        return self.host_coordinator.lookup(_block_datastore_key(block_cidr))
+
+    def _host_lock(self, host, *versions):
+        """
+        :return: A context manager holding the host coordinator's leases for
+        the host and IP versions, if there is a host coordinator.
+        """
+        if self.host_coordinator is None:
+            return _NO_LOCK
+        return self.host_coordinator.lock(host, *versions)
+
+    def _cache_block(self, block_cidr, value, modified_index):
+        """
+        Add a block to the block cache.
+        """
+        if len(self._block_cache) >= BLOCK_CACHE_SIZE:
+            self._block_cache.clear()
+        self._block_cache[block_cidr] = (value, modified_index)
+
+    def _uncache_block(self, block_cidr):
+        """
+        Remove a block from the block cache, so the next read of the block
+        goes to the datastore, at quorum.
+        """
+        self._block_cache.pop(block_cidr, None)
+        self._conflicting_blocks.pop(block_cidr, None)
+        if self.host_coordinator is not None:
+            if len(self._unpublished_reads) >= BLOCK_CACHE_SIZE:
+                self._unpublished_reads.clear()
+            self._unpublished_reads.add(block_cidr)
+        if self.read_consistency != CONSISTENCY_QUORUM:
+            self._require_quorum(_block_datastore_key(block_cidr))
 
     def _compare_and_swap_block(self, block):
         """
@@ -82,18 +400,116 @@ class BlockHandleReaderWriter(DatastoreClient):
         # If the block has a db_result, CAS against that.
         if block.db_result is not None:
             _log.debug("CAS Update block %s", block)
+            db_result = block.update_result(self.block_encoding)
+            value = db_result.value
             try:
-                self.etcd_client.update(block.update_result())
-            except EtcdCompareFailed:
+                result = self.etcd_client.update(db_result)
+            except EtcdCompareFailed as e:
+                # The block has changed since it was read.
+                self._uncache_block(block.cidr)
+                self._fetch_conflicting_block(block, e)
+                raise CASError(str(block.cidr))
+            except EtcdKeyNotFound:
+                # The block has been deleted since it was read.
+                self._uncache_block(block.cidr)
                 raise CASError(str(block.cidr))
         else:
             _log.debug("CAS Write new block %s", block)
             key = _block_datastore_key(block.cidr)
-            value = block.to_json()
+            value = block.encode(self.block_encoding)
             try:
-                self.etcd_client.write(key, value, prevExist=False)
+                result = self.etcd_client.write(key, value, prevExist=False)
             except EtcdAlreadyExist:
+                self._uncache_block(block.cidr)
                 raise CASError(str(block.cidr))
+        self._block_written(block, value, result)
+
+    def _compare_and_swap_block_and_handles(self, block, handle_amounts):
+        """
+        Write the block, and increment the counts for the block on the given
+        handles, in a single transaction.  Requires a transactional backend.
+
+        :param block: The AllocationBlock to write.
+        :param handle_amounts: Dict of the amount to increment each handle
+        by, keyed by handle ID.
+        :raises CASError: The block or one of the handles has been modified
+        since it was read.
+        """
+        ops = []
+        if block.db_result is not None:
+            _log.debug("Transaction update block %s", block)
+            prev_index = block.db_result.modifiedIndex
+            value = block.update_result(self.block_encoding).value
+            ops.append(TxnWrite(block.db_result.key, value,
+                                prevIndex=prev_index))
+        else:
+            _log.debug("Transaction write new block %s", block)
+            value = block.encode(self.block_encoding)
+            ops.append(TxnWrite(_block_datastore_key(block.cidr), value,
+                                prevExist=False))
+
+        for handle_id, amount in handle_amounts.iteritems():
+            key = _handle_datastore_key(handle_id)
+            try:
+                handle = self._read_handle(handle_id)
+            except KeyError:
+                handle = AllocationHandle(handle_id)
+            handle.increment_block(block.cidr, amount)
+            if handle.db_result is not None:
+                ops.append(TxnWrite(key, handle.to_json(),
+                                    prevIndex=handle.db_result.modifiedIndex))
+            else:
+                ops.append(TxnWrite(key, handle.to_json(), prevExist=False))
+
+        try:
+            results = self.etcd_client.transaction(ops)
+        except EtcdCompareFailed as e:
+            # The block or a handle has changed since it was read.
+            self._uncache_block(block.cidr)
+            for op in ops[1:]:
+                self._require_quorum(op.key)
+            node = current_node(e, _block_datastore_key(block.cidr))
+            if node is not None:
+                self._store_conflicting_block(block.cidr, node)
+            raise CASError(str(block.cidr))
+        self._block_written(block, value, results[0])
+
+    def _block_written(self, block, value, result):
+        """
+        Update the block cache and summary, and publish the block to the
+        other clients on this host, after writing a block.
+
+        :param result: The EtcdResult of the write.
+        """
+        if self.cache_blocks:
+            self._cache_block(block.cidr, value, result.modifiedIndex)
+        if self.host_coordinator is not None:
+            self.host_coordinator.publish(_block_datastore_key(block.cidr),
+                                          value, result.modifiedIndex)
+        if self.block_summaries and block.host_affinity is not None:
+            self._write_block_summary(block, result.modifiedIndex)
+
+    def _write_block_summary(self, block, generation):
+        """
+        Publish the free-space summary of a block on its host affinity key.
+
+        This is best-effort: the block has already been written, so failures
+        are logged rather than raised, and a summary may be overwritten by one
+        for an older generation of the block.
+        """
+        key = _block_host_key(block.host_affinity, block.cidr)
+        value = json.dumps({SUMMARY_FREE: block.count_free_addresses(),
+                            SUMMARY_GENERATION: generation})
+        try:
+            # Only update an existing key, so we don't recreate the affinity
+            # if it has been released.
+            self.etcd_client.write(key, value, prevExist=True)
+        except EtcdKeyNotFound:
+            _log.debug("Affinity for block %s released, no summary written",
+                       block.cidr)
+        except EtcdException as e:
+            _log.warning("Failed to write summary for block %s: %s",
+                         block.cidr, e)
 
     def _delete_block(self, block):
         """
@@ -101,14 +517,18 @@ class BlockHandleReaderWriter(DatastoreClient):
 
         Raises CASError if the block has been modified.
         """
+        self._uncache_block(block.cidr)
         try:
             self.etcd_client.delete(
                 block.db_result.key,
                 prevIndex=block.db_result.modifiedIndex)
         except EtcdCompareFailed:
             raise CASError(str(block.cidr))
+        if self.host_coordinator is not None:
+            self.host_coordinator.unpublish(block.db_result.key)
 
-    def _get_affine_blocks(self, host, version, pool):
+    def _get_affine_blocks(self, host, version, pool, summaries=None,
+                           quorum=False):
         """
         Get the blocks for which this host has affinity.
 
@@ -116,29 +536,57 @@ class BlockHandleReaderWriter(DatastoreClient):
         :param version: 4 for IPv4, 6 for IPv6.
         :param pool: Limit blocks to a specific pool, or pass None to find all
         blocks for the specified version.
+        :param summaries: (optional) Dict to fill in with the free-space
+        summary of each block that has one, as (free, generation) tuples keyed
+        by block CIDR.
+        :param quorum: (optional) Whether the affinities must be read at
+        quorum, rather than the configured read consistency.
         """
         # Construct the path
         path = IPAM_HOST_AFFINITY_PATH % {"host": host,
                                           "version": version}
-        block_ids = []
         try:
-            result = self.etcd_client.read(path, quorum=True).children
-            for child in result:
-                packed = child.key.split("/")
-                if len(packed) == 9:
-                    # block_ids are encoded 192.168.1.0/24 -> 192.168.1.0-24
-                    # in etcd.
-                    block_ids.append(IPNetwork(packed[8].replace("-", "/")))
+            children = list(self._read(path, quorum)[0].children)
         except EtcdKeyNotFound:
             # Means the path is empty.
-            pass
+            children = []
 
-        # If pool specified, filter to only include ones in the pool.
-        if pool is not None:
-            assert isinstance(pool, IPPool)
-            block_ids = [cidr for cidr in block_ids if cidr in pool]
+        return _affine_blocks_from_nodes(children, pool, summaries)
 
-        return block_ids
+    def _get_host_affine_blocks(self, host, pool):
+        """
+        Get the blocks for which this host has affinity, for both IP versions,
+        using a single recursive read.
+
+        :param host: The host ID to get affinity for.
+        :param pool: Tuple of (v4 pool, v6 pool) to limit blocks to, where
+        None finds all blocks for that version.
+        :return: Dict of (block CIDR list, summaries) tuples keyed by IP
+        version, as returned by _get_affine_blocks().
+        """
+        nodes_by_version = {4: [], 6: []}
+        try:
+            result, _ = self._read(IPAM_HOST_PATH % {"host": host},
+                                   recursive=True)
+            leaves = result.leaves
+            for leaf in leaves:
+                # The affinity keys are <host path>/ipv<version>/block/<id>.
+                packed = leaf.key.split("/")
+                if len(packed) == 9 and packed[7] == "block":
+                    nodes = nodes_by_version.get(_VERSIONS.get(packed[6]))
+                    if nodes is not None:
+                        nodes.append(leaf)
+        except EtcdKeyNotFound:
+            # Means the path is empty.
+            pass
+
+        affine_blocks = {}
+        for version, version_pool in ((4, pool[0]), (6, pool[1])):
+            summaries = {}
+            block_ids = _affine_blocks_from_nodes(nodes_by_version[version],
+                                                  version_pool, summaries)
+            affine_blocks[version] = (block_ids, summaries)
+        return affine_blocks
 
     def _get_host_block_pairs(self, pool):
         """
@@ -185,16 +633,22 @@ class BlockHandleReaderWriter(DatastoreClient):
         # Walk the affine blocks in a somewhat random way but seed the RNG
         # from our hostname so that multiple concurrent invocations on the
         # same host will try to claim the same blocks.
-        for block_cidr in self._random_blocks(version=version,
-                                              pool=pool,
-                                              seed=host):
-            block_id = str(block_cidr)
-            _log.debug("Checking if block %s is free.", block_id)
-            key = _block_datastore_key(block_cidr)
-            try:
-                _ = self.etcd_client.read(key, quorum=True)
-            except EtcdKeyNotFound:
-                _log.debug("Found block %s free.", block_id)
+        probes = 0
+        try:
+            for block_cidr in self._random_blocks(version=version,
+                                                  pool=pool,
+                                                  seed=host,
+                                                  ipam_config=ipam_config):
+                if probes == 0:
+                    # List the existing blocks once, rather than reading each
+                    # candidate block in turn.  The listing may be out of
+                    # date by the time we claim a block, but the claim only
+                    # succeeds if the block doesn't exist.
+                    existing_ids = self._get_block_ids(version)
+                probes += 1
+                if _block_id(block_cidr) in existing_ids:
+                    continue
+                _log.debug("Found block %s free.", block_cidr)
                 try:
                     self._claim_block_affinity(host, block_cidr,
                                                ipam_config)
@@ -205,8 +659,30 @@ class BlockHandleReaderWriter(DatastoreClient):
                     continue
                 # Success!
                 return block_cidr
+        finally:
+            _log.debug("Checked %d blocks for a free block", probes)
+            self.new_block_probes += probes
         raise NoFreeBlocksError()
 
+    def _get_block_ids(self, version):
+        """
+        Get the IDs of all the existing blocks, using a single recursive read.
+
+        :param version: 4 for IPv4, 6 for IPv6.
+        :return: Set of block IDs, as used in the block keys.
+        """
+        blocks_path = IPAM_BLOCK_PATH % {"version": version}
+        try:
+            result, _ = self._read(blocks_path, recursive=True)
+            leaves = result.leaves
+        except EtcdKeyNotFound:
+            # Path doesn't exist.
+            return set()
+
+        # When there are no blocks, the recursive read returns the parent
+        # directory, which doesn't match any block ID.
+        return set(leaf.key.rsplit("/", 1)[-1] for leaf in leaves)
+
     def _claim_block_affinity(self, host, block_cidr, ipam_config):
         """
         Claim a block we think is free.
@@ -260,9 +736,14 @@ class BlockHandleReaderWriter(DatastoreClient):
         different host.
         Raises KeyError if the block does not exist.
         """
-        for _ in xrange(RETRIES):
+        block_key = _block_datastore_key(block_cidr)
+        for _ in self.retry_policy.attempts(block_key):
             block = self._read_block(block_cidr)
             if block.host_affinity != host:
+                if block.from_cache:
+                    # Confirm against the datastore before failing.
+                    self._uncache_block(block_cidr)
+                    continue
                 _log.info("Block host affinity is %s (expected %s) - not "
                           "releasing", block.host_affinity, host)
                 raise HostAffinityClaimedError(
@@ -298,14 +779,18 @@ class BlockHandleReaderWriter(DatastoreClient):
 
         raise RuntimeError("Max retries hit.")  # pragma: no cover
 
-    def _random_blocks(self, version, pool=None, excluded_ids=None, seed=None):
+    def _random_blocks(self, version, pool=None, excluded_ids=None, seed=None,
+                       ipam_config=None):
         """
-        Generate block CIDRs, in pseudo-random order.
+        Generate block CIDRs, in pseudo-random order.  Each pool is split into
+        blocks of the pool's block size.
 
         :param version: The IP version 4, or 6.
         :param pool: IPPool to get blocks from, or None to use all pools
         :param excluded_ids: Set of IDs that should be excluded or None.
         :param seed: Seed for the RNG, or None to have the RNG self-seed.
+        :param ipam_config: The global IPAM configuration, or None to query it
+        if a pool uses the default block size.
         :raises PoolNotFound if pool is set to a non-existent pool.
         :return: An iterator of block CIDRs.
         """
@@ -318,9 +803,18 @@ class BlockHandleReaderWriter(DatastoreClient):
                                    "wrong attributes" % pool)
             # Confine search to only the one pool.
             ip_pools = [pool]
-        cidrs = [p.cidr for p in ip_pools]
+        cidrs = []
+        prefixlens = []
+        for ip_pool in ip_pools:
+            block_size_bits = ip_pool.block_size_bits
+            if block_size_bits is None:
+                if ipam_config is None:
+                    ipam_config = self.get_ipam_config()
+                block_size_bits = ipam_config.block_size_bits
+            cidrs.append(ip_pool.cidr)
+            prefixlens.append(BITS_BY_VERSION[version] - block_size_bits)
         for block_cidr in _random_subnets_from_cidrs(cidrs,
-                                                     BLOCK_PREFIXLEN[version],
+                                                     prefixlens,
                                                      seed=seed):
             if block_cidr not in excluded_ids:
                 yield block_cidr
@@ -330,14 +824,56 @@ class BlockHandleReaderWriter(DatastoreClient):
         Increment the allocation count on the given handle for the given block
         by the given amount.
         """
-        for _ in xrange(RETRIES):
+        self._update_handle_blocks(handle_id, {block_cidr: amount})
+
+    def _decrement_handle(self, handle_id, block_cidr, amount):
+        """
+        Decrement the allocation count on the given handle for the given block
+        by the given amount.
+        """
+        self._update_handle_blocks(handle_id, {block_cidr: -amount})
+
+    def _update_handle_blocks(self, handle_id, deltas):
+        """
+        Update the allocation counts on the given handle for several blocks,
+        with a single compare-and-swap.
+
+        The handle is created if it doesn't exist and all the counts are
+        being incremented.
+
+        :param handle_id: The handle ID.
+        :param deltas: Dict of the amount to change the count by, keyed by
+        block CIDR.  Negative amounts decrement the count.
+        """
+        decrementing = any(delta < 0 for delta in deltas.itervalues())
+        handle_key = _handle_datastore_key(handle_id)
+        for _ in self.retry_policy.attempts(handle_key):
             try:
                 handle = self._read_handle(handle_id)
             except KeyError:
+                if decrementing:
+                    # This is bad.  The handle doesn't exist, which means
+                    # something really wrong has happened, like DB corruption.
+                    _log.error("Can't decrement blocks %s on handle %s; it "
+                               "doesn't exist.", [str(b) for b in deltas],
+                               handle_id)
+                    raise
                 # handle doesn't exist.  Create it.
                 handle = AllocationHandle(handle_id)
 
-            _ = handle.increment_block(block_cidr, amount)
+            for block_cidr, delta in deltas.iteritems():
+                if delta >= 0:
+                    handle.increment_block(block_cidr, delta)
+                    continue
+                try:
+                    handle.decrement_block(block_cidr, -delta)
+                except AddressCountTooLow:
+                    # This is also bad.  The handle says it has fewer than the
+                    # requested amount of addresses allocated on the block.
+                    # This means the DB is corrupted.
+                    _log.error("Can't decrement block %s on handle %s; too "
+                               "few allocated.", str(block_cidr), handle_id)
+                    raise
 
             try:
                 self._compare_and_swap_handle(handle)
@@ -345,53 +881,47 @@ class BlockHandleReaderWriter(DatastoreClient):
                 # CAS failed.  Retry.
                 continue
             else:
-                # success!
+                # Success!
                 return
         raise RuntimeError("Max retries hit.")  # pragma: no cover
 
-    def _decrement_handle(self, handle_id, block_cidr, amount):
+    def _commit_handle_updates(self, updates, parallelism=1):
         """
-        Decrement the allocation count on the given handle for the given block
-        by the given amount.
+        Commit the changes recorded in a handle update accumulator, with a
+        single compare-and-swap for each handle.
+
+        :param updates: The _HandleUpdates accumulator.
+        :param parallelism: (optional) The maximum number of handles to update
+        concurrently.
+        :return: List of the exceptions raised updating handles.  A failure
+        updating one handle doesn't stop the others being updated.
         """
-        for _ in xrange(RETRIES):
-            try:
-                handle = self._read_handle(handle_id)
-            except KeyError:
-                # This is bad.  The handle doesn't exist, which means something
-                # really wrong has happened, like DB corruption.
-                _log.error("Can't decrement block %s on handle %s; it doesn't "
-                           "exist.", str(block_cidr), handle_id)
-                raise
+        deltas_by_handle = updates.deltas()
 
-            try:
-                handle.decrement_block(block_cidr, amount)
-            except AddressCountTooLow:
-                # This is also bad.  The handle says it has fewer than the
-                # requested amount of addresses allocated on the block.  This
-                # means the DB is corrupted.
-                _log.error("Can't decrement block %s on handle %s; too few "
-                           "allocated.", str(block_cidr), handle_id)
-                raise
+        def update_handle(handle_id):
+            self._update_handle_blocks(handle_id, deltas_by_handle[handle_id])
 
-            try:
-                self._compare_and_swap_handle(handle)
-            except CASError:
-                continue
-            else:
-                # Success!
-                return
-        raise RuntimeError("Max retries hit.")  # pragma: no cover
+        handle_ids = deltas_by_handle.keys()
+        results = _call_concurrently(update_handle, handle_ids, parallelism)
+        errors = []
+        for handle_id, (_, error) in zip(handle_ids, results):
+            if error is not None:
+                _log.error("Failed to update handle %s: %r", handle_id, error)
+                errors.append(error)
+        return errors
 
-    def _read_handle(self, handle_id):
+    def _read_handle(self, handle_id, quorum=False):
         """
         Read the handle with the given handle ID from the data store.
         :param handle_id: The handle ID to read.
+        :param quorum: (optional) Whether the handle must be read at quorum,
+        rather than the configured read consistency, because no
+        compare-and-swap on it will confirm it.
         :return: AllocationHandle object.
         """
         key = _handle_datastore_key(handle_id)
         try:
-            result = self.etcd_client.read(key, quorum=True)
+            result, _ = self._read(key, quorum)
         except EtcdKeyNotFound:
             raise KeyError(handle_id)
         handle = AllocationHandle.from_etcd_result(result)
@@ -413,12 +943,15 @@ class BlockHandleReaderWriter(DatastoreClient):
                         key,
                         prevIndex=handle.db_result.modifiedIndex)
                 except EtcdCompareFailed:
+                    self._require_quorum(key)
                     raise CASError(handle.handle_id)
             else:
                 _log.debug("Handle %s is not empty.", handle.handle_id)
                 try:
                     self.etcd_client.update(handle.update_result())
                 except EtcdCompareFailed:
+                    self._require_quorum(
+                                _handle_datastore_key(handle.handle_id))
                     raise CASError(handle.handle_id)
         else:
             _log.debug("CAS Write new handle %s", handle.handle_id)
@@ -428,8 +961,72 @@ class BlockHandleReaderWriter(DatastoreClient):
             try:
                 self.etcd_client.write(key, value, prevExist=False)
             except EtcdAlreadyExist:
+                self._require_quorum(key)
                 raise CASError(handle.handle_id)
 
+    def _store_attributes(self, attributes):
+        """
+        Write assignment attributes to the attribute store, if enabled.
+
+        :param attributes: The assignment attributes.
+        :return: The attributes to store in the block.  This is a reference to
+        the attributes in the store, or the attributes themselves if the
+        store is not enabled or there are no attributes.
+        """
+        if not (self.dedup_attributes and attributes):
+            return attributes
+
+        value = json.dumps(attributes, sort_keys=True, separators=(",", ":"))
+        digest = hashlib.sha256(value).hexdigest()
+        if digest not in self._attributes_cache:
+            try:
+                self.etcd_client.write(_attributes_datastore_key(digest),
+                                       value, prevExist=False)
+            except EtcdAlreadyExist:
+                # Content addressed, so the existing value is the same.
+                _log.debug("Attributes %s already stored", digest)
+            self._cache_attributes(digest, value)
+        return {ATTRIBUTES_REF: digest}
+
+    def _resolve_attributes(self, attributes):
+        """
+        Resolve assignment attributes read from a block, reading them from
+        the attribute store if the block holds a reference.
+
+        :param attributes: The attributes from the block.
+        :return: The assignment attributes.
+        """
+        if not _is_attributes_ref(attributes):
+            return attributes
+
+        digest = attributes[ATTRIBUTES_REF]
+        value = self._attributes_cache.get(digest)
+        if value is None:
+            try:
+                # The store is content addressed, so the attributes are
+                # either current or missing, and a stale read that misses
+                # them is repeated at quorum.
+                result, _ = self._read(_attributes_datastore_key(digest))
+            except EtcdKeyNotFound:
+                # This is bad.  A block references attributes that don't
+                # exist, which means the DB is corrupted.
+                _log.error("Can't resolve attributes %s; they don't exist.",
+                           digest)
+                raise KeyError(digest)
+            value = result.value
+            self._cache_attributes(digest, value)
+
+        # Parse on every call so callers can't modify the cached copy.
+        return json.loads(value)
+
+    def _cache_attributes(self, digest, value):
+        """
+        Add attributes to the attribute cache, clearing it if full.
+        """
+        if len(self._attributes_cache) >= ATTRIBUTES_CACHE_SIZE:
+            self._attributes_cache.clear()
+        self._attributes_cache[digest] = value
+
     def _read_blocks(self):
         """
         Read all the allocated blocks.
@@ -451,25 +1048,95 @@ class BlockHandleReaderWriter(DatastoreClient):
                 # Convert the leaf values to AllocationBlocks.  We need to
                 # handle an empty leaf value because when no pools are
                 # configured the recursive read returns the parent directory.
-                blocks[version] = [AllocationBlock.from_etcd_result(leaf) for leaf in leaves
-                                                                          if leaf.value]
+                blocks[version] = [
+                    AllocationBlock.from_etcd_result(
+                                            leaf,
+                                            validation=self.block_validation,
+                                            lazy=True)
+                    for leaf in leaves if leaf.value]
         return blocks[4], blocks[6]
 
-    @handle_errors
-    def get_ipam_config(self):
+    def _get_ipam_pools(self, version, refresh=False):
         """
-        Return the deployment specific IPAM configuration.
+        Get the Calico IPAM pools of an IP version, as cached by this client.
 
-        :param host: The host ID of the config to return.
-        :return: An IPAMConfig object.
+        The block size of a pool can't change while the pool has blocks, so a
+        block found using the cached pools is always the right block.  If a
+        block isn't found, the pools may have changed since, so refresh them.
+        Refreshing the pools also discards the cached IPAM configuration.
+
+        :param version: 4 for IPv4, 6 for IPv6.
+        :param refresh: Whether to read the pools again rather than use the
+        cached pools.
+        :return: List of (first, last, block_size_bits, disabled) tuples, one
+        for each pool, where first and last are the pool's integer range.
         """
-        try:
-            result = self.etcd_client.read(IPAM_CONFIG_PATH)
-        except EtcdKeyNotFound:
-            _log.debug("No IPAM Config stored - return default")
-            return IPAMConfig()
+        pools = None if refresh else self._ipam_pools.get(version)
+        if pools is None:
+            pools = [(pool.cidr.first, pool.cidr.last, pool.block_size_bits,
+                      pool.disabled)
+                     for pool in self.get_ip_pools(version, ipam=True,
+                                                   include_disabled=True)]
+            self._ipam_pools[version] = pools
+            if refresh:
+                self._ipam_config = None
+        return pools
+
+    def _uncache_ipam_pools(self):
+        """
+        Discard the cached pools and IPAM configuration, so that they are
+        read again when next needed.
+        """
+        self._ipam_pools.clear()
+        self._ipam_config = None
+
+    def _get_cached_ipam_config(self):
+        """
+        :return: The IPAMConfig cached by this client, read when first needed
+        and again after the pools are refreshed.
+        """
+        ipam_config = self._ipam_config
+        if ipam_config is None:
+            ipam_config = self._ipam_config = self.get_ipam_config()
+        return ipam_config
+
+    def _get_pool_block_size_bits(self, cidr, refresh=False):
+        """
+        Get the block size configured on the IP pool containing the given
+        address or CIDR.
+
+        :param cidr: IPAddress or IPNetwork to look up.
+        :param refresh: Whether to read the pools again rather than use the
+        cached pools.
+        :return: The block size as the number of host bits, or None if the
+        pool uses the default block size or no pool contains cidr.
+        """
+        if isinstance(cidr, IPNetwork):
+            first, last = cidr.first, cidr.last
         else:
-            return IPAMConfig.from_json(result.value)
+            first = last = int(cidr)
+        for pool_first, pool_last, block_size_bits, _ in \
+                self._get_ipam_pools(cidr.version, refresh):
+            if pool_first <= first and last <= pool_last:
+                return block_size_bits
+        return None
+
+    def _get_block_size_bits(self, cidr, refresh=False):
+        """
+        Get the block size to use for the given address or CIDR.  This is the
+        block size of the containing IP pool if it has one, otherwise the
+        default block size from the IPAM configuration, which is only read if
+        it is needed.
+
+        :param cidr: IPAddress or IPNetwork to look up.
+        :param refresh: Whether to read the pools again rather than use the
+        cached pools.
+        :return: The block size as the number of host bits.
+        """
+        block_size_bits = self._get_pool_block_size_bits(cidr, refresh)
+        if block_size_bits is None:
+            block_size_bits = self._get_cached_ipam_config().block_size_bits
+        return block_size_bits
 
     @handle_errors
     def set_ipam_config(self, config):
@@ -506,6 +1173,48 @@ class BlockHandleReaderWriter(DatastoreClient):
         self.etcd_client.write(IPAM_CONFIG_PATH, config.to_json())
 
 
+class _HandleUpdates(object):
+    """
+    Accumulates changes to the allocation counts of handles during an
+    operation, so that each handle can be written once at the end of it.
+
+    Changes should only be recorded once it is safe to write them: handles
+    are incremented before the blocks are written, and decremented after.
+    """
+
+    def __init__(self):
+        self._deltas = {}
+        self._lock = threading.Lock()
+
+    def add(self, handle_id, block_cidr, delta):
+        """
+        Record a change to the allocation count of a handle for a block.
+
+        :param handle_id: The handle ID.
+        :param block_cidr: The block CIDR.
+        :param delta: The amount to change the count by.  Negative amounts
+        decrement the count.
+        """
+        with self._lock:
+            deltas = self._deltas.setdefault(handle_id, {})
+            total = deltas.get(block_cidr, 0) + delta
+            if total:
+                deltas[block_cidr] = total
+            else:
+                del deltas[block_cidr]
+                if not deltas:
+                    del self._deltas[handle_id]
+
+    def deltas(self):
+        """
+        :return: Dict of the recorded changes, as dicts of the amount to
+        change the count by keyed by block CIDR, keyed by handle ID.
+        """
+        with self._lock:
+            return dict((handle_id, dict(deltas))
+                        for handle_id, deltas in self._deltas.iteritems())
+
+
 class CASError(DataStoreError):
     """
     Compare-and-swap atomic update failed.
@@ -536,6 +1245,33 @@ class IPAMConfigConflictError(DataStoreError):
     pass
 
 
+_block_ids = {}
+"""
+Memoized block IDs, keyed by the integer (version, value, prefixlen) of the
+block CIDR.  The same blocks are formatted into keys on every read and write,
+so this avoids repeatedly formatting the CIDR as a string.
+"""
+
+BLOCK_ID_CACHE_SIZE = 65536
+
+
+def _block_id(block_cidr):
+    """
+    Get the ID of a block as used in datastore keys, e.g. 10.11.12.0-26.
+    :param block_cidr: IPNetwork representing the block
+    :return: The block ID as a string.
+    """
+    cache_key = (block_cidr.version, block_cidr.value, block_cidr.prefixlen)
+    try:
+        return _block_ids[cache_key]
+    except KeyError:
+        if len(_block_ids) >= BLOCK_ID_CACHE_SIZE:
+            _block_ids.clear()
+        block_id = str(block_cidr).replace("/", "-")
+        _block_ids[cache_key] = block_id
+        return block_id
+
+
 def _block_datastore_key(block_cidr):
     """
     Translate a block CIDR into a datastore key.
@@ -543,7 +1279,7 @@ def _block_datastore_key(block_cidr):
     :return: etcd key as a string.
     """
     path = IPAM_BLOCK_PATH % {'version': block_cidr.version}
-    return path + str(block_cidr).replace("/", "-")
+    return path + _block_id(block_cidr)
 
 
 def _block_host_key(host, block_cidr):
@@ -555,10 +1291,112 @@ def _block_host_key(host, block_cidr):
     :param block_cidr: IPNetwork representing the block
     :return: etcd key as a string.
     """
-    block_id = str(block_cidr)
     path = IPAM_HOST_AFFINITY_PATH % {"host": host,
                                       "version": block_cidr.version}
-    return path + block_id.replace("/", "-")
+    return path + _block_id(block_cidr)
+
+
+_VERSIONS = {"ipv4": 4, "ipv6": 6}
+"""
+IP versions keyed by the name used for them in the host affinity path.
+"""
+
+
+def _affine_blocks_from_nodes(nodes, pool, summaries=None):
+    """
+    Get the block CIDRs from a list of host affinity key nodes.
+
+    :param nodes: The host affinity key nodes.
+    :param pool: Limit blocks to a specific pool, or None for all blocks.
+    :param summaries: (optional) Dict to fill in with the free-space summary
+    of each block that has one, keyed by block CIDR.
+    :return: List of block CIDRs.
+    """
+    if pool is not None:
+        assert isinstance(pool, IPPool)
+    block_ids = []
+    for node in nodes:
+        packed = node.key.split("/")
+        if len(packed) != 9:
+            continue
+        # block_ids are encoded 192.168.1.0/24 -> 192.168.1.0-24 in etcd.
+        block_id = IPNetwork(packed[8].replace("-", "/"))
+        if pool is not None and block_id not in pool:
+            continue
+        block_ids.append(block_id)
+        if summaries is not None:
+            summary = _parse_block_summary(node.value)
+            if summary is not None:
+                summaries[block_id] = summary
+    return block_ids
+
+
+def _parse_block_summary(value):
+    """
+    Parse the free-space summary stored on a host affinity key.
+
+    :param value: The value of the host affinity key.
+    :return: A (free, generation) tuple, or None if the key has no valid
+    summary (for example, one written by a client that doesn't publish them).
+    """
+    if not value:
+        return None
+    try:
+        summary = json.loads(value)
+        return int(summary[SUMMARY_FREE]), int(summary[SUMMARY_GENERATION])
+    except (ValueError, TypeError, KeyError):
+        _log.warning("Ignoring invalid block summary %r", value)
+        return None
+
+
+def _order_blocks_by_free(blocks, summaries):
+    """
+    Order blocks for allocation using their free-space summaries.
+
+    Blocks with a summary come first, emptiest first, followed by blocks
+    without one, followed by blocks summarised as full.  Blocks that compare
+    equal keep their original order.
+
+    :param blocks: List of block CIDRs.
+    :param summaries: Free-space summaries, as (free, generation) tuples keyed
+    by block CIDR.
+    :return: New list of the block CIDRs.
+    """
+    def free_order(block_id):
+        summary = summaries.get(block_id)
+        if summary is None:
+            return 1, 0
+        free = summary[0]
+        return (0, -free) if free > 0 else (2, 0)
+    return sorted(blocks, key=free_order)
+
+
+def _attributes_datastore_key(digest):
+    """
+    Translate an attributes digest into a datastore key.
+    :param digest: The SHA-256 digest of the attributes, as a hex string.
+    :return: etcd key as string.
+    """
+    return IPAM_ATTRIBUTES_PATH + digest
+
+
+def _is_attributes_ref(attributes):
+    """
+    Check whether assignment attributes are a reference to the attribute
+    store.
+    """
+    return (isinstance(attributes, dict) and
+            len(attributes) == 1 and
+            isinstance(attributes.get(ATTRIBUTES_REF), basestring))
+
+
+def _check_attributes(attributes):
+    """
+    Check assignment attributes can be stored.
+
+    :raises TypeError, ValueError: The attributes are not JSON serializable.
+    """
+    json.dumps(attributes)
 
 
 def _handle_datastore_key(handle_id):
@@ -570,8 +1408,127 @@ def _handle_datastore_key(handle_id):
     return IPAM_HANDLE_PATH + handle_id
 
 
+class _NoLock(object):
+    """
+    Context manager used in place of the host coordinator's leases when
+    there is no host coordinator.
+    """
+
+    def __enter__(self):
+        return True
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_LOCK = _NoLock()
+
+
+class _BackgroundCall(object):
+    """
+    Calls a function in a background thread.
+    """
+
+    def __init__(self, fn, *args):
+        self.result = None
+        self.error = None
+        self._thread = threading.Thread(target=self._run,
+                                        args=(bind_operations(fn),) + args)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, fn, *args):
+        try:
+            self.result = fn(*args)
+        except Exception as e:
+            _log.debug("Background call failed", exc_info=True)
+            self.error = e
+
+    def join(self):
+        """
+        Wait for the call to finish.  Its return value or exception is then
+        available as the result or error attribute.
+        """
+        self._thread.join()
+
+
+class _AssignGroup(object):
+    """
+    Auto-assign requests that are committed together by group commit.
+    """
+
+    def __init__(self):
+        self.requests = []
+        """
+        The requests, as (handle_id, attributes, num_v4, num_v6) tuples.
+        """
+
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchAssignment(object):
+    """
+    The outcome of one request passed to auto_assign_ips_batch().
+
+    Unpacks as a (v4_address_list, v6_address_list) tuple.
+    """
+
+    def __init__(self, num_v4, num_v6, error=None):
+        self.num_v4 = num_v4
+        self.num_v6 = num_v6
+        self.v4_addresses = []
+        self.v6_addresses = []
+        self.error = error
+        """
+        The exception that failed the request, such as a TypeError for
+        attributes that are not JSON serializable, or None.  A failed request
+        isn't assigned any addresses.
+        """
+
+    @property
+    def shortfall(self):
+        """
+        A tuple of the numbers of IPv4 and IPv6 addresses requested but not
+        assigned, because the configured pools are at or near exhaustion.
+        """
+        if self.error is not None:
+            return 0, 0
+        return (self.num_v4 - len(self.v4_addresses),
+                self.num_v6 - len(self.v6_addresses))
+
+    def __iter__(self):
+        return iter((self.v4_addresses, self.v6_addresses))
+
+    def __repr__(self):
+        return "BatchAssignment(%s, %s, error=%r)" % (
+            [str(a) for a in self.v4_addresses],
+            [str(a) for a in self.v6_addresses], self.error)
+
+
 class IPAMClient(BlockHandleReaderWriter):
 
+    def __init__(self, group_commit_window=None, **kwargs):
+        """
+        :param group_commit_window: (optional) If set, calls to
+        auto_assign_ips() for the same host and pools that arrive within this
+        many seconds of each other are assigned together, with a single
+        compare-and-swap per block, rather than contending for the same
+        blocks.  Each call waits for up to the window before being assigned.
+        Only useful when the client is shared by several threads.
+        :param kwargs: Passed to BlockHandleReaderWriter.
+        """
+        super(IPAMClient, self).__init__(**kwargs)
+        self.group_commit_window = group_commit_window
+
+        self._groups = {}
+        """
+        The _AssignGroup collecting requests, keyed by (host, pool).
+        """
+
+        self._groups_lock = threading.Lock()
+
     @handle_errors
     def auto_assign_ips(self, num_v4, num_v6, handle_id, attributes,
                         pool=(None, None), host=None):
@@ -598,21 +1555,205 @@ class IPAMClient(BlockHandleReaderWriter):
         assert isinstance(handle_id, str) or handle_id is None
 
         host = host or get_hostname()
+        if self.group_commit_window is not None:
+            return self._auto_assign_grouped(num_v4, num_v6, handle_id,
+                                             attributes, pool, host)
+        attributes = self._store_attributes(attributes)
 
         _log.info("Auto-assign %d IPv4, %d IPv6 addrs",
                   num_v4, num_v6)
-        v4_address_list = self._auto_assign(4, num_v4, handle_id, attributes,
-                                            pool[0], host)
+        if num_v4 > 0 and num_v6 > 0:
+            with self._host_lock(host, 4, 6):
+                return self._auto_assign_dual(num_v4, num_v6, handle_id,
+                                              attributes, pool, host)
+        # Only take the lease for a version that is being assigned, so
+        # assignments of one version don't wait behind the other.
+        with self._host_lock(host, 4) if num_v4 > 0 else _NO_LOCK:
+            v4_address_list = self._auto_assign(4, num_v4, handle_id,
+                                                attributes, pool[0], host)
         _log.info("Auto-assigned IPv4s %s",
                   [str(addr) for addr in v4_address_list])
-        v6_address_list = self._auto_assign(6, num_v6, handle_id, attributes,
-                                            pool[1], host)
+        with self._host_lock(host, 6) if num_v6 > 0 else _NO_LOCK:
+            v6_address_list = self._auto_assign(6, num_v6, handle_id,
+                                                attributes, pool[1], host)
         _log.info("Auto-assigned IPv6s %s",
                   [str(addr) for addr in v6_address_list])
         return v4_address_list, v6_address_list
 
+    def _auto_assign_dual(self, num_v4, num_v6, handle_id, attributes, pool,
+                          host):
+        """
+        Auto assign IPv4 and IPv6 addresses concurrently.
+
+        The IPv6 addresses are assigned in a background thread while the
+        IPv4 addresses are assigned in this one.  The two versions use
+        disjoint blocks, handles are updated by compare-and-swap, and the
+        affine blocks for both are read up front.
+
+        If either version fails, its exception is raised once the other has
+        finished.  Any addresses assigned for the other version are logged,
+        and can be released using the handle.
+
+        :return: A tuple of (v4_address_list, v6_address_list).
+        """
+        affine_blocks = self._get_host_affine_blocks(host, pool)
+        v6_call = _BackgroundCall(self._auto_assign, 6, num_v6, handle_id,
+                                  attributes, pool[1], host, affine_blocks[6])
+        v4_address_list = None
+        try:
+            v4_address_list = self._auto_assign(4, num_v4, handle_id,
+                                                attributes, pool[0], host,
+                                                affine_blocks[4])
+            _log.info("Auto-assigned IPv4s %s",
+                      [str(addr) for addr in v4_address_list])
+        finally:
+            # Don't return, or raise, until the IPv6 assignment is done.
+            v6_call.join()
+            if v4_address_list is None:
+                if v6_call.error is not None:
+                    _log.error("IPv6 auto-assign also failed: %s",
+                               v6_call.error)
+                else:
+                    _log.warning("IPv4 auto-assign failed after assigning "
+                                 "IPv6s %s",
+                                 [str(addr) for addr in v6_call.result])
+
+        if v6_call.error is not None:
+            _log.warning("IPv6 auto-assign failed after assigning IPv4s %s",
+                         [str(addr) for addr in v4_address_list])
+            raise v6_call.error
+        v6_address_list = v6_call.result
+        _log.info("Auto-assigned IPv6s %s",
+                  [str(addr) for addr in v6_address_list])
+        return v4_address_list, v6_address_list
+
+    def _auto_assign_grouped(self, num_v4, num_v6, handle_id, attributes,
+                             pool, host):
+        """
+        Auto assign addresses together with any other requests for the same
+        host and pools that arrive within the group commit window.
+
+        The first request to arrive leads the group: it waits for the window
+        to pass, assigns addresses for the whole group using
+        auto_assign_ips_batch(), and passes each request's result (or its
+        error, or the error that failed the whole group) back to it.
+
+        :return: A tuple of (v4_address_list, v6_address_list), as for
+        auto_assign_ips().
+        """
+        # Check the request before it joins the group, so that invalid input
+        # only fails this caller.
+        _check_attributes(attributes)
+
+        # Pools are compared by CIDR, as equal pools may be different objects.
+        key = (host, tuple(str(p.cidr) if p is not None else None
+                           for p in pool))
+        with self._groups_lock:
+            group = self._groups.get(key)
+            leader = group is None
+            if leader:
+                group = _AssignGroup()
+                self._groups[key] = group
+            index = len(group.requests)
+            group.requests.append((handle_id, attributes, num_v4, num_v6))
+
+        if leader:
+            try:
+                time.sleep(self.group_commit_window)
+                with self._groups_lock:
+                    # Later requests start a new group.
+                    del self._groups[key]
+                _log.debug("Group commit of %d requests", len(group.requests))
+                group.results = self.auto_assign_ips_batch(group.requests,
+                                                           pool=pool,
+                                                           host=host)
+            except Exception as e:
+                group.error = e
+            finally:
+                group.done.set()
+        else:
+            group.done.wait()
+
+        if group.error is not None:
+            raise group.error
+        result = group.results[index]
+        if result.error is not None:
+            raise result.error
+        return tuple(result)
+
+    @handle_errors
+    def auto_assign_ips_batch(self, requests, pool=(None, None), host=None):
+        """
+        Automatically pick and assign addresses for several requests at once.
+
+        This is equivalent to calling auto_assign_ips() for each request in
+        turn, except that all the requests share each block read, and each
+        block is written with a single compare-and-swap.  Each handle is
+        written once for each block it is assigned addresses in.
+
+        :param requests: List of (handle_id, attributes, num_v4, num_v6)
+        tuples, with the same meanings as the parameters of auto_assign_ips().
+        :param pool: (optional) Tuple of (v4 pool, v6 pool); if supplied, the
+        pool(s) to assign from,  If None, automatically choose a pool.
+        :param host: (optional) The host ID to use for affinity in assigning IP
+        addresses.  Defaults to the hostname returned by get_hostname().
+        :return: A list of BatchAssignment, one for each request in order.  A
+        request with invalid input, such as attributes that are not JSON
+        serializable, fails on its own, with the exception as its error.
+        When IPs in configured pools are at or near exhaustion, requests are
+        satisfied in order, so later requests may be given fewer than the
+        requested number of addresses, or none; the shortfall of each is
+        given.  Other errors, such as failing to reach the datastore, fail
+        the whole batch.
+        """
+        host = host or get_hostname()
+        results = []
+        batch = []
+        for i, (handle_id, attributes, num_v4, num_v6) in enumerate(requests):
+            result = BatchAssignment(num_v4, num_v6)
+            results.append(result)
+            try:
+                if not (isinstance(handle_id, str) or handle_id is None):
+                    raise TypeError("Handle ID %r is not a string" %
+                                    (handle_id,))
+                _check_attributes(attributes)
+                attributes = self._store_attributes(attributes)
+            except Exception as e:
+                _log.warning("Request %d for handle %s failed: %r", i,
+                             handle_id, e)
+                result.error = e
+                continue
+            batch.append((i, handle_id, attributes, num_v4, num_v6))
+
+        _log.info("Auto-assign %d IPv4, %d IPv6 addrs for %d requests",
+                  sum(r[3] for r in batch), sum(r[4] for r in batch),
+                  len(batch))
+        for ip_version, index, version_pool in ((4, 0, pool[0]),
+                                                (6, 1, pool[1])):
+            # Requests for this version, as (request index, handle_id,
+            # attributes, num) tuples.
+            wanted = [(r[0], r[1], r[2], r[3 + index])
+                      for r in batch if r[3 + index] > 0]
+            if not wanted:
+                continue
+            with self._host_lock(host, ip_version):
+                allocated = self._auto_assign_batch(ip_version, wanted,
+                                                    version_pool, host)
+            for i, ips in allocated.iteritems():
+                if index == 0:
+                    results[i].v4_addresses.extend(ips)
+                else:
+                    results[i].v6_addresses.extend(ips)
+        for i, handle_id, _, num_v4, num_v6 in batch:
+            if results[i].shortfall != (0, 0):
+                _log.warning("Assigned %d of %d IPv4, %d of %d IPv6 addrs for "
+                             "handle %s", len(results[i].v4_addresses),
+                             num_v4, len(results[i].v6_addresses), num_v6,
+                             handle_id)
+        return results
+
     def _auto_assign(self, ip_version, num, handle_id,
-                     attributes, pool, host):
+                     attributes, pool, host, affine_blocks=None):
         """
         Auto assign addresses from a specific IP version.
 
@@ -633,6 +1774,9 @@ class IPAMClient(BlockHandleReaderWriter):
         :param pool: (optional) if supplied, the pool to assign from,  If None,
         automatically choose a pool.
         :param host: The host ID to use for affinity in assigning IP addresses.
+        :param affine_blocks: (optional) The host-affine blocks and their
+        summaries, as returned by _get_host_affine_blocks().  If None, they
+        are read from the datastore.
         :return:
         """
         assert isinstance(handle_id, str) or handle_id is None
@@ -641,14 +1785,20 @@ class IPAMClient(BlockHandleReaderWriter):
         # globally we have strict_affinity or not.
         _log.info("Looking for %s IPs in already-allocated affine blocks.",
                   num)
-        host_blocks = self._get_affine_blocks(host, ip_version, pool)
+        if affine_blocks is None:
+            summaries = {}
+            host_blocks = self._get_affine_blocks(host, ip_version, pool,
+                                                  summaries=summaries)
+        else:
+            host_blocks, summaries = affine_blocks
         num_remaining = num
         allocated_ips = self._allocate_ips_explicit_blocks(
             host_blocks,
             num_remaining,
             attributes,
             handle_id,
-            host
+            host,
+            summaries=summaries
         )
         num_remaining = num - len(allocated_ips)
         if len(allocated_ips) < num:
@@ -689,16 +1839,21 @@ class IPAMClient(BlockHandleReaderWriter):
                         host,
                         ip_version,
                         pool,
-                        excluded_blocks=set(host_blocks)
+                        excluded_blocks=set(host_blocks),
+                        ipam_config=ipam_config
                     )
                     allocated_ips.extend(ips_from_random_blocks)
         _log.info("Allocated %s of %s requested IPs", len(allocated_ips), num)
         return allocated_ips
 
     def _allocate_ips_explicit_blocks(self, blocks, num, attributes, handle_id,
-                                      host):
+                                      host, summaries=None):
         """Tries to allocate IPs from the explicitly-listed blocks.
 
+        Blocks with a free-space summary are tried emptiest first, followed by
+        blocks without one.  Blocks summarised as full are only tried once all
+        the others are exhausted, since the summary may be out of date.
+
         :param list blocks: Blocks to allocate from (for example, the affine
         blocks for a host).
         :param num: Number to try to allocate.
@@ -707,8 +1862,13 @@ class IPAMClient(BlockHandleReaderWriter):
         be JSON serializable.
         :param handle_id: Handle ID to associate with the allocations.
         :param host: The host ID to use for affinity in assigning IP addresses.
+        :param summaries: (optional) Free-space summaries of the blocks, as
+        returned by _get_affine_blocks().
         :return: list of allocated IPs or an empty list if none were available.
         """
+        if summaries:
+            blocks = _order_blocks_by_free(blocks, summaries)
+
         # Copy the list so we can use it as a retry queue.
         remaining_host_blocks = deque(blocks)
         key_errors = 0
@@ -799,7 +1959,7 @@ class IPAMClient(BlockHandleReaderWriter):
 
     def _allocate_ips_no_affinity(self, num, attributes, handle_id,
                                   host, ip_version, pool,
-                                  excluded_blocks):
+                                  excluded_blocks, ipam_config=None):
         """Tries to allocate IP addresses from any available block, without
         affinity.
 
@@ -813,6 +1973,8 @@ class IPAMClient(BlockHandleReaderWriter):
         :param pool: IP pool to choose from, or None for "any pool".
         :param excluded_blocks: set of blocks to exclude from the search, for
                example, to exclude blocks that we've already looked in.
+        :param ipam_config: The global IPAM configuration, or None to query it
+               if required.
         :return: list of allocated IPs or an empty list if none were available.
         """
         # Note that this processing simply takes all of the IP pools and breaks
@@ -828,7 +1990,8 @@ class IPAMClient(BlockHandleReaderWriter):
         _log.debug("Attempt to allocate from non-affine random block")
         random_blocks = self._random_blocks(version=ip_version, pool=pool,
                                             excluded_ids=excluded_blocks,
-                                            seed=host)
+                                            seed=host,
+                                            ipam_config=ipam_config)
         allocated_ips = []
         while len(allocated_ips) < num:
             try:
@@ -846,6 +2009,166 @@ class IPAMClient(BlockHandleReaderWriter):
             allocated_ips.extend(ips)
         return allocated_ips
 
+    def _auto_assign_batch(self, ip_version, wanted, pool, host):
+        """
+        Auto assign addresses of a specific IP version for a batch of
+        requests.
+
+        Blocks are chosen in the same way as _auto_assign(): first the
+        host-affine blocks, then new affine blocks, then (without strict
+        affinity) random blocks.
+
+        :param ip_version: 4 or 6, the IP version number.
+        :param wanted: List of (request index, handle_id, attributes, num)
+        tuples.
+        :param pool: (optional) if supplied, the pool to assign from,  If None,
+        automatically choose a pool.
+        :param host: The host ID to use for affinity in assigning IP addresses.
+        :return: Dict of the assigned IPs, as lists keyed by request index.
+        """
+        allocated = defaultdict(list)
+
+        def num_remaining():
+            return sum(num - len(allocated[i]) for i, _, _, num in wanted)
+
+        summaries = {}
+        host_blocks = self._get_affine_blocks(host, ip_version, pool,
+                                              summaries=summaries)
+        remaining_host_blocks = deque(_order_blocks_by_free(host_blocks,
+                                                            summaries))
+        key_errors = 0
+        while remaining_host_blocks and num_remaining() > 0:
+            block_cidr = remaining_host_blocks.popleft()
+            try:
+                self._auto_assign_batch_in_block(block_cidr, wanted,
+                                                 allocated, host)
+            except KeyError:
+                # The block may be about to be created by another IPAM client
+                # on this host.  See _allocate_ips_explicit_blocks().
+                _log.warning("Tried to auto-assign to block %s.  Doesn't "
+                             "exist.", block_cidr)
+                key_errors += 1
+                if key_errors <= KEY_ERROR_RETRIES:
+                    remaining_host_blocks.append(block_cidr)
+            except NoHostAffinityError:
+                _log.warning("No host affinity on block %s; skipping.",
+                             block_cidr)
+
+        if num_remaining() > 0:
+            ipam_config = self.get_ipam_config()
+            if ipam_config.auto_allocate_blocks:
+                for _ in xrange(RETRIES):
+                    if num_remaining() == 0:
+                        break
+                    try:
+                        new_block = self._new_affine_block(host,
+                                                           ip_version,
+                                                           pool,
+                                                           ipam_config)
+                    except NoFreeBlocksError:
+                        _log.info("Could not get new host affinity block for "
+                                  "%s in pool %s", host, pool)
+                        break
+                    self._auto_assign_batch_in_block(new_block, wanted,
+                                                     allocated, host)
+                else:  # pragma: no cover
+                    raise RuntimeError("Hit Max Retries.")
+
+            if num_remaining() > 0 and not ipam_config.strict_affinity:
+                random_blocks = self._random_blocks(
+                                            version=ip_version,
+                                            pool=pool,
+                                            excluded_ids=set(host_blocks),
+                                            seed=host,
+                                            ipam_config=ipam_config)
+                for block_cidr in random_blocks:
+                    self._auto_assign_batch_in_block(block_cidr, wanted,
+                                                     allocated, host,
+                                                     affinity_check=False)
+                    if num_remaining() == 0:
+                        break
+        return allocated
+
+    def _auto_assign_batch_in_block(self, block_cidr, wanted, allocated, host,
+                                    affinity_check=True):
+        """
+        Assign as many of the addresses still wanted by a batch of requests as
+        possible from a block, and commit them with a single compare-and-swap.
+
+        :param block_cidr: The identifier for the block to read.
+        :param wanted: List of (request index, handle_id, attributes, num)
+        tuples.
+        :param allocated: Dict of the IPs already assigned, as lists keyed by
+        request index.  Updated with the IPs assigned from this block.
+        :param host: The host ID to use for affinity in assigning IP addresses.
+        :param affinity_check: True to enable checking the host has the
+        affinity to the block, False to disable this check.
+        :return: None.
+        """
+        block_key = _block_datastore_key(block_cidr)
+        for i in self.retry_policy.attempts(block_key):
+            _log.debug("Batch auto-assign from %s, retry %d", block_cidr, i)
+            block = self._read_block(block_cidr)
+
+            unconfirmed_ips = {}
+            handle_amounts = defaultdict(int)
+            try:
+                for index, handle_id, attributes, num in wanted:
+                    num_remaining = num - len(allocated[index])
+                    if num_remaining <= 0:
+                        continue
+                    ips = block.auto_assign(num=num_remaining,
+                                            handle_id=handle_id,
+                                            attributes=attributes,
+                                            host=host,
+                                            affinity_check=affinity_check)
+                    if not ips:
+                        # Block is full.
+                        break
+                    unconfirmed_ips[index] = ips
+                    if handle_id is not None:
+                        handle_amounts[handle_id] += len(ips)
+            except NoHostAffinityError:
+                if block.from_cache:
+                    # Confirm against the datastore before failing.
+                    self._uncache_block(block_cidr)
+                    continue
+                raise
+            if not unconfirmed_ips:
+                if block.from_cache:
+                    self._uncache_block(block_cidr)
+                    continue
+                _log.debug("Block %s is full.", block_cidr)
+                return
+
+            if handle_amounts and is_transactional(self.etcd_client):
+                try:
+                    self._compare_and_swap_block_and_handles(block,
+                                                             handle_amounts)
+                except CASError:
+                    _log.debug("Transaction failed on block %s", block_cidr)
+                    continue
+                for index, ips in unconfirmed_ips.iteritems():
+                    allocated[index].extend(ips)
+                return
+
+            # Increment each handle once, before committing the block, so that
+            # a crash can only leave a handle counting too many addresses.
+            for handle_id, amount in handle_amounts.iteritems():
+                self._increment_handle(handle_id, block_cidr, amount)
+
+            try:
+                self._compare_and_swap_block(block)
+            except CASError:
+                _log.debug("CAS failed on block %s", block_cidr)
+                for handle_id, amount in handle_amounts.iteritems():
+                    self._decrement_handle(handle_id, block_cidr, amount)
+            else:
+                for index, ips in unconfirmed_ips.iteritems():
+                    allocated[index].extend(ips)
+                return
+        raise RuntimeError("Hit Max Retries.")
+
     def _auto_assign_ips_in_block(self, block_cidr, num, handle_id, attributes,
                                   host, affinity_check=True):
         """
@@ -865,19 +2188,43 @@ class IPAMClient(BlockHandleReaderWriter):
         """
         assert isinstance(handle_id, str) or handle_id is None
         _log.debug("Auto-assigning from block %s", block_cidr)
-        for i in xrange(RETRIES):
+        block_key = _block_datastore_key(block_cidr)
+        for i in self.retry_policy.attempts(block_key):
             _log.debug("Auto-assign from %s, retry %d", block_cidr, i)
             block = self._read_block(block_cidr)
 
-            unconfirmed_ips = block.auto_assign(num=num,
+            try:
+                unconfirmed_ips = block.auto_assign(
+                                                num=num,
                                                 handle_id=handle_id,
                                                 attributes=attributes,
                                                 host=host,
                                                 affinity_check=affinity_check)
+            except NoHostAffinityError:
+                if block.from_cache:
+                    # Confirm against the datastore before failing.
+                    self._uncache_block(block_cidr)
+                    continue
+                raise
             if len(unconfirmed_ips) == 0:
+                if block.from_cache:
+                    # Confirm against the datastore before giving up on the
+                    # block.
+                    self._uncache_block(block_cidr)
+                    continue
                 _log.debug("Block %s is full.", block_cidr)
                 return []
 
+            if handle_id is not None and is_transactional(self.etcd_client):
+                # Write the block and the handle together.
+                try:
+                    self._compare_and_swap_block_and_handles(
+                        block, {handle_id: len(unconfirmed_ips)})
+                except CASError:
+                    _log.debug("Transaction failed on block %s", block_cidr)
+                    continue
+                return unconfirmed_ips
+
             # If using a handle, increment the handle by the number of
             # confirmed IPs.
             if handle_id is not None:
@@ -919,26 +2266,39 @@ class IPAMClient(BlockHandleReaderWriter):
         assert isinstance(handle_id, str) or handle_id is None
         assert isinstance(address, IPAddress)
         host = host or get_hostname()
-        block_cidr = get_block_cidr_for_address(address)
-        ipam_config = None
-
-        for _ in xrange(RETRIES):
+        attributes = self._store_attributes(attributes)
+        block_cidr = get_block_cidr_for_address(
+                                        address,
+                                        self._get_block_size_bits(address))
+        refreshed = False
+
+        block_key = _block_datastore_key(block_cidr)
+        for _ in self.retry_policy.attempts(block_key):
             try:
                 block = self._read_block(block_cidr)
             except KeyError:
                 _log.debug("Block %s doesn't exist.", block_cidr)
-                if self._validate_cidr_in_pools(block_cidr):
+                if not refreshed:
+                    # The cached pools may be out of date, so refresh them
+                    # before claiming the block, in case the address is in
+                    # a block of a different size.
+                    refreshed = True
+                    refreshed_cidr = get_block_cidr_for_address(
+                            address,
+                            self._get_block_size_bits(address, refresh=True))
+                    if refreshed_cidr != block_cidr:
+                        _log.debug("Address %s is in block %s",
+                                   address, refreshed_cidr)
+                        block_cidr = refreshed_cidr
+                        continue
+                if self._validate_cidr_in_pools(block_cidr, refresh=False):
                     _log.debug("Create and claim block %s.",
                                block_cidr)
-
-                    # We need the IPAM config, so get it once now.
-                    if ipam_config is None:
-                        _log.debug("Querying IPAM config")
-                        ipam_config = self.get_ipam_config()
-
+                    ipam_config = self._get_cached_ipam_config()
                     try:
-                        self._claim_block_affinity(host, block_cidr,
-                                                   ipam_config)
+                        with self._host_lock(host, address.version):
+                            self._claim_block_affinity(host, block_cidr,
+                                                       ipam_config)
                     except HostAffinityClaimedError:
                         _log.debug("Someone else claimed block %s before us.",
                                    block_cidr)
@@ -953,7 +2313,24 @@ class IPAMClient(BlockHandleReaderWriter):
             # Try to assign.  Throws AlreadyAssignedError if already assigned,
             # or a NoHostAffinityError if the block requires strict host
             # affinity and the host affinity does not match the host.
-            block.assign(address, handle_id, attributes, host)
+            try:
+                block.assign(address, handle_id, attributes, host)
+            except (AlreadyAssignedError, NoHostAffinityError):
+                if block.from_cache:
+                    # Confirm against the datastore before failing.
+                    self._uncache_block(block_cidr)
+                    continue
+                raise
+
+            if handle_id is not None and is_transactional(self.etcd_client):
+                # Write the block and the handle together.
+                try:
+                    self._compare_and_swap_block_and_handles(block,
+                                                             {handle_id: 1})
+                    return
+                except CASError:
+                    _log.debug("Transaction failed on block %s", block_cidr)
+                    continue
 
             # If using a handle, increment by one IP
             if handle_id is not None:
@@ -972,51 +2349,167 @@ class IPAMClient(BlockHandleReaderWriter):
         raise RuntimeError("Hit max retries.")
 
     @handle_errors
-    def release_ips(self, addresses):
+    def release_ips(self, addresses, parallelism=1):
         """
         Release the given addresses.
 
+        Each block is released independently: a failure releasing one block
+        doesn't stop the others being released, and the first failure is
+        raised once they are all done.  Each handle is then decremented once,
+        for all the blocks it had addresses released from.
+
         :param addresses: Set of IPAddresses to release (ok to mix IPv4 and
         IPv6).
+        :param parallelism: (optional) The maximum number of blocks to release
+        concurrently.
         :return: Set of addresses that were already unallocated.
         """
         assert isinstance(addresses, (set, frozenset))
         _log.info("Releasing addresses %s", [str(addr) for addr in addresses])
-        unallocated = set()
-        # sort the addresses into blocks
+        # sort the addresses into blocks, using the block size of the pool
+        # that contains each address.  Addresses that are not in a pool use
+        # the default block size.  Blocks are keyed by integer (version,
+        # prefix, prefixlen) so that only one IPNetwork is built per block.
         addrs_by_block = {}
         for address in addresses:
-            block_cidr = get_block_cidr_for_address(address)
-            addrs = addrs_by_block.setdefault(block_cidr, set())
+            block_size_bits = self._get_block_size_bits(address)
+            version = address.version
+            block_key = (version,
+                         int(address) >> block_size_bits << block_size_bits,
+                         BITS_BY_VERSION[version] - block_size_bits)
+            addrs = addrs_by_block.setdefault(block_key, set())
             addrs.add(address)
 
-        # loop through blocks, CAS releasing.
-        for block_cidr, addresses in addrs_by_block.iteritems():
-            unalloc_block = self._release_ips_from_block(block_cidr, addresses)
-            unallocated = unallocated.union(unalloc_block)
+        # CAS release each block, recording the addresses released for each
+        # handle.  The handles are only decremented after the blocks are
+        # written, so a failure can only leave a handle counting too many
+        # addresses.
+        blocks = [(IPNetwork((prefix, prefixlen), version=version), addrs)
+                  for (version, prefix, prefixlen), addrs
+                  in addrs_by_block.iteritems()]
+        updates = _HandleUpdates()
+        unallocated, missing, errors = self._release_blocks(
+                                        blocks, updates, parallelism)
+        if missing:
+            # These addresses aren't in the blocks their pools put them in,
+            # for example because the pool has been deleted, so find their
+            # blocks from the blocks that are stored instead.
+            self._uncache_ipam_pools()
+            blocks, not_found = self._find_stored_blocks(missing)
+            unallocated.update(not_found)
+            stored_unallocated, _, stored_errors = self._release_blocks(
+                                        blocks, updates, parallelism,
+                                        missing_ok=True)
+            unallocated.update(stored_unallocated)
+            errors.extend(stored_errors)
+
+        errors.extend(self._commit_handle_updates(updates, parallelism))
+        if errors:
+            raise errors[0]
         return unallocated
 
-    def _release_ips_from_block(self, block_cidr, addresses):
+    def _release_blocks(self, blocks, updates, parallelism, missing_ok=False):
+        """
+        Release addresses from each of a list of blocks.
+
+        :param blocks: List of (block CIDR, set of addresses) tuples.
+        :param updates: A _HandleUpdates accumulator to record the handle
+        decrements in.  The caller must then commit them.
+        :param parallelism: The maximum number of blocks to release
+        concurrently.
+        :param missing_ok: Whether the addresses of a block that doesn't exist
+        are already unallocated, rather than missing.
+        :return: Tuple of (set of addresses that were already unallocated,
+        set of addresses whose block doesn't exist, list of errors).
+        """
+        def release_block(block):
+            block_cidr, addrs = block
+            return self._release_ips_from_block(block_cidr, addrs, updates,
+                                                missing_ok)
+
+        unallocated = set()
+        missing = set()
+        errors = []
+        results = _call_concurrently(release_block, blocks, parallelism)
+        for (block_cidr, addrs), (unalloc_block, error) in zip(blocks,
+                                                               results):
+            if isinstance(error, KeyError):
+                _log.debug("Block %s doesn't exist", block_cidr)
+                missing.update(addrs)
+            elif error is not None:
+                _log.error("Failed to release addresses from block %s: %r",
+                           block_cidr, error)
+                errors.append(error)
+            else:
+                unallocated.update(unalloc_block)
+        return unallocated, missing, errors
+
+    def _find_stored_blocks(self, addresses):
+        """
+        Find the blocks containing the given addresses from the IDs of the
+        blocks that are stored, rather than from the block sizes of the pools.
+
+        :param addresses: Set of IPAddresses.
+        :return: Tuple of (list of (block CIDR, set of addresses) tuples, set
+        of addresses that aren't in any block).
+        """
+        block_cidrs_by_version = {}
+        addrs_by_block = {}
+        not_found = set()
+        for address in addresses:
+            block_cidrs = block_cidrs_by_version.get(address.version)
+            if block_cidrs is None:
+                # Skip the parent directory, which is listed when there are
+                # no blocks.
+                block_cidrs = [IPNetwork(block_id.replace("-", "/"))
+                               for block_id
+                               in self._get_block_ids(address.version)
+                               if "-" in block_id]
+                block_cidrs_by_version[address.version] = block_cidrs
+            for block_cidr in block_cidrs:
+                if address in block_cidr:
+                    addrs_by_block.setdefault(block_cidr, set()).add(address)
+                    break
+            else:
+                not_found.add(address)
+        return addrs_by_block.items(), not_found
+
+    def _release_ips_from_block(self, block_cidr, addresses, updates=None,
+                                missing_ok=True):
         """
         Release the given addresses from the block, using compare-and-swap to
         write the block.
         :param block_cidr: IPNetwork identifying the block
         :param addresses: List of addresses to release.
+        :param updates: (optional) A _HandleUpdates accumulator to record the
+        handle decrements in, instead of decrementing the handles.  The caller
+        must then commit them.
+        :param missing_ok: (optional) Whether the addresses are already
+        unallocated if the block doesn't exist.  If False, a KeyError is
+        raised instead.
         :return: List of addresses that were already unallocated.
         """
         _log.debug("Releasing %d adddresses from block %s",
                    len(addresses), block_cidr)
 
-        for _ in xrange(RETRIES):
+        block_key = _block_datastore_key(block_cidr)
+        for _ in self.retry_policy.attempts(block_key):
             try:
                 block = self._read_block(block_cidr)
             except KeyError:
                 _log.debug("Block %s doesn't exist.", block_cidr)
+                if not missing_ok:
+                    raise
                 # OK to return, all addresses must be released already.
                 return addresses
-            (unallocated, handles) = block.release(addresses)
+            (unallocated, released_handles) = block.release(addresses)
             assert len(unallocated) <= len(addresses)
             if len(unallocated) == len(addresses):
+                if block.from_cache:
+                    # Confirm against the datastore, as there's nothing to
+                    # write.
+                    self._uncache_block(block_cidr)
+                    continue
                 # All the addresses are already unallocated.
                 return addresses
             # Try to commit
@@ -1034,25 +2527,32 @@ class IPAMClient(BlockHandleReaderWriter):
                 continue
             else:
                 # Success!  Decrement handles.
-                for handle_id, amount in handles.iteritems():
-                    if handle_id is not None:
+                for handle_id, amount in released_handles.iteritems():
+                    if handle_id is None:
                         # Skip the None handle, it's a special value meaning
                         # the addresses were not allocated with a handle.
+                        continue
+                    if updates is not None:
+                        updates.add(handle_id, block_cidr, -amount)
+                    else:
                         self._decrement_handle(handle_id, block_cidr, amount)
 
                 return unallocated
 
         raise RuntimeError("Hit Max retries.")  # pragma: no cover
 
-    def _validate_cidr_in_pools(self, cidr):
+    def _validate_cidr_in_pools(self, cidr, refresh=True):
         """
-        Validate a CIDR is fully covered by one of the configured IP pools.
-        Raises a PoolNotFound exception if the CIDR is not valid.
+        Validate a CIDR is fully covered by one of the enabled IP pools.
 
         :param cidr: (IPNetwork) The CIDR to check.
+        :param refresh: Whether to read the pools again rather than use the
+        pools cached by this client.
+        :return: True if the CIDR is in an enabled pool, False otherwise.
         """
-        pools = self.get_ip_pools(cidr.version, ipam=True, include_disabled=False)
-        return any([cidr in pool for pool in pools])
+        return any(first <= cidr.first and cidr.last <= last and not disabled
+                   for first, last, _, disabled in
+                   self._get_ipam_pools(cidr.version, refresh))
 
     @handle_errors
     def get_ip_assignments_by_handle(self, handle_id):
@@ -1063,11 +2563,15 @@ class IPAMClient(BlockHandleReaderWriter):
         :return: List of IPAddresses
         """
         assert isinstance(handle_id, str)
-        handle = self._read_handle(handle_id)  # Can throw KeyError, let it.
+        # Read at quorum, so we don't miss blocks recently added to the
+        # handle.  Can throw KeyError, let it.
+        handle = self._read_handle(handle_id, quorum=True)
 
         ip_assignments = []
         for block_str in handle.block:
             block_cidr = IPNetwork(block_str)
+            # Read-only, so don't serve the block from the cache.
+            self._uncache_block(block_cidr)
             try:
                 block = self._read_block(block_cidr)
             except KeyError:
@@ -1088,21 +2592,37 @@ class IPAMClient(BlockHandleReaderWriter):
         :return: None.
         """
         assert isinstance(handle_id, str)
-        handle = self._read_handle(handle_id)  # Can throw KeyError, let it.
-
-        # Loop through blocks, releasing.
-        for block_str in handle.block:
-            block_cidr = IPNetwork(block_str)
-            self._release_ip_by_handle_block(handle_id, block_cidr)
-
-    def _release_ip_by_handle_block(self, handle_id, block_cidr):
+        # Read at quorum, so we don't miss blocks recently added to the
+        # handle.  Can throw KeyError, let it.
+        handle = self._read_handle(handle_id, quorum=True)
+
+        # Loop through blocks, releasing.  The handle is updated once, after
+        # all the blocks have been written, even if releasing from a block
+        # fails.
+        updates = _HandleUpdates()
+        try:
+            for block_str in handle.block:
+                block_cidr = IPNetwork(block_str)
+                self._release_ip_by_handle_block(handle_id, block_cidr,
+                                                 updates)
+        finally:
+            errors = self._commit_handle_updates(updates)
+        if errors:
+            raise errors[0]
+
+    def _release_ip_by_handle_block(self, handle_id, block_cidr,
+                                    updates=None):
         """
         Release all address in a block with the given handle ID.
         :param handle_id: The handle ID to find addresses with.
         :param block_cidr: The block to release addresses on.
+        :param updates: (optional) A _HandleUpdates accumulator to record the
+        handle decrement in, instead of decrementing the handle.  The caller
+        must then commit it.
         :return: None
         """
-        for _ in xrange(RETRIES):
+        block_key = _block_datastore_key(block_cidr)
+        for _ in self.retry_policy.attempts(block_key):
             try:
                 block = self._read_block(block_cidr)
             except KeyError:
@@ -1113,6 +2633,10 @@ class IPAMClient(BlockHandleReaderWriter):
                 return
 
             num_release = block.release_by_handle(handle_id)
+            if num_release == 0 and block.from_cache:
+                # Confirm against the datastore, as there's nothing to write.
+                self._uncache_block(block_cidr)
+                continue
             if num_release == 0:
                 # Block didn't have any addresses with this handle, so all
                 # so all addresses are already unallocated.  This can happen if
@@ -1130,7 +2654,10 @@ class IPAMClient(BlockHandleReaderWriter):
             if handle_id is not None:
                 # Skip the None handle, it's a special value meaning
                 # the addresses were not allocated with a handle.
-                self._decrement_handle(handle_id, block_cidr, num_release)
+                if updates is not None:
+                    updates.add(handle_id, block_cidr, -num_release)
+                else:
+                    self._decrement_handle(handle_id, block_cidr, num_release)
                 return
         raise RuntimeError("Hit Max retries.")  # pragma: no cover
 
@@ -1144,17 +2671,31 @@ class IPAMClient(BlockHandleReaderWriter):
         assign().
         """
         assert isinstance(address, IPAddress)
-        block_cidr = get_block_cidr_for_address(address)
+        block_cidr = get_block_cidr_for_address(
+                                        address,
+                                        self._get_block_size_bits(address))
 
+        # Read-only, so don't serve the block from the cache.
+        self._uncache_block(block_cidr)
         try:
             block = self._read_block(block_cidr)
         except KeyError:
-            _log.warning("Couldn't read block %s for requested address %s",
-                         block_cidr, address)
-            raise AddressNotAssignedError("%s is not assigned." % address)
-        else:
-            _, attributes = block.get_attributes_for_ip(address)
-            return attributes
+            # The address may be in a block its pool doesn't put it in, for
+            # example because the pool has been deleted.
+            self._uncache_ipam_pools()
+            blocks, _ = self._find_stored_blocks({address})
+            if not blocks:
+                _log.warning("Couldn't read block %s for requested address "
+                             "%s", block_cidr, address)
+                raise AddressNotAssignedError("%s is not assigned." % address)
+            block_cidr = blocks[0][0]
+            self._uncache_block(block_cidr)
+            try:
+                block = self._read_block(block_cidr)
+            except KeyError:
+                raise AddressNotAssignedError("%s is not assigned." % address)
+        _, attributes = block.get_attributes_for_ip(address)
+        return self._resolve_attributes(attributes)
 
     @handle_errors
     def claim_affinity(self, cidr, host=None):
@@ -1172,14 +2713,21 @@ class IPAMClient(BlockHandleReaderWriter):
                   [IPNetwork<blocks that were claimed by another host>])
         """
         assert isinstance(cidr, IPNetwork)
-        if not validate_block_size(cidr):
+
+        # Get the IPAM configuration.  We need this when claiming block
+        # affinities, and for the block size if the pool does not specify one.
+        ipam_config = self.get_ipam_config()
+        block_size_bits = self._get_pool_block_size_bits(cidr, refresh=True)
+        if block_size_bits is None:
+            block_size_bits = ipam_config.block_size_bits
+        if not validate_block_size(cidr, block_size_bits):
             _log.info("Requested CIDR %s is too small", cidr)
             raise InvalidBlockSizeError("The requested CIDR is smaller than "
                                         "the minimum block size.")
 
         host = host or get_hostname()
 
-        if not self._validate_cidr_in_pools(cidr):
+        if not self._validate_cidr_in_pools(cidr, refresh=False):
             _log.info("Requested CIDR %s is not in a configured pool", cidr)
             raise PoolNotFound("Requested CIDR is not in a configured IP "
                                "Pool.")
@@ -1187,11 +2735,8 @@ class IPAMClient(BlockHandleReaderWriter):
         claimed = []
         unclaimed = []
 
-        # Get the IPAM configuration.  We need this when claiming block
-        # affinities.
-        ipam_config = self.get_ipam_config()
-
-        for block_cidr in cidr.subnet(BLOCK_PREFIXLEN[cidr.version]):
+        block_prefixlen = BITS_BY_VERSION[cidr.version] - block_size_bits
+        for block_cidr in cidr.subnet(block_prefixlen):
             try:
                 self._claim_block_affinity(host, block_cidr, ipam_config)
             except HostAffinityClaimedError:
@@ -1217,7 +2762,8 @@ class IPAMClient(BlockHandleReaderWriter):
                   [IPNetwork<blocks that were claimed by another host>])
         """
         assert isinstance(cidr, IPNetwork)
-        if not validate_block_size(cidr):
+        block_size_bits = self._get_block_size_bits(cidr, refresh=True)
+        if not validate_block_size(cidr, block_size_bits):
             _log.info("Requested CIDR %s is too small", cidr)
             raise InvalidBlockSizeError("The requested CIDR is smaller than "
                                         "the minimum block size.")
@@ -1227,7 +2773,8 @@ class IPAMClient(BlockHandleReaderWriter):
         not_claimed = []
         claimed_by_other = []
 
-        for block_cidr in cidr.subnet(BLOCK_PREFIXLEN[cidr.version]):
+        block_prefixlen = BITS_BY_VERSION[cidr.version] - block_size_bits
+        for block_cidr in cidr.subnet(block_prefixlen):
             try:
                 self._release_block_affinity(host, block_cidr)
             except HostAffinityClaimedError:
@@ -1256,7 +2803,7 @@ class IPAMClient(BlockHandleReaderWriter):
         # block.
         _log.debug("Releasing affinities for %s", host)
         for version in (4, 6):
-            cidrs = self._get_affine_blocks(host, version, None)
+            cidrs = self._get_affine_blocks(host, version, None, quorum=True)
             for cidr in cidrs:
                 try:
                     self._release_block_affinity(host, cidr)
@@ -1315,6 +2862,49 @@ class IPAMClient(BlockHandleReaderWriter):
             pass
 
 
+def _call_concurrently(fn, items, parallelism):
+    """
+    Call a function for each of a list of items, using up to the given number
+    of threads.  An exception calling the function for one item doesn't stop
+    it being called for the others.
+
+    :param fn: The function, called with one item.
+    :param items: List of items.
+    :param parallelism: The maximum number of concurrent calls.  If 1, the
+    calls are made in turn in this thread.
+    :return: List of (result, error) tuples in the same order as the items,
+    where error is the exception raised, or None.
+    """
+    results = [None] * len(items)
+    indexes = deque(xrange(len(items)))
+    fn = bind_operations(fn)
+
+    def worker():
+        while True:
+            try:
+                index = indexes.popleft()
+            except IndexError:
+                return
+            try:
+                results[index] = (fn(items[index]), None)
+            except Exception as e:
+                _log.debug("Call for %s failed", items[index], exc_info=True)
+                results[index] = (None, e)
+
+    num_threads = min(parallelism, len(items))
+    if num_threads <= 1:
+        worker()
+    else:
+        threads = [threading.Thread(target=worker)
+                   for _ in xrange(num_threads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return results
+
+
 # Choice of steps to take when iterating over the subnets.  Must all be
 # coprime to powers of 2.  Since we choose a random start point and a random
 # step, repeat collisions are very unlikely.
@@ -1343,7 +2933,8 @@ def _random_subnets_from_cidr(cidr, prefixlen, rnd=random):
     # Calculate number of subnets to be returned.
     max_subnets = 2 ** (prefixlen - cidr.prefixlen)
 
-    base_subnet_addr = str(cidr.cidr.ip)  # Throws away the .1 in 10.0.0.1/8.
+    base_subnet_addr = cidr.first  # Throws away the .1 in 10.0.0.1/8.
+    subnet_size = 2 ** (cidr._module.width - prefixlen)
     num_returned = 0
     # Choose our step and initial position randomly.  We avoid using
     # rnd.shuffle() because that would require us to generate the whole list
@@ -1363,10 +2954,8 @@ def _random_subnets_from_cidr(cidr, prefixlen, rnd=random):
     step = rnd.choice(STEPS)
     position = rnd.randint(0, max_subnets - 1)
     while num_returned < max_subnets:
-        subnet = IPNetwork('%s/%d' % (base_subnet_addr, prefixlen),
-                           cidr.version)
-        subnet.value += (subnet.size * position)
-        subnet.prefixlen = prefixlen
+        subnet = IPNetwork((base_subnet_addr + subnet_size * position,
+                            prefixlen), version=cidr.version)
         num_returned += 1
         position = (position + step) % max_subnets
         yield subnet
@@ -1378,7 +2967,8 @@ def _random_subnets_from_cidrs(cidrs, prefixlen, seed=None):
     in a pseudo-random order with no repeats.
 
     :param cidrs: List of CIDRs.
-    :param prefixlen: Length of subnets to generate.
+    :param prefixlen: Length of subnets to generate, or a list with the length
+    of subnets to generate from each CIDR.
     :param seed: Seed for the random number generator; any hashable object or
     None to use the standard library's seeding strategy.
     """
@@ -1386,8 +2976,10 @@ def _random_subnets_from_cidrs(cidrs, prefixlen, seed=None):
     # Make a generator for the subnet CIDRs in each pool.  We'll pick CIDRs
     # from each generator in turn so that we spread the subnets evenly between
     # pools.
-    pool_subnets = deque([_random_subnets_from_cidr(cidr, prefixlen, rnd=rnd)
-                          for cidr in cidrs])
+    if isinstance(prefixlen, (int, long)):
+        prefixlen = [prefixlen] * len(cidrs)
+    pool_subnets = deque([_random_subnets_from_cidr(cidr, length, rnd=rnd)
+                          for cidr, length in zip(cidrs, prefixlen)])
     num_generated = 0
     while pool_subnets:
         # Shuffle the per-pool generators each time we cycle through them.
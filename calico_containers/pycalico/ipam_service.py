@@ -0,0 +1,236 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A local IPAM service, serving the operations of a long-lived IPAMClient over
+a Unix domain socket.
+
+Run one on each host, with:
+
+    python -m pycalico.ipam_service --socket /var/run/calico/ipam.sock
+
+Short-lived processes such as CNI plugins then make requests with the
+lightweight IPAMServiceClient (pycalico.ipam_service_client), instead of
+each importing the IPAM client, reading its configuration and connecting to
+etcd.  The service keeps its etcd connections open, and its caches warm,
+between requests.  Each connection is served by its own thread.
+"""
+import argparse
+import errno
+import logging
+import os
+import SocketServer
+import socket
+import threading
+
+from netaddr import IPAddress
+
+from pycalico.datastore_errors import PoolNotFound
+from pycalico.ipam import IPAMClient
+from pycalico.ipam_service_client import (DEFAULT_SOCKET_PATH, read_message,
+                                          write_message)
+
+_log = logging.getLogger(__name__)
+_log.addHandler(logging.NullHandler())
+
+SOCKET_MODE = 0o600
+"""
+The permissions of the socket.  Only the owner can use the service.
+"""
+
+
+class IPAMService(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Serves the operations of an IPAMClient on a Unix domain socket.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, client, socket_path=DEFAULT_SOCKET_PATH):
+        """
+        Creates the socket, replacing any left by a previous service.  Call
+        serve_forever() to serve requests, and shutdown() from another thread
+        to stop, then server_close() to close the socket and connections.
+
+        :param client: The IPAMClient.
+        :param socket_path: (optional) The path of the socket.
+        """
+        self.client = client
+        self.socket_path = socket_path
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+        try:
+            os.unlink(socket_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               _RequestHandler)
+        os.chmod(socket_path, SOCKET_MODE)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+        with self._connections_lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def handle_request_message(self, request):
+        """
+        Call the IPAMClient method for a request.
+
+        :param request: The decoded request message.
+        :return: The response message.
+        """
+        try:
+            if not isinstance(request, dict):
+                raise ValueError("Invalid request")
+            method = _METHODS.get(request.get("method"))
+            if method is None:
+                raise ValueError("Unknown method %s" % request.get("method"))
+            params = dict((str(name), value) for name, value
+                          in (request.get("params") or {}).iteritems())
+            return {"result": method(self.client, **params)}
+        except Exception as e:
+            _log.debug("Request %s failed", request, exc_info=True)
+            return {"error": {"type": e.__class__.__name__,
+                              "message": str(e)}}
+
+
+class _RequestHandler(SocketServer.BaseRequestHandler):
+    """
+    Serves the requests on a connection, in turn, until it is closed.
+    """
+
+    def setup(self):
+        with self.server._connections_lock:
+            self.server._connections.add(self.request)
+
+    def finish(self):
+        with self.server._connections_lock:
+            self.server._connections.discard(self.request)
+
+    def handle(self):
+        while True:
+            try:
+                request = read_message(self.request)
+            except (ValueError, socket.error) as e:
+                _log.warning("Closing IPAM service connection: %s", e)
+                return
+            if request is None:
+                return
+            response = self.server.handle_request_message(request)
+            try:
+                write_message(self.request, response)
+            except socket.error as e:
+                _log.warning("Failed to send IPAM service response: %s", e)
+                return
+
+
+def _auto_assign_ips(client, num_v4, num_v6, handle_id, attributes,
+                     pool=(None, None), host=None):
+    pool = (_pool(client, 4, pool[0]), _pool(client, 6, pool[1]))
+    v4, v6 = client.auto_assign_ips(num_v4, num_v6, _str(handle_id),
+                                    attributes, pool=pool, host=host)
+    return [str(a) for a in v4], [str(a) for a in v6]
+
+
+def _assign_ip(client, address, handle_id, attributes, host=None):
+    client.assign_ip(IPAddress(address), _str(handle_id), attributes,
+                     host=host)
+
+
+def _release_ips(client, addresses):
+    unallocated = client.release_ips(set(IPAddress(a) for a in addresses))
+    return [str(a) for a in unallocated]
+
+
+def _release_ip_by_handle(client, handle_id):
+    client.release_ip_by_handle(_str(handle_id))
+
+
+def _get_ip_assignments_by_handle(client, handle_id):
+    return [str(a) for a in
+            client.get_ip_assignments_by_handle(_str(handle_id))]
+
+
+def _get_assignment_attributes(client, address):
+    return client.get_assignment_attributes(IPAddress(address))
+
+
+_METHODS = {
+    "auto_assign_ips": _auto_assign_ips,
+    "assign_ip": _assign_ip,
+    "release_ips": _release_ips,
+    "release_ip_by_handle": _release_ip_by_handle,
+    "get_ip_assignments_by_handle": _get_ip_assignments_by_handle,
+    "get_assignment_attributes": _get_assignment_attributes,
+}
+"""
+The functions that serve each request method.  They convert the JSON
+parameters and results to and from those of the IPAMClient methods.
+"""
+
+
+def _pool(client, version, cidr):
+    """
+    :return: The configured IPPool with the given CIDR, or None if cidr is
+    None.
+    """
+    if cidr is None:
+        return None
+    for pool in client.get_ip_pools(version, ipam=True):
+        if str(pool.cidr) == cidr:
+            return pool
+    raise PoolNotFound("Requested pool %s is not configured" % cidr)
+
+
+def _str(value):
+    """
+    Convert a JSON string to the str the IPAMClient expects.
+    """
+    return str(value) if value is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local IPAM service.")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH,
+                        help="the path of the Unix domain socket")
+    parser.add_argument("--no-block-cache", action="store_true",
+                        help="read each block from etcd every time")
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level,
+                        format="%(asctime)s %(levelname)s %(name)s: "
+                               "%(message)s")
+
+    client = IPAMClient(cache_blocks=not args.no_block_cache)
+    service = IPAMService(client, args.socket)
+    _log.info("Serving IPAM requests on %s", args.socket)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Client for the local IPAM service (pycalico.ipam_service).
+
+This module only uses the standard library, so a short-lived process such as
+a CNI plugin can assign and release addresses through the service without
+importing the IPAM client or connecting to etcd itself:
+
+    client = IPAMServiceClient()
+    v4_addresses, v6_addresses = client.auto_assign_ips(1, 0, handle_id, {})
+
+Addresses are passed and returned as strings.
+
+Messages are framed as a 4 byte, big-endian length followed by that many
+bytes of JSON.  A request is {"method": <name>, "params": {...}}, and the
+response is {"result": <result>}, or {"error": {"type": <exception class
+name>, "message": <message>}}.  A connection may be used for any number of
+requests, one at a time.
+"""
+import json
+import socket
+import struct
+
+from pycalico import PyCalicoError
+
+DEFAULT_SOCKET_PATH = "/var/run/calico/ipam.sock"
+
+DEFAULT_TIMEOUT = 60
+"""
+The default number of seconds to wait for a response.
+"""
+
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+_HEADER = struct.Struct("!I")
+
+
+class IPAMServiceError(PyCalicoError):
+    """
+    The IPAM service could not be reached, or the operation failed.
+    """
+
+    def __init__(self, error_type, message):
+        """
+        :param error_type: The class name of the exception raised by the
+        operation, or None if the service could not be reached.
+        :param message: The error message.
+        """
+        super(IPAMServiceError, self).__init__(message)
+        self.error_type = error_type
+
+
+class IPAMServiceClient(object):
+    """
+    Makes requests to the IPAM service over a single connection, which is
+    opened on the first request and reopened after an error.  Not safe to
+    use from several threads at once.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH,
+                 timeout=DEFAULT_TIMEOUT):
+        """
+        :param socket_path: (optional) The path of the service's socket.
+        :param timeout: (optional) The number of seconds to wait for a
+        response.
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._sock = None
+
+    def auto_assign_ips(self, num_v4, num_v6, handle_id, attributes,
+                        pool=(None, None), host=None):
+        """
+        As IPAMClient.auto_assign_ips(), with pools given by CIDR.
+
+        :return: A tuple of (v4_address_list, v6_address_list).
+        """
+        v4, v6 = self.call("auto_assign_ips", num_v4=num_v4, num_v6=num_v6,
+                           handle_id=handle_id, attributes=attributes,
+                           pool=list(pool), host=host)
+        return v4, v6
+
+    def assign_ip(self, address, handle_id, attributes, host=None):
+        """
+        As IPAMClient.assign_ip().
+        """
+        return self.call("assign_ip", address=str(address),
+                         handle_id=handle_id, attributes=attributes,
+                         host=host)
+
+    def release_ips(self, addresses):
+        """
+        As IPAMClient.release_ips().
+
+        :return: Set of addresses that were already unallocated.
+        """
+        return set(self.call("release_ips",
+                             addresses=[str(a) for a in addresses]))
+
+    def release_ip_by_handle(self, handle_id):
+        """
+        As IPAMClient.release_ip_by_handle().
+        """
+        return self.call("release_ip_by_handle", handle_id=handle_id)
+
+    def get_ip_assignments_by_handle(self, handle_id):
+        """
+        As IPAMClient.get_ip_assignments_by_handle().
+        """
+        return self.call("get_ip_assignments_by_handle", handle_id=handle_id)
+
+    def get_assignment_attributes(self, address):
+        """
+        As IPAMClient.get_assignment_attributes().
+        """
+        return self.call("get_assignment_attributes", address=str(address))
+
+    def call(self, method, **params):
+        """
+        Make a request to the service.
+
+        :param method: The name of the IPAMClient method to call.
+        :param params: The method's parameters.
+        :raises IPAMServiceError: The service could not be reached, or the
+        method raised an exception.
+        :return: The method's result.
+        """
+        try:
+            if self._sock is None:
+                self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._sock.settimeout(self.timeout)
+                self._sock.connect(self.socket_path)
+            write_message(self._sock, {"method": method, "params": params})
+            response = read_message(self._sock)
+            if response is None:
+                raise IPAMServiceError(None, "Connection closed by the IPAM "
+                                             "service")
+        except (socket.error, ValueError, IPAMServiceError) as e:
+            # Don't reuse the connection, as it may have a response pending.
+            self.close()
+            if isinstance(e, IPAMServiceError):
+                raise
+            raise IPAMServiceError(None, "Error accessing the IPAM service "
+                                         "at %s: %s" % (self.socket_path, e))
+
+        error = response.get("error")
+        if error is not None:
+            raise IPAMServiceError(error.get("type"), error.get("message"))
+        return response.get("result")
+
+    def close(self):
+        """
+        Close the connection, if open.
+        """
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+def write_message(sock, message):
+    """
+    Send a message on a socket.
+
+    :param sock: The connected socket.
+    :param message: The JSON serializable message.
+    """
+    data = json.dumps(message, separators=(",", ":"))
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def read_message(sock):
+    """
+    Receive a message from a socket.
+
+    :param sock: The connected socket.
+    :raises ValueError: The message is too large, truncated or not JSON.
+    :return: The decoded message, or None if the connection was closed
+    before the message started.
+    """
+    header = _read_exactly(sock, _HEADER.size)
+    if not header:
+        return None
+    size, = _HEADER.unpack(header)
+    if size > MAX_MESSAGE_SIZE:
+        raise ValueError("Message of %d bytes is too large" % size)
+    return json.loads(_read_exactly(sock, size))
+
+
+def _read_exactly(sock, size):
+    """
+    :return: The next size bytes from the socket, or "" if the connection was
+    closed before any were received.
+    :raises ValueError: The connection was closed part way through.
+    """
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = sock.recv(remaining)
+        if not chunk:
+            if remaining == size:
+                return ""
+            raise ValueError("Connection closed mid-message")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return "".join(chunks)
@@ -0,0 +1,397 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+An in-memory datastore backend.
+
+MemoryEtcdClient implements the parts of the etcd v2 keys API that pycalico
+uses, with the same compare-and-swap semantics and exceptions as a real etcd
+cluster, so the datastore and IPAM clients can be driven without one.  It is
+used to simulate and benchmark IPAM under load, for example:
+
+    client = IPAMClient(backend=MemoryEtcdClient(latency=0.001))
+
+TTLs are recorded but keys never expire.
+"""
+from collections import deque
+import logging
+import posixpath
+import threading
+import time
+
+from etcd import (EtcdResult, EtcdException, EtcdKeyNotFound,
+                  EtcdAlreadyExist, EtcdNotFile, EtcdNotDir, EtcdDirNotEmpty,
+                  EtcdEventIndexCleared, EtcdWatchTimedOut)
+
+from pycalico.backend import DatastoreBackend, TxnWrite, compare_failed
+
+_log = logging.getLogger(__name__)
+_log.addHandler(logging.NullHandler())
+
+ROOT_KEY = "/"
+
+EVENT_HISTORY = 1000
+"""
+The number of changes remembered for watches, as for etcd.
+"""
+
+
+class MemoryEtcdClient(DatastoreBackend):
+    """
+    A thread-safe, in-memory etcd v2 keys API.
+    """
+
+    transactional = True
+
+    def __init__(self, latency=0):
+        """
+        :param latency: (optional) The number of seconds each request takes,
+        or a function returning it, to simulate the round trip to an etcd
+        cluster.  Requests wait for the latency outside of any lock, so
+        concurrent requests overlap as they would against a real cluster.
+        """
+        self.latency = latency
+
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._index = 1
+        """
+        The etcd index, incremented by every change.
+        """
+
+        self._nodes = {ROOT_KEY: _Node(ROOT_KEY, None, True, 0)}
+        """
+        Every key, including directories, keyed by the full key path.
+        """
+
+        self._round_trips = {}
+        """
+        The number of requests made, keyed by method ("read", "write",
+        "delete", "watch" or "txn").
+        """
+
+        self._events = deque(maxlen=EVENT_HISTORY)
+        """
+        The most recent changes, as EtcdResult arguments.
+        """
+
+    def read(self, key, recursive=False, wait=False, waitIndex=None,
+             timeout=None, **kwargs):
+        if wait:
+            self._round_trip("watch")
+            return self._wait(_normalize_key(key), recursive, waitIndex,
+                              timeout)
+        self._round_trip("read")
+        key = _normalize_key(key)
+        with self._lock:
+            node = self._get_node(key)
+            return self._result("get", node.to_dict(self._nodes, recursive))
+
+    def write(self, key, value, ttl=None, dir=False, append=False,
+              prevExist=None, prevIndex=None, prevValue=None, **kwargs):
+        """
+        Write a key, with the same arguments as etcd.Client.write().
+
+        :raises EtcdAlreadyExist: prevExist is False and the key exists.
+        :raises EtcdKeyNotFound: prevExist, prevIndex or prevValue is set and
+        the key does not exist.
+        :raises EtcdCompareFailed: prevIndex or prevValue does not match.
+        :raises EtcdNotFile: Writing a value to a directory.
+        :raises EtcdNotDir: A parent of the key is not a directory.
+        :return: etcd.EtcdResult
+        """
+        if dir and value:
+            raise EtcdException("Cannot create a directory with a value")
+        self._round_trip("write")
+        with self._lock:
+            return self._write(_normalize_key(key), value, ttl, dir, append,
+                               prevExist, prevIndex, prevValue)
+
+    def _write(self, key, value, ttl=None, dir=False, append=False,
+               prevExist=None, prevIndex=None, prevValue=None):
+        """
+        Write a key.  The lock must be held.
+        """
+        if append:
+            self._get_node(key)
+            key = posixpath.join(key, "%020d" % (self._index + 1))
+        existing = self._nodes.get(key)
+        if existing is not None:
+            if prevExist is False:
+                raise EtcdAlreadyExist("Key already exists", key)
+            if existing.dir and not (dir and prevExist):
+                raise EtcdNotFile("Not a file", key)
+            existing.check(prevIndex, prevValue)
+        elif prevExist or prevIndex is not None or prevValue is not None:
+            raise EtcdKeyNotFound("Key not found", key)
+
+        self._index += 1
+        parent = self._make_parents(key)
+        node = _Node(key, None if dir else _to_value(value), dir,
+                     self._index, ttl=ttl)
+        if existing is not None:
+            node.created_index = existing.created_index
+            node.children = existing.children
+        self._nodes[key] = node
+        parent.children.add(key)
+
+        if prevExist is False or append:
+            action = "create"
+        elif prevIndex is not None or prevValue is not None:
+            action = "compareAndSwap"
+        elif prevExist:
+            action = "update"
+        else:
+            action = "set"
+        prev_node = (existing.to_dict(self._nodes, False)
+                     if existing is not None else None)
+        return self._change(action, node.to_dict(self._nodes, False),
+                            prev_node)
+
+    def delete(self, key, recursive=None, dir=None, prevIndex=None,
+               prevValue=None, **kwargs):
+        """
+        Delete a key, with the same arguments as etcd.Client.delete().
+
+        :raises EtcdKeyNotFound: The key does not exist.
+        :raises EtcdCompareFailed: prevIndex or prevValue does not match.
+        :raises EtcdNotFile: Deleting a directory without dir or recursive.
+        :raises EtcdDirNotEmpty: Deleting a non-empty directory without
+        recursive.
+        :return: etcd.EtcdResult
+        """
+        self._round_trip("delete")
+        with self._lock:
+            return self._delete(_normalize_key(key), recursive, dir,
+                                prevIndex, prevValue)
+
+    def _delete(self, key, recursive=None, dir=None, prevIndex=None,
+                prevValue=None):
+        """
+        Delete a key.  The lock must be held.
+        """
+        node = self._get_node(key)
+        if key == ROOT_KEY:
+            raise EtcdException("Cannot delete the root key")
+        if node.dir:
+            if not (dir or recursive):
+                raise EtcdNotFile("Not a file", key)
+            if node.children and not recursive:
+                raise EtcdDirNotEmpty("Directory not empty", key)
+        node.check(prevIndex, prevValue)
+
+        prev_node = node.to_dict(self._nodes, False)
+        self._index += 1
+        self._remove(key)
+        self._nodes[posixpath.dirname(key)].children.discard(key)
+        result = {"key": key, "dir": node.dir,
+                  "modifiedIndex": self._index,
+                  "createdIndex": node.created_index}
+        return self._change("delete", result, prev_node)
+
+    def transaction(self, ops):
+        self._round_trip("txn")
+        ops = [(op, _normalize_key(op.key)) for op in ops]
+        with self._lock:
+            for op, key in ops:
+                existing = self._nodes.get(key)
+                write = isinstance(op, TxnWrite)
+                if existing is None:
+                    failed = (not write or op.prevExist or
+                              op.prevIndex is not None)
+                elif existing.dir:
+                    raise EtcdNotFile("Not a file", key)
+                elif write and op.prevExist is False:
+                    failed = True
+                else:
+                    failed = (op.prevIndex is not None and
+                              int(op.prevIndex) != existing.modified_index)
+                if failed:
+                    # Include the current nodes, as Etcd3Backend does.
+                    nodes = dict((k, self._nodes[k].to_dict(self._nodes,
+                                                            False))
+                                 for _, k in ops if k in self._nodes)
+                    raise compare_failed(key, self._index, nodes)
+
+            # All the conditions hold, so the changes can't fail.
+            return [self._write(key, op.value, prevIndex=op.prevIndex,
+                                prevExist=op.prevExist)
+                    if isinstance(op, TxnWrite)
+                    else self._delete(key, prevIndex=op.prevIndex)
+                    for op, key in ops]
+
+    def round_trips(self):
+        """
+        :return: Dict of the number of requests made, keyed by method.
+        """
+        with self._lock:
+            return dict(self._round_trips)
+
+    def reset_round_trips(self):
+        with self._lock:
+            self._round_trips = {}
+
+    def _round_trip(self, method):
+        with self._lock:
+            self._round_trips[method] = self._round_trips.get(method, 0) + 1
+        latency = self.latency() if callable(self.latency) else self.latency
+        if latency > 0:
+            time.sleep(latency)
+
+    def _wait(self, key, recursive, wait_index, timeout):
+        """
+        Wait for a change to a key, or to the subtree under it.
+        """
+        deadline = time.time() + timeout if timeout else None
+        prefix = key.rstrip("/") + "/"
+        with self._lock:
+            if wait_index is None:
+                wait_index = self._index + 1
+            elif (len(self._events) == self._events.maxlen and
+                    wait_index < self._events[0][0]):
+                raise EtcdEventIndexCleared("The event in requested index "
+                                            "is outdated and cleared",
+                                            wait_index)
+            while True:
+                for index, action, node, prev_node in self._events:
+                    if index < wait_index:
+                        continue
+                    if (node["key"] == key or
+                            (recursive and node["key"].startswith(prefix))):
+                        return self._result(action, node, prev_node)
+                remaining = (deadline - time.time() if deadline is not None
+                             else None)
+                if remaining is not None and remaining <= 0:
+                    raise EtcdWatchTimedOut("Watch timed out", key)
+                wait_index = self._index + 1
+                self._changed.wait(remaining)
+
+    def _get_node(self, key):
+        try:
+            return self._nodes[key]
+        except KeyError:
+            raise EtcdKeyNotFound("Key not found", key)
+
+    def _make_parents(self, key):
+        """
+        Create any missing parent directories of a key.
+
+        :return: The _Node of the key's parent directory.
+        """
+        parent_key = posixpath.dirname(key)
+        parent = self._nodes.get(parent_key)
+        if parent is None:
+            grandparent = self._make_parents(parent_key)
+            parent = _Node(parent_key, None, True, self._index)
+            self._nodes[parent_key] = parent
+            grandparent.children.add(parent_key)
+        elif not parent.dir:
+            raise EtcdNotDir("Not a directory", parent_key)
+        return parent
+
+    def _remove(self, key):
+        node = self._nodes.pop(key)
+        for child in node.children:
+            self._remove(child)
+
+    def _change(self, action, node, prev_node):
+        """
+        Record a change for watches, and wake up any waiting.
+
+        :return: etcd.EtcdResult for the change.
+        """
+        self._events.append((self._index, action, node, prev_node))
+        self._changed.notify_all()
+        return self._result(action, node, prev_node)
+
+    def _result(self, action, node, prev_node=None):
+        result = EtcdResult(action, node, prevNode=prev_node)
+        result.etcd_index = self._index
+        return result
+
+
+class _Node(object):
+    """
+    A key stored by MemoryEtcdClient.
+    """
+
+    def __init__(self, key, value, dir, index, ttl=None):
+        self.key = key
+        self.value = value
+        self.dir = dir
+        self.ttl = ttl
+        self.created_index = index
+        self.modified_index = index
+        self.children = set()
+        """
+        The full keys of a directory's children.
+        """
+
+    def check(self, prev_index, prev_value):
+        """
+        Check the conditions of a compare-and-swap or compare-and-delete.
+
+        :raises EtcdCompareFailed: A condition does not match.
+        """
+        if prev_index is None and prev_value is None:
+            return
+        if self.dir:
+            raise EtcdNotFile("Not a file", self.key)
+        if prev_index is not None and int(prev_index) != self.modified_index:
+            raise compare_failed("[%s != %s]" % (prev_index,
+                                                 self.modified_index))
+        if prev_value is not None and _to_value(prev_value) != self.value:
+            raise compare_failed("[%s != %s]" % (prev_value, self.value))
+
+    def to_dict(self, nodes, recursive, top=True):
+        """
+        :param nodes: The dict of all _Nodes, keyed by key.
+        :param recursive: Whether to include the whole subtree of a
+        directory.  Otherwise only immediate children are included.
+        :param top: False for the children of the node read.
+        :return: The node in the form returned by the etcd API.
+        """
+        node = {"key": self.key,
+                "modifiedIndex": self.modified_index,
+                "createdIndex": self.created_index}
+        if self.ttl is not None:
+            node["ttl"] = self.ttl
+        if not self.dir:
+            node["value"] = self.value
+            return node
+        node["dir"] = True
+        if top or recursive:
+            children = [nodes[child].to_dict(nodes, recursive, top=False)
+                        for child in sorted(self.children)]
+            if children:
+                node["nodes"] = children
+        return node
+
+
+def _normalize_key(key):
+    """
+    Normalize a key as etcd does, so that for example "/a/b/" and "a//b" are
+    both "/a/b".
+    """
+    return posixpath.normpath(posixpath.join(ROOT_KEY, key)).replace("//", "/")
+
+
+def _to_value(value):
+    """
+    Convert a value to the string etcd stores.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
@@ -0,0 +1,387 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Instrumentation of the datastore and IPAM clients.
+
+Once enabled with DatastoreClient.enable_metrics(), a MetricsRegistry
+records for each public client method the number of calls and errors, the
+wall time spent, and the etcd requests made: reads, writes, deletes,
+transactions and watches, compare-and-swap failures, and the payload bytes
+sent and received.  Requests are counted against every method in progress
+on the thread, so the counts for a method include those of the methods it
+calls.
+
+The registry can be exported in the Prometheus text format with
+to_prometheus().  While metrics are not enabled, the only cost is checking
+whether they are.
+"""
+import bisect
+import threading
+import time
+
+from etcd import EtcdCompareFailed, EtcdAlreadyExist
+
+from pycalico.backend import DatastoreBackend, is_transactional
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+"""
+The upper bounds of the operation latency histogram buckets, in seconds.
+"""
+
+REQUEST_TYPES = ("read", "write", "delete", "txn", "watch")
+
+COUNTERS = ("reads", "writes", "deletes", "txns", "watches", "cas_failures",
+            "bytes_sent", "bytes_received")
+
+_COUNTER_BY_REQUEST_TYPE = dict(zip(REQUEST_TYPES, COUNTERS))
+
+_local = threading.local()
+"""
+Holds the stack of operations in progress on each thread.
+"""
+
+
+class MetricsRegistry(object):
+    """
+    Records the operations of one or more datastore clients.  Safe to use
+    from several threads at once.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: (optional) The upper bounds of the latency histogram
+        buckets, in seconds.
+        """
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._operations = {}
+        """
+        _OperationMetrics keyed by method name.
+        """
+
+        self._totals = dict.fromkeys(COUNTERS, 0)
+        """
+        The etcd request counters for all requests, including those made
+        outside of any instrumented method.
+        """
+
+    def start(self, name):
+        """
+        Start recording an operation on this thread.
+
+        :param name: The method name.
+        :return: The _ActiveOperation, to pass to finish().
+        """
+        operation = _ActiveOperation(self, name)
+        _stack().append(operation)
+        return operation
+
+    def finish(self, operation, succeeded):
+        """
+        Finish recording an operation started on this thread.
+
+        :param operation: The _ActiveOperation returned by start().
+        :param succeeded: False if the operation raised an exception.
+        """
+        elapsed = time.time() - operation.start_time
+        stack = _stack()
+        if stack and stack[-1] is operation:
+            stack.pop()
+        with self._lock:
+            metrics = self._operations.get(operation.name)
+            if metrics is None:
+                metrics = _OperationMetrics(len(self.buckets))
+                self._operations[operation.name] = metrics
+            metrics.add(operation, elapsed, succeeded,
+                        bisect.bisect_left(self.buckets, elapsed))
+
+    def record_request(self, request_type, sent, received, cas_failed):
+        """
+        Record an etcd request against the totals, and against the
+        operations in progress on this thread.
+
+        :param request_type: One of REQUEST_TYPES.
+        :param sent: The payload bytes sent.
+        :param received: The payload bytes received.
+        :param cas_failed: Whether the request failed a compare-and-swap
+        condition.
+        """
+        counter = _COUNTER_BY_REQUEST_TYPE[request_type]
+        counts = [self._totals]
+        counts.extend(operation.counts for operation in _stack()
+                      if operation.registry is self)
+        with self._lock:
+            for count in counts:
+                count[counter] += 1
+                count["bytes_sent"] += sent
+                count["bytes_received"] += received
+                if cas_failed:
+                    count["cas_failures"] += 1
+
+    def snapshot(self):
+        """
+        :return: Dict of the metrics recorded so far:
+          - "operations": dicts of "count", "errors", "seconds", "buckets"
+            (the cumulative count of calls in each latency bucket) and each
+            of COUNTERS, keyed by method name
+          - "totals": dict of each of COUNTERS for all requests.
+        """
+        with self._lock:
+            return {"operations": dict((name, metrics.to_dict())
+                                       for name, metrics
+                                       in self._operations.iteritems()),
+                    "totals": dict(self._totals)}
+
+    def to_prometheus(self, prefix="pycalico"):
+        """
+        Export the metrics in the Prometheus text exposition format.
+
+        :param prefix: (optional) The prefix of the metric names.
+        :return: The metrics, as a string.
+        """
+        snapshot = self.snapshot()
+        operations = sorted(snapshot["operations"].iteritems())
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append("# HELP %s_%s %s" % (prefix, name, help_text))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, metric_type))
+            for suffix, labels, value in samples:
+                label_text = ",".join('%s="%s"' % (key, _escape(value))
+                                      for key, value in labels)
+                lines.append("%s_%s%s{%s} %s" % (prefix, name, suffix,
+                                                  label_text, _number(value)))
+
+        samples = []
+        for name, op in operations:
+            labels = [("operation", name)]
+            for bound, count in zip(self.buckets, op["buckets"]):
+                samples.append(("_bucket", labels + [("le", _number(bound))],
+                                count))
+            samples.append(("_bucket", labels + [("le", "+Inf")],
+                            op["count"]))
+            samples.append(("_sum", labels, op["seconds"]))
+            samples.append(("_count", labels, op["count"]))
+        metric("operation_duration_seconds", "histogram",
+               "Time spent in datastore client operations.", samples)
+        metric("operation_errors_total", "counter",
+               "Datastore client operations that raised an exception.",
+               [("", [("operation", name)], op["errors"])
+                for name, op in operations])
+        metric("operation_etcd_requests_total", "counter",
+               "etcd requests made by datastore client operations.",
+               [("", [("operation", name), ("type", request_type)],
+                 op[_COUNTER_BY_REQUEST_TYPE[request_type]])
+                for name, op in operations
+                for request_type in REQUEST_TYPES])
+        metric("operation_cas_failures_total", "counter",
+               "Failed compare-and-swaps in datastore client operations.",
+               [("", [("operation", name)], op["cas_failures"])
+                for name, op in operations])
+        metric("operation_etcd_sent_bytes_total", "counter",
+               "Payload bytes sent to etcd by datastore client operations.",
+               [("", [("operation", name)], op["bytes_sent"])
+                for name, op in operations])
+        metric("operation_etcd_received_bytes_total", "counter",
+               "Payload bytes received from etcd by datastore client "
+               "operations.",
+               [("", [("operation", name)], op["bytes_received"])
+                for name, op in operations])
+        totals = snapshot["totals"]
+        metric("etcd_requests_total", "counter", "All etcd requests.",
+               [("", [("type", request_type)],
+                 totals[_COUNTER_BY_REQUEST_TYPE[request_type]])
+                for request_type in REQUEST_TYPES])
+        metric("etcd_cas_failures_total", "counter",
+               "All failed compare-and-swaps.",
+               [("", [], totals["cas_failures"])])
+        return "\n".join(lines) + "\n"
+
+
+class InstrumentedBackend(DatastoreBackend):
+    """
+    Wraps a datastore backend, recording each request in a MetricsRegistry.
+    """
+
+    def __init__(self, backend, registry):
+        """
+        :param backend: The backend to wrap, for example an etcd.Client.
+        :param registry: The MetricsRegistry to record requests in.
+        """
+        self.backend = backend
+        self.registry = registry
+
+    @property
+    def transactional(self):
+        return is_transactional(self.backend)
+
+    def read(self, key, **kwargs):
+        request_type = "watch" if kwargs.get("wait") else "read"
+        return self._call(request_type, len(key), self.backend.read, key,
+                          **kwargs)
+
+    def write(self, key, value, *args, **kwargs):
+        return self._call("write", len(key) + _len(value),
+                          self.backend.write, key, value, *args, **kwargs)
+
+    def update(self, obj):
+        return self._call("write", len(obj.key) + _len(obj.value),
+                          self.backend.update, obj)
+
+    def delete(self, key, *args, **kwargs):
+        return self._call("delete", len(key), self.backend.delete, key,
+                          *args, **kwargs)
+
+    def transaction(self, ops):
+        sent = sum(len(op.key) + _len(getattr(op, "value", None))
+                   for op in ops)
+        return self._call("txn", sent, self.backend.transaction, ops)
+
+    def watch(self, key, index=None, timeout=None, recursive=None):
+        return self.read(key, wait=True, waitIndex=index, timeout=timeout,
+                         recursive=recursive)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def _call(self, request_type, sent, fn, *args, **kwargs):
+        try:
+            result = fn(*args, **kwargs)
+        except (EtcdCompareFailed, EtcdAlreadyExist):
+            self.registry.record_request(request_type, sent, 0, True)
+            raise
+        except Exception:
+            self.registry.record_request(request_type, sent, 0, False)
+            raise
+        self.registry.record_request(request_type, sent,
+                                     _result_size(result), False)
+        return result
+
+
+def bind_operations(fn):
+    """
+    Wrap a function to be called on another thread, so that etcd requests
+    it makes are recorded against the operations in progress on this
+    thread.
+
+    :param fn: The function.
+    :return: The wrapped function, or fn if no operations are in progress.
+    """
+    stack = getattr(_local, "stack", None)
+    if not stack:
+        return fn
+    operations = list(stack)
+
+    def bound(*args, **kwargs):
+        previous = getattr(_local, "stack", None)
+        _local.stack = list(operations)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.stack = previous if previous is not None else []
+    return bound
+
+
+class _ActiveOperation(object):
+    """
+    An operation in progress.
+    """
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+        self.start_time = time.time()
+        self.counts = dict.fromkeys(COUNTERS, 0)
+
+
+class _OperationMetrics(object):
+    """
+    The metrics recorded for a method.
+    """
+
+    def __init__(self, num_buckets):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.bucket_counts = [0] * num_buckets
+        self.counts = dict.fromkeys(COUNTERS, 0)
+
+    def add(self, operation, elapsed, succeeded, bucket):
+        self.count += 1
+        if not succeeded:
+            self.errors += 1
+        self.seconds += elapsed
+        if bucket < len(self.bucket_counts):
+            self.bucket_counts[bucket] += 1
+        for counter, value in operation.counts.iteritems():
+            self.counts[counter] += value
+
+    def to_dict(self):
+        cumulative = []
+        total = 0
+        for count in self.bucket_counts:
+            total += count
+            cumulative.append(total)
+        result = {"count": self.count,
+                  "errors": self.errors,
+                  "seconds": self.seconds,
+                  "buckets": cumulative}
+        result.update(self.counts)
+        return result
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+def _len(value):
+    return len(value) if isinstance(value, basestring) else 0
+
+
+def _result_size(result):
+    """
+    :return: The payload bytes of a result: the keys and values of its
+    nodes, or 0 if it isn't an EtcdResult.
+    """
+    if isinstance(result, list):
+        return sum(_result_size(item) for item in result)
+    key = getattr(result, "key", None)
+    if not isinstance(key, basestring):
+        return 0
+    size = len(key) + _len(result.value)
+    nodes = list(getattr(result, "_children", None) or [])
+    while nodes:
+        node = nodes.pop()
+        size += _len(node.get("key")) + _len(node.get("value"))
+        nodes.extend(node.get("nodes", []))
+    return size
+
+
+def _number(value):
+    """
+    Format a number for the Prometheus text format.
+    """
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n",
+                                                                  "\\n")
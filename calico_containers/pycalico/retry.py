@@ -0,0 +1,174 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Retry policy for compare-and-swap loops.
+"""
+import logging
+import random
+import threading
+import time
+
+_log = logging.getLogger(__name__)
+_log.addHandler(logging.NullHandler())
+
+DEFAULT_RETRIES = 100
+DEFAULT_INITIAL_DELAY = 0.001
+DEFAULT_MAX_DELAY = 0.1
+DEFAULT_MULTIPLIER = 2
+
+MAX_TRACKED_KEYS = 4096
+"""
+The maximum number of keys retry counts are recorded for.  Retries on other
+keys are counted against OTHER_KEY.
+"""
+
+OTHER_KEY = "other"
+
+
+class RetryPolicy(object):
+    """
+    Controls how compare-and-swap loops retry, and records how often they do.
+
+    Retries are delayed by a random amount of up to an exponentially
+    increasing maximum ("full jitter"), so that clients that conflicted on a
+    key don't all retry at the same time.
+
+    A single policy is shared by all the loops of a client, and is safe to
+    use from several threads at once.
+    """
+
+    def __init__(self, retries=DEFAULT_RETRIES,
+                 initial_delay=DEFAULT_INITIAL_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY, multiplier=DEFAULT_MULTIPLIER,
+                 deadline=None):
+        """
+        :param retries: The maximum number of attempts of an operation.
+        :param initial_delay: The maximum delay in seconds before the first
+        retry.  Set to 0 to retry immediately.
+        :param max_delay: The maximum delay in seconds before any retry.
+        :param multiplier: How much the maximum delay increases by for each
+        retry.
+        :param deadline: (optional) The maximum number of seconds to spend
+        retrying an operation, or None for no limit.
+        """
+        assert retries > 0
+        self.retries = retries
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.deadline = deadline
+
+        self._sleep = time.sleep
+        self._time = time.time
+        self._random = random.Random()
+
+        self._lock = threading.Lock()
+        self._retries_by_key = {}
+        """
+        The number of retries, keyed by datastore key.
+        """
+
+        self._attempts_histogram = {}
+        """
+        The number of operations, keyed by the number of attempts they took.
+        """
+
+        self._exhausted = 0
+        """
+        The number of operations that ran out of attempts.
+        """
+
+    def attempts(self, key):
+        """
+        Generate the attempts at an operation on a datastore key, delaying
+        before each retry.  Stops when the operation runs out of attempts or
+        time; the caller should then fail the operation.
+
+        :param key: The datastore key the operation is on, for example the
+        block key.
+        :return: Generator of attempt numbers, starting from 0.
+        """
+        start = self._time()
+        attempt = 0
+        try:
+            while attempt < self.retries:
+                if attempt:
+                    delay = self.delay(attempt)
+                    if (self.deadline is not None and
+                            self._time() + delay - start > self.deadline):
+                        _log.warning("Deadline reached retrying %s after %d "
+                                     "attempts", key, attempt)
+                        break
+                    self._record_retry(key)
+                    if delay > 0:
+                        self._sleep(delay)
+                attempt += 1
+                yield attempt - 1
+            self._record_exhausted()
+        finally:
+            # Also runs when the caller stops iterating, because the
+            # operation has finished.
+            self._record_attempts(attempt)
+
+    def delay(self, attempt):
+        """
+        :param attempt: The number of attempts made so far.
+        :return: A random delay in seconds before the next attempt.
+        """
+        # Cap the exponent; the delay is capped by max_delay anyway.
+        exponent = min(attempt - 1, 64)
+        limit = min(self.max_delay,
+                    self.initial_delay * self.multiplier ** exponent)
+        return self._random.uniform(0, limit)
+
+    def stats(self):
+        """
+        Get the retries recorded so far, for export.
+
+        :return: Dict with:
+          - "retries": retry counts, keyed by datastore key
+          - "attempts": operation counts, keyed by the number of attempts
+          - "exhausted": the number of operations that ran out of attempts.
+        """
+        with self._lock:
+            return {"retries": dict(self._retries_by_key),
+                    "attempts": dict(self._attempts_histogram),
+                    "exhausted": self._exhausted}
+
+    def hot_keys(self, num=10):
+        """
+        :param num: The number of keys to return.
+        :return: List of (key, retries) tuples for the keys with the most
+        retries, most first.
+        """
+        with self._lock:
+            items = self._retries_by_key.items()
+        items.sort(key=lambda item: item[1], reverse=True)
+        return items[:num]
+
+    def _record_retry(self, key):
+        with self._lock:
+            if (key not in self._retries_by_key and
+                    len(self._retries_by_key) >= MAX_TRACKED_KEYS):
+                key = OTHER_KEY
+            self._retries_by_key[key] = self._retries_by_key.get(key, 0) + 1
+
+    def _record_attempts(self, attempts):
+        with self._lock:
+            self._attempts_histogram[attempts] = \
+                self._attempts_histogram.get(attempts, 0) + 1
+
+    def _record_exhausted(self):
+        with self._lock:
+            self._exhausted += 1
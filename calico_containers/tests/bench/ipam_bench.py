@@ -0,0 +1,201 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+IPAM load simulator and benchmark.
+
+Drives IPAMClients on a number of simulated hosts, each with a number of
+threads assigning addresses, against an in-memory etcd.  The pool is first
+filled to each requested level by another host, so that the cost of finding
+free space in a nearly full pool (claiming new affine blocks, then borrowing
+from other hosts' blocks) shows up in the results.
+
+Run from the calico_containers directory:
+
+    python -m tests.bench.ipam_bench --hosts 4 --threads 4 --latency 1
+"""
+import argparse
+import threading
+import time
+import uuid
+
+from netaddr import IPNetwork
+
+from pycalico.block import BITS_BY_VERSION
+from pycalico.datastore_datatypes import IPPool
+from pycalico.ipam import IPAMClient
+from pycalico.memory_etcd import MemoryEtcdClient
+from pycalico.retry import RetryPolicy
+
+DEFAULT_POOL = "10.0.0.0/16"
+DEFAULT_BLOCK_SIZE_BITS = 6
+DEFAULT_FILLS = (0, 0.5, 0.9, 0.99)
+FILL_HOST = "bench-fill"
+
+COLUMNS = (("fill", "%5.0f%%", 100),
+           ("allocations", "%7d", 1),
+           ("failures", "%5d", 1),
+           ("allocations_per_sec", "%9.1f", 1),
+           ("p50_ms", "%8.2f", 1),
+           ("p99_ms", "%8.2f", 1),
+           ("conflict_rate", "%8.3f", 1),
+           ("round_trips_per_op", "%7.1f", 1))
+
+
+def run_benchmark(fill=0, hosts=4, threads=4, operations=25, latency=0,
+                  pool=DEFAULT_POOL, block_size_bits=DEFAULT_BLOCK_SIZE_BITS):
+    """
+    Fill the pool to a level, then assign one address per operation from
+    each thread of each host.
+
+    :param fill: The fraction of the pool to assign before measuring.
+    :param hosts: The number of simulated hosts, each with its own
+    IPAMClient.
+    :param threads: The number of threads assigning on each host.
+    :param operations: The number of assignments made by each thread.
+    :param latency: The simulated etcd round trip time in seconds.
+    :param pool: The IPv4 pool CIDR.
+    :param block_size_bits: The block size of the pool.
+    :return: Dict of results:
+      - "fill": the fraction of the pool assigned before measuring
+      - "allocations": the number of operations that assigned an address
+      - "failures": the number that didn't, because the pool was full
+      - "allocations_per_sec": allocations per second of wall clock time
+      - "p50_ms", "p99_ms": operation latency percentiles, in milliseconds
+      - "conflict_rate": the fraction of compare-and-swap attempts that had
+        to be retried
+      - "round_trips_per_op": etcd requests per operation.
+    """
+    etcd_client = MemoryEtcdClient()
+    setup_client = _make_client(etcd_client)
+    pool = IPPool(IPNetwork(pool), block_size_bits=block_size_bits)
+    setup_client.add_ip_pool(4, pool)
+    _fill_pool(setup_client, pool, fill)
+
+    etcd_client.latency = latency
+    etcd_client.reset_round_trips()
+    retry_policy = RetryPolicy()
+    clients = [_make_client(etcd_client, retry_policy)
+               for _ in xrange(hosts)]
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+
+    def assign(client, host):
+        for _ in xrange(operations):
+            start = time.time()
+            v4, _ = client.auto_assign_ips(1, 0, uuid.uuid4().hex, {},
+                                           host=host)
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                if not v4:
+                    failures.append(elapsed)
+
+    workers = [threading.Thread(target=assign,
+                                args=(client, "bench-host-%d" % i))
+               for i, client in enumerate(clients)
+               for _ in xrange(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+
+    stats = retry_policy.stats()
+    attempts = sum(num * count for num, count in stats["attempts"].items())
+    retries = sum(stats["retries"].values())
+    allocations = len(latencies) - len(failures)
+    latencies.sort()
+    return {"fill": fill,
+            "allocations": allocations,
+            "failures": len(failures),
+            "allocations_per_sec": allocations / elapsed if elapsed else 0,
+            "p50_ms": _percentile(latencies, 0.5) * 1000,
+            "p99_ms": _percentile(latencies, 0.99) * 1000,
+            "conflict_rate": float(retries) / attempts if attempts else 0,
+            "round_trips_per_op": (float(sum(etcd_client.round_trips()
+                                             .values())) /
+                                   max(len(latencies), 1))}
+
+
+def _make_client(etcd_client, retry_policy=None):
+    return IPAMClient(backend=etcd_client, retry_policy=retry_policy)
+
+
+def _fill_pool(client, pool, fill):
+    """
+    Assign a fraction of the pool from a single host, filling one block at a
+    time.  The blocks are filled directly rather than through
+    auto_assign_ips(), which would read every full block before claiming
+    the next one.
+    """
+    remaining = int(pool.cidr.size * fill)
+    block_prefixlen = (BITS_BY_VERSION[pool.cidr.version] -
+                       pool.block_size_bits)
+    for block_cidr in pool.cidr.subnet(block_prefixlen):
+        if remaining <= 0:
+            break
+        client.claim_affinity(block_cidr, host=FILL_HOST)
+        num = min(remaining, block_cidr.size)
+        assigned = client._auto_assign_ips_in_block(block_cidr, num,
+                                                    "bench-fill", {},
+                                                    FILL_HOST)
+        assert len(assigned) == num, "Failed to fill block %s" % block_cidr
+        remaining -= num
+
+
+def _percentile(values, fraction):
+    """
+    :param values: Sorted list of values.
+    :return: The value at the given fraction of the list, or 0 if empty.
+    """
+    if not values:
+        return 0
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--hosts", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4,
+                        help="threads per host")
+    parser.add_argument("--operations", type=int, default=25,
+                        help="assignments per thread")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="etcd round trip time in milliseconds")
+    parser.add_argument("--pool", default=DEFAULT_POOL)
+    parser.add_argument("--block-size-bits", type=int,
+                        default=DEFAULT_BLOCK_SIZE_BITS)
+    parser.add_argument("--fill", type=float, action="append",
+                        help="percentage of the pool to fill before "
+                             "measuring; may be repeated")
+    args = parser.parse_args()
+
+    fills = ([fill / 100 for fill in args.fill] if args.fill
+             else DEFAULT_FILLS)
+    print(" ".join(name for name, _, _ in COLUMNS))
+    for fill in fills:
+        result = run_benchmark(fill=fill, hosts=args.hosts,
+                               threads=args.threads,
+                               operations=args.operations,
+                               latency=args.latency / 1000,
+                               pool=args.pool,
+                               block_size_bits=args.block_size_bits)
+        print(" ".join(fmt % (result[name] * scale)
+                       for name, fmt, scale in COLUMNS))
+
+
+if __name__ == "__main__":
+    main()
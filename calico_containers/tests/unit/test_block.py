@@ -19,11 +19,18 @@ import unittest
 import json
 from pycalico.block import (AllocationBlock,
                             BLOCK_SIZE,
+                            BlockError,
+                            COMPACT_PREFIX,
+                            ENCODING_COMPACT,
+                            ENCODING_JSON,
                             NoHostAffinityError,
                             AlreadyAssignedError,
                             AddressNotAssignedError,
+                            InvalidBlockError,
+                            VALIDATE_OFF,
                             get_block_cidr_for_address,
-                            validate_block_size)
+                            validate_block_size,
+                            validate_block_size_bits)
 from etcd import EtcdResult
 
 network = IPNetwork("192.168.25.0/26")
@@ -40,6 +47,36 @@ class TestAllocationBlock(unittest.TestCase):
         assert_equal(block.host_affinity, host)
         assert_equal(block.cidr, network)
         assert_equal(block.count_free_addresses(), BLOCK_SIZE)
+        assert_true(block._verify_unallocated())
+
+    @parameterized.expand([
+        (IPNetwork("10.11.12.0/28"), 16),
+        (IPNetwork("10.11.0.0/20"), 4096),
+        (IPNetwork("10.11.12.13/32"), 1),
+        (IPNetwork("2001:abcd:def0::/124"), 16),
+    ])
+    def test_init_block_size(self, cidr, size):
+        """
+        Test blocks take their size from the CIDR.
+        """
+        block = AllocationBlock(cidr, TEST_HOST, False)
+        assert_equal(block.size, size)
+        assert_equal(block.count_free_addresses(), size)
+
+        ips = block.auto_assign(size + 1, None, {}, TEST_HOST)
+        assert_equal(len(ips), size)
+        assert_equal(set(ips), set(cidr))
+        assert_equal(block.count_free_addresses(), 0)
+
+        block.release(set(ips))
+        assert_true(block.is_empty())
+
+    def test_init_block_size_invalid(self):
+        """
+        Test blocks larger than the maximum block size are rejected.
+        """
+        assert_raises(AssertionError, AllocationBlock,
+                      IPNetwork("10.11.0.0/19"), TEST_HOST, False)
 
     def test_to_json(self):
         host = "test_host"
@@ -53,9 +90,8 @@ class TestAllocationBlock(unittest.TestCase):
                 "key2": "value2"
             }
         }
-        block.attributes.append(attr)
-        block.allocations[5] = 0
-        block.unallocated.remove(5)
+        block.assign(network[5], "test_key",
+                     attr[AllocationBlock.ATTR_SECONDARY], host)
         assert_equal(block.count_free_addresses(), BLOCK_SIZE - 1)
 
         # Read out the JSON
@@ -193,17 +229,23 @@ class TestAllocationBlock(unittest.TestCase):
         # Check repeats
         json_dict[AllocationBlock.UNALLOCATED] = unallocated + [3]
         result.value = json.dumps(json_dict)
-        self.assertRaises(AssertionError,
+        self.assertRaises(InvalidBlockError,
                           AllocationBlock.from_etcd_result, result)
         # Check invalid entry
         json_dict[AllocationBlock.UNALLOCATED] = unallocated + [0]
         result.value = json.dumps(json_dict)
-        self.assertRaises(AssertionError,
+        self.assertRaises(InvalidBlockError,
                           AllocationBlock.from_etcd_result, result)
         # Check missing entry
         json_dict[AllocationBlock.UNALLOCATED] = unallocated[1:]
         result.value = json.dumps(json_dict)
-        self.assertRaises(AssertionError,
+        self.assertRaises(InvalidBlockError,
+                          AllocationBlock.from_etcd_result, result)
+        # Check invalid affinity
+        json_dict[AllocationBlock.UNALLOCATED] = unallocated
+        json_dict[AllocationBlock.AFFINITY] = "Sammy Davis, Jr."
+        result.value = json.dumps(json_dict)
+        self.assertRaises(InvalidBlockError,
                           AllocationBlock.from_etcd_result, result)
 
     def test_update_result_from_pre_unallocated(self):
@@ -255,8 +297,8 @@ class TestAllocationBlock(unittest.TestCase):
         assert_list_equal(block.unallocated, unallocated)
 
         # Modify the block (and the expected allocation order)
-        block.allocations[3] = 1
-        block.unallocated.remove(3)
+        block.assign(network[3], "test_key2",
+                     attr1[AllocationBlock.ATTR_SECONDARY], TEST_HOST)
         unallocated.remove(3)
 
         # Get the update.  It should be the same result object, but with the
@@ -480,6 +522,16 @@ class TestAllocationBlock(unittest.TestCase):
         assert_raises(AlreadyAssignedError, block0.assign,
                       ip0, "key0", attr, TEST_HOST)
 
+    def test_assign_outside_block(self):
+        block0 = _test_block_empty_v4()
+
+        assert_raises(AssertionError, block0.assign,
+                      BLOCK_V4_1.next()[0], "key0", {}, TEST_HOST)
+        assert_raises(AssertionError, block0.get_attributes_for_ip,
+                      BLOCK_V4_1[0] - 1)
+        assert_raises(AssertionError, block0.release,
+                      {BLOCK_V4_1.next()[0]})
+
     def test_assign_v4_strict_affinity(self):
         """
         Test attempting to assign with strict affinity raises an error.
@@ -668,6 +720,215 @@ class TestAllocationBlock(unittest.TestCase):
         # Check that the unallocated list has the released ordinals appended.
         assert_list_equal(block.unallocated[-2:], [2, 4])
 
+    def test_assign_release_reassign(self):
+        """
+        Test that explicitly assigning and releasing the same address keeps
+        the allocation order consistent.
+        """
+        block = _test_block_empty_v4()
+        for _ in range(3 * BLOCK_SIZE):
+            block.assign(BLOCK_V4_1[1], None, {}, TEST_HOST)
+            block.release({BLOCK_V4_1[1]})
+        assert_equal(block.count_free_addresses(), BLOCK_SIZE)
+        assert_true(block._verify_unallocated())
+        assert_true(block.is_empty())
+        assert_true(block._verify_unallocated())
+
+        # The repeatedly released address is now at the end of the list, so
+        # it is only handed out once all other addresses have been used.
+        assert_equal(block.unallocated[-1], 1)
+        ips = block.auto_assign(BLOCK_SIZE, None, {}, TEST_HOST)
+        assert_equal(len(set(ips)), BLOCK_SIZE)
+        assert_equal(ips[-1], BLOCK_V4_1[1])
+        assert_equal(block.count_free_addresses(), 0)
+        assert_false(block.is_empty())
+
+    def test_indexes_kept_up_to_date(self):
+        """
+        Test the handle and attribute indexes are maintained through assign
+        and release, and match indexes built from scratch.
+        """
+        block = _test_block_not_empty_v4()
+        ips_a = block.auto_assign(3, "key_a", {"pod": "a"}, TEST_HOST)
+        ips_b = block.auto_assign(2, "key_b", {"pod": "b"}, TEST_HOST)
+        block.assign(BLOCK_V4_1[40], "key_a", {"pod": "a2"}, TEST_HOST)
+        assert_equal(len(block.attributes), 4)
+
+        # Release some of key_a and all of the original key1 allocations.
+        block.release({ips_a[0], BLOCK_V4_1[2], BLOCK_V4_1[4]})
+        assert_equal(len(block.attributes), 3)
+        assert_list_equal(block.get_ip_assignments_by_handle("key_a"),
+                          ips_a[1:] + [BLOCK_V4_1[40]])
+        assert_list_equal(block.get_ip_assignments_by_handle("key1"), [])
+
+        # Re-using existing attributes does not add a new entry, even if the
+        # attributes have been renumbered.
+        block.auto_assign(1, "key_b", {"pod": "b"}, TEST_HOST)
+        assert_equal(len(block.attributes), 3)
+
+        assert_equal(block.release_by_handle("key_a"), 3)
+        assert_list_equal(block.get_ip_assignments_by_handle("key_b"),
+                          ips_b + [BLOCK_V4_1[7]])
+
+        # Compare against indexes built from the JSON.
+        result = Mock(spec=EtcdResult)
+        result.value = block.to_json()
+        block2 = AllocationBlock.from_etcd_result(result)
+        block2._ensure_indexes()
+        assert_list_equal(block._attr_ordinals, block2._attr_ordinals)
+        assert_dict_equal(block._handle_attrs, block2._handle_attrs)
+        assert_dict_equal(block._attr_keys, block2._attr_keys)
+
+    def test_release_moves_last_attributes(self):
+        """
+        Test that deleting attributes on release moves the last attributes
+        into the freed slot.
+        """
+        block = _test_block_empty_v4()
+        ips_a = block.auto_assign(2, "key_a", {}, TEST_HOST)
+        ips_b = block.auto_assign(2, "key_b", {}, TEST_HOST)
+        ips_c = block.auto_assign(2, "key_c", {}, TEST_HOST)
+
+        # Releasing one of key_a's addresses keeps its attributes.
+        block.release({ips_a[0]})
+        assert_equal(len(block.attributes), 3)
+
+        # Releasing the other moves key_c's attributes into slot 0.
+        (_, handles) = block.release({ips_a[1]})
+        assert_dict_equal(handles, {"key_a": 1})
+        assert_equal(len(block.attributes), 2)
+        assert_equal(block.attributes[0][AllocationBlock.ATTR_HANDLE_ID],
+                     "key_c")
+        assert_list_equal(block.allocations[:6],
+                          [None, None, 1, 1, 0, 0])
+        assert_list_equal(block.get_ip_assignments_by_handle("key_c"), ips_c)
+        assert_list_equal(block.get_ip_assignments_by_handle("key_b"), ips_b)
+        assert_true(block._verify_attributes())
+
+    def test_find_or_add_attrs_not_serializable(self):
+        """
+        Test attributes that can't be stored are rejected.
+        """
+        block = _test_block_empty_v4()
+        assert_raises(TypeError, block.auto_assign, 1, None,
+                      {"bad": object()}, TEST_HOST)
+        assert_equal(block.count_free_addresses(), BLOCK_SIZE)
+        assert_true(block._verify_unallocated())
+
+    @parameterized.expand([
+        (BLOCK_V4_1,),
+        (BLOCK_V6_1,),
+        (IPNetwork("10.11.0.0/24"),),
+        (IPNetwork("2001:abcd:def0::/116"),),
+    ])
+    def test_compact_round_trip(self, cidr):
+        """
+        Test blocks survive a round trip through the compact encoding.
+        """
+        block = AllocationBlock(cidr, TEST_HOST, True)
+        block.assign(cidr[40], "key1", {}, TEST_HOST)
+        block.auto_assign(3, "key_a", {"pod": u"caf\xe9", "n": [1, 2]},
+                          TEST_HOST)
+        block.auto_assign(2, None, {}, TEST_HOST)
+        block.auto_assign(1, "key_b", {}, TEST_HOST)
+        block.release({block.cidr[0], block.cidr[6]})
+
+        value = block.encode(ENCODING_COMPACT)
+        assert_true(value.startswith(COMPACT_PREFIX))
+        assert_less(len(value), len(block.encode(ENCODING_JSON)))
+
+        result = Mock(spec=EtcdResult)
+        result.value = value
+        block2 = AllocationBlock.from_etcd_result(result)
+        assert_equal(block2.to_json(), block.to_json())
+        assert_equal(block2.strict_affinity, True)
+        assert_equal(block2.host_affinity, TEST_HOST)
+
+        # And back to JSON.
+        block2.update_result(ENCODING_JSON)
+        block3 = AllocationBlock.from_etcd_result(result)
+        assert_equal(block3.to_json(), block.to_json())
+
+    def test_compact_no_affinity(self):
+        """
+        Test the compact encoding of a block without host affinity.
+        """
+        block = AllocationBlock(BLOCK_V4_1, None, False)
+        result = Mock(spec=EtcdResult)
+        result.value = block.to_compact()
+        block2 = AllocationBlock.from_etcd_result(result)
+        assert_is_none(block2.host_affinity)
+        assert_false(block2.strict_affinity)
+        assert_true(block2.is_empty())
+
+    def test_compact_bad_version(self):
+        """
+        Test reading an unsupported compact version fails.
+        """
+        result = Mock(spec=EtcdResult)
+        result.value = COMPACT_PREFIX + "99:AAAA"
+        assert_raises(BlockError, AllocationBlock.from_etcd_result, result)
+
+    def test_from_etcd_result_lazy(self):
+        """
+        Test lazily decoding a block.
+        """
+        block = _test_block_not_empty_v4()
+        block.auto_assign(3, "key2", {}, TEST_HOST)
+        for value in (block.to_json(), block.to_compact()):
+            result = Mock(spec=EtcdResult)
+            result.value = value
+            block2 = AllocationBlock.from_etcd_result(result, lazy=True)
+            assert_is_not_none(block2._pending)
+
+            # The header is available without decoding the allocations.
+            assert_equal(block2.cidr, BLOCK_V4_1)
+            assert_equal(block2.host_affinity, TEST_HOST)
+            assert_equal(block2.count_free_addresses(), BLOCK_SIZE - 5)
+            assert_false(block2.is_empty())
+            assert_is_not_none(block2._pending)
+
+            # Touching the allocations decodes them.
+            assert_list_equal(block2.get_ip_assignments_by_handle("key1"),
+                              [BLOCK_V4_1[2], BLOCK_V4_1[4]])
+            assert_is_none(block2._pending)
+            assert_equal(block2.to_json(), block.to_json())
+
+    def test_from_etcd_result_lazy_full_block(self):
+        """
+        Test auto-assigning from a full lazily decoded block doesn't decode
+        the allocations.
+        """
+        block = _test_block_empty_v4()
+        block.auto_assign(BLOCK_SIZE, None, {}, TEST_HOST)
+        result = Mock(spec=EtcdResult)
+        result.value = block.to_json()
+        block2 = AllocationBlock.from_etcd_result(result, lazy=True)
+        assert_list_equal(block2.auto_assign(1, None, {}, TEST_HOST), [])
+        assert_is_not_none(block2._pending)
+
+    def test_from_etcd_result_validation(self):
+        """
+        Test the validation levels when decoding an inconsistent block.
+        """
+        block = _test_block_not_empty_v4()
+        json_dict = json.loads(block.to_json())
+        json_dict[AllocationBlock.ALLOCATIONS][2] = 3
+        result = Mock(spec=EtcdResult)
+        result.value = json.dumps(json_dict)
+
+        assert_raises(InvalidBlockError,
+                      AllocationBlock.from_etcd_result, result)
+
+        # Lazily decoded blocks are validated when first used.
+        block2 = AllocationBlock.from_etcd_result(result, lazy=True)
+        assert_raises(InvalidBlockError, block2.to_json)
+
+        # No validation.
+        block3 = AllocationBlock.from_etcd_result(result,
+                                                  validation=VALIDATE_OFF)
+        assert_equal(block3.allocations[2], 3)
+
 
 class TestBlockFunctions(unittest.TestCase):
 
@@ -688,6 +949,38 @@ class TestBlockFunctions(unittest.TestCase):
         block_id = get_block_cidr_for_address(address)
         assert_equal(block_id, cidr)
 
+    @parameterized.expand([
+        (IPAddress("192.168.3.7"), 0, IPNetwork("192.168.3.7/32")),
+        (IPAddress("192.168.3.7"), 2, IPNetwork("192.168.3.4/30")),
+        (IPAddress("10.34.11.75"), 8, IPNetwork("10.34.11.0/24")),
+        (IPAddress("10.34.11.75"), 12, IPNetwork("10.34.0.0/20")),
+        (IPAddress("2001:abee:beef::1234"), 4,
+         IPNetwork("2001:abee:beef::1230/124")),
+    ])
+    def test_get_block_cidr_size(self, address, block_size_bits, cidr):
+        """
+        Test get_block_cidr_for_address with a non-default block size.
+        """
+        block_id = get_block_cidr_for_address(address, block_size_bits)
+        assert_equal(block_id, cidr)
+
+    def test_validate_block_size_bits(self):
+        """
+        Test validate_block_size() and validate_block_size_bits() with
+        non-default block sizes.
+        """
+        assert_true(validate_block_size(IPNetwork("1.2.3.4/28"), 4))
+        assert_false(validate_block_size(IPNetwork("1.2.3.4/29"), 4))
+        assert_true(validate_block_size(IPNetwork("1.2.0.0/20"), 12))
+        assert_false(validate_block_size(IPNetwork("1.2.0.0/21"), 12))
+
+        assert_true(validate_block_size_bits(0))
+        assert_true(validate_block_size_bits(12))
+        assert_false(validate_block_size_bits(-1))
+        assert_false(validate_block_size_bits(13))
+        assert_false(validate_block_size_bits("6"))
+        assert_false(validate_block_size_bits(True))
+
     def test_validate_block_size(self):
         """
         Test validate_block_size()
@@ -706,14 +999,9 @@ def _test_block_empty_v4():
 def _test_block_not_empty_v4():
     block = _test_block_empty_v4()
 
-    attr = {AllocationBlock.ATTR_HANDLE_ID: "key1",
-            AllocationBlock.ATTR_SECONDARY: {"key21": "value1",
-                                             "key22": "value2"}}
-    block.attributes.append(attr)
-    block.allocations[2] = 0
-    block.allocations[4] = 0
-    block.unallocated.remove(2)
-    block.unallocated.remove(4)
+    attr = {"key21": "value1", "key22": "value2"}
+    block.assign(BLOCK_V4_1[2], "key1", attr, TEST_HOST)
+    block.assign(BLOCK_V4_1[4], "key1", attr, TEST_HOST)
     return block
 
 
@@ -725,12 +1013,7 @@ def _test_block_empty_v6():
 def _test_block_not_empty_v6():
     block = _test_block_empty_v6()
 
-    attr = {AllocationBlock.ATTR_HANDLE_ID: "key1",
-            AllocationBlock.ATTR_SECONDARY: {"key21": "value1",
-                                             "key22": "value2"}}
-    block.attributes.append(attr)
-    block.allocations[2] = 0
-    block.allocations[4] = 0
-    block.unallocated.remove(2)
-    block.unallocated.remove(4)
+    attr = {"key21": "value1", "key22": "value2"}
+    block.assign(BLOCK_V6_1[2], "key1", attr, TEST_HOST)
+    block.assign(BLOCK_V6_1[4], "key1", attr, TEST_HOST)
     return block
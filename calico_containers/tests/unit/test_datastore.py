@@ -28,11 +28,13 @@ from pycalico.datastore import (DatastoreClient, CALICO_V_PATH,
                                 ETCD_SCHEME_ENV, ETCD_SCHEME_DEFAULT,
                                 ETCD_ENDPOINTS_ENV,
                                 ETCD_AUTHORITY_ENV, ETCD_CA_CERT_FILE_ENV,
-                                ETCD_CERT_FILE_ENV, ETCD_KEY_FILE_ENV)
+                                ETCD_CERT_FILE_ENV, ETCD_KEY_FILE_ENV,
+                                IPAM_CONFIG_PATH)
 from pycalico.datastore_errors import DataStoreError, ProfileNotInEndpoint, ProfileAlreadyInEndpoint, \
     MultipleEndpointsMatch, InvalidBlockSizeError
 from pycalico.datastore_datatypes import Rules, BGPPeer, IPPool, \
-    Endpoint, Profile, Rule
+    Endpoint, Profile, Rule, IPAMConfig
+from pycalico.memory_etcd import MemoryEtcdClient
 
 TEST_HOST = "TEST_HOST"
 TEST_ORCH_ID = "docker"
@@ -478,6 +480,30 @@ class TestIPPool(unittest.TestCase):
         assert_false(ippool1 == ippool6)
         assert_false(ippool1 == "This is not an IPPool")
 
+    def test_block_size_bits(self):
+        """
+        Test IPPool block size is validated and stored in the JSON only when
+        set.
+        """
+        ippool1 = IPPool("1.2.3.0/28", block_size_bits=4)
+        assert_equal(ippool1.block_size_bits, 4)
+        assert_equal(json.loads(ippool1.to_json())["block_size_bits"], 4)
+        assert_equal(IPPool.from_json(ippool1.to_json()), ippool1)
+        assert_false(ippool1 == IPPool("1.2.3.0/28", block_size_bits=3))
+
+        ippool2 = IPPool("1.2.0.0/16")
+        assert_equal(ippool2.block_size_bits, None)
+        assert_not_in("block_size_bits", json.loads(ippool2.to_json()))
+        assert_equal(IPPool.from_json(ippool2.to_json()), ippool2)
+
+        # The pool must hold at least one block of the requested size.
+        assert_raises(InvalidBlockSizeError, IPPool, "1.2.3.0/28",
+                      block_size_bits=5)
+        assert_raises(InvalidBlockSizeError, IPPool, "1.2.0.0/16",
+                      block_size_bits=13)
+        assert_raises(InvalidBlockSizeError, IPPool, "1.2.0.0/16",
+                      block_size_bits=-1)
+
     def test_contains(self):
         """
         Test IPPool "__contains__"operator.
@@ -514,6 +540,10 @@ class TestIPPool(unittest.TestCase):
         except InvalidBlockSizeError:
             self.fail("Received unexpected AddressRangeNotAllowedError")
 
+        pool = IPPool(bad_cidr2, ipam=False)
+        pool.check_block_size_bits(2)
+        assert_raises(InvalidBlockSizeError, pool.check_block_size_bits, 3)
+
 
 class TestDatastoreClient(unittest.TestCase):
 
@@ -1069,10 +1099,16 @@ class TestDatastoreClient(unittest.TestCase):
         Test adding an IP pool when the directory exists, but pool doesn't.
         :return: None
         """
-        # Return false for the IP in IP global setting.
+        # Return false for the IP in IP global setting.  There is no IPAM
+        # config and there are no blocks.
         ipip_disabled_value = Mock(EtcdResult)
         ipip_disabled_value.value = "false"
-        self.etcd_client.read.return_value = ipip_disabled_value
+
+        def m_read(path, **kwargs):
+            if path == CONFIG_PATH + "IpInIpEnabled":
+                return ipip_disabled_value
+            raise EtcdKeyNotFound()
+        self.etcd_client.read.side_effect = m_read
 
         pool = IPPool("192.168.100.5/24", ipip=True, masquerade=True)
         self.datastore.add_ip_pool(4, pool)
@@ -1096,6 +1132,21 @@ class TestDatastoreClient(unittest.TestCase):
         self.assertEqual(data, {'cidr': '192.168.100.0/24'})
         self.assertEqual(pool, IPPool.from_json(raw_data))
 
+    def test_add_ip_pool_block_size(self):
+        """
+        Test adding an IPAM pool checks the pool holds a block of the default
+        block size from the IPAM config.
+        """
+        datastore = DatastoreClient(backend=MemoryEtcdClient())
+        datastore.etcd_client.write(IPAM_CONFIG_PATH,
+                                    IPAMConfig(block_size_bits=8).to_json())
+        assert_raises(InvalidBlockSizeError, datastore.add_ip_pool, 4,
+                      IPPool("10.0.0.0/26"))
+        datastore.add_ip_pool(4, IPPool("10.0.0.0/26", ipam=False))
+        datastore.add_ip_pool(4, IPPool("10.1.0.0/24"))
+        assert_equal(datastore.get_ip_pools(4, ipam=True),
+                     [IPPool("10.1.0.0/24")])
+
     def test_add_ip_pool_key_not_found(self):
         """
         Test adding an IP pool when the directory doesn't exists.
@@ -1807,6 +1858,14 @@ class TestDatastoreClient(unittest.TestCase):
 
 class TestDatastoreClientEndpoints(unittest.TestCase):
 
+    @patch("pycalico.datastore.etcd.Client", autospec=True)
+    def test_backend(self, m_etcd_client):
+        """ Test a backend can be passed in instead of configuring etcd."""
+        backend = MemoryEtcdClient()
+        datastore = DatastoreClient(backend=backend)
+        assert_is(datastore.etcd_client, backend)
+        assert_false(m_etcd_client.called)
+
     @patch("pycalico.datastore.os.getenv", autospec=True)
     @patch("pycalico.datastore.etcd.Client", autospec=True)
     def test_endpoints_single_override(self, m_etcd_client, m_getenv):
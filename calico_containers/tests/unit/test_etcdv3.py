@@ -0,0 +1,516 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from base64 import b64decode, b64encode
+from distutils.spawn import find_executable
+import json
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import unittest
+
+from etcd import (EtcdKeyNotFound, EtcdAlreadyExist, EtcdCompareFailed,
+                  EtcdNotFile, EtcdConnectionFailed, EtcdWatchTimedOut)
+from mock import Mock, patch
+from nose.plugins.skip import SkipTest
+from nose.tools import *
+from nose_parameterized import parameterized
+from urllib3.exceptions import MaxRetryError, ReadTimeoutError
+
+from pycalico.backend import (TxnWrite, TxnDelete, current_node,
+                              compare_failed_indexes)
+from pycalico.datastore import DatastoreClient
+from pycalico.etcdv3 import Etcd3Backend
+from tests.unit.test_memory_etcd import BackendContract
+
+
+def kv(key, value, create_revision=2, mod_revision=3):
+    return {"key": b64encode(key), "value": b64encode(value),
+            "create_revision": str(create_revision),
+            "mod_revision": str(mod_revision)}
+
+
+def header(revision=10):
+    return {"header": {"revision": str(revision)}}
+
+
+class FakeEtcd3Gateway(object):
+    """
+    An in-memory stand-in for the etcd v3 JSON gateway, serving the requests
+    Etcd3Backend makes, so the backend can be tested without an etcd binary.
+    Like the gateway, it omits fields with zero values and encodes integers
+    as strings.
+    """
+
+    def __init__(self):
+        self.kvs = {}
+        self.revision = 1
+        self.events = []
+
+    def request(self, path, body, timeout=None, stream=False):
+        """
+        Replaces Etcd3Backend._request.
+        """
+        if path == "/watch":
+            return self._watch(body["create_request"])
+        handler = {"/kv/range": self._range,
+                   "/kv/put": self._put,
+                   "/kv/txn": self._txn,
+                   "/lease/grant": lambda request: {"ID": "1"}}[path]
+        self._written = False
+        response = handler(body)
+        response.update(header(self.revision))
+        return Mock(status=200, data=json.dumps(response))
+
+    def _keys(self, request):
+        key = b64decode(request["key"])
+        if "range_end" not in request:
+            return [key] if key in self.kvs else []
+        end = b64decode(request["range_end"])
+        return sorted(k for k in self.kvs if key <= k < end)
+
+    def _encode(self, key, kv, keys_only=False):
+        encoded = {"key": b64encode(key),
+                   "create_revision": str(kv["create_revision"]),
+                   "mod_revision": str(kv["mod_revision"])}
+        if kv["value"] and not keys_only:
+            encoded["value"] = b64encode(kv["value"])
+        return encoded
+
+    def _next_revision(self):
+        # All the changes made by a request share a revision.
+        if not self._written:
+            self._written = True
+            self.revision += 1
+        return self.revision
+
+    def _range(self, request):
+        keys = self._keys(request)
+        if not keys:
+            return {}
+        return {"kvs": [self._encode(key, self.kvs[key],
+                                     request.get("keys_only"))
+                        for key in keys],
+                "count": str(len(keys))}
+
+    def _put(self, request):
+        key = b64decode(request["key"])
+        prev = self.kvs.get(key)
+        revision = self._next_revision()
+        self.kvs[key] = {"value": b64decode(request.get("value", "")),
+                         "create_revision": (prev["create_revision"]
+                                             if prev else revision),
+                         "mod_revision": revision}
+        self.events.append((revision, "PUT", key,
+                            self._encode(key, self.kvs[key]), prev))
+        response = {}
+        if prev and request.get("prev_kv"):
+            response["prev_kv"] = self._encode(key, prev)
+        return response
+
+    def _delete(self, request):
+        keys = self._keys(request)
+        if not keys:
+            return {}
+        revision = self._next_revision()
+        prev_kvs = []
+        for key in keys:
+            prev = self.kvs.pop(key)
+            prev_kvs.append(self._encode(key, prev))
+            self.events.append((revision, "DELETE", key,
+                                {"key": b64encode(key),
+                                 "mod_revision": str(revision)}, prev))
+        response = {"deleted": str(len(keys))}
+        if request.get("prev_kv"):
+            response["prev_kvs"] = prev_kvs
+        return response
+
+    def _compare(self, compare):
+        kv = self.kvs.get(b64decode(compare["key"]))
+        target = compare["target"]
+        if target == "CREATE":
+            actual = kv["create_revision"] if kv else 0
+            expected = compare["create_revision"]
+        elif target == "VERSION":
+            actual = 1 if kv else 0
+            expected = compare["version"]
+        elif target == "MOD":
+            actual = kv["mod_revision"] if kv else 0
+            expected = compare["mod_revision"]
+        else:
+            actual = kv["value"] if kv else None
+            expected = b64decode(compare["value"])
+        if compare["result"] == "EQUAL":
+            return actual == expected
+        return actual > expected
+
+    def _txn(self, request):
+        succeeded = all(self._compare(compare)
+                        for compare in request.get("compare", []))
+        responses = []
+        for op in request["success" if succeeded else "failure"]:
+            if "request_range" in op:
+                responses.append(
+                    {"response_range": self._range(op["request_range"])})
+            elif "request_put" in op:
+                responses.append(
+                    {"response_put": self._put(op["request_put"])})
+            else:
+                responses.append({"response_delete_range": self._delete(
+                                            op["request_delete_range"])})
+        response = {"responses": responses}
+        if succeeded:
+            response["succeeded"] = True
+        return response
+
+    def _watch(self, create):
+        key = b64decode(create["key"])
+        end = (b64decode(create["range_end"]) if "range_end" in create
+               else None)
+        for revision, event_type, event_key, kv, prev in self.events:
+            if revision < int(create.get("start_revision", 0)):
+                continue
+            if event_key == key or (end and key <= event_key < end):
+                event = {"kv": kv}
+                if event_type == "DELETE":
+                    event["type"] = "DELETE"
+                if prev:
+                    event["prev_kv"] = self._encode(event_key, prev)
+                message = {"result": dict(header(self.revision),
+                                          events=[event])}
+                response = Mock()
+                response.stream.return_value = [json.dumps(message)]
+                return response
+        response = Mock()
+        response.stream.side_effect = ReadTimeoutError(None, None, "")
+        return response
+
+
+class TestEtcd3Backend(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = Etcd3Backend(host=(("127.0.0.1", 2379),
+                                          ("127.0.0.2", 2379)))
+        self.m_post = Mock()
+        self.backend._post = self.m_post
+
+    def test_read_key(self):
+        """
+        Test reading a key reads just that key.
+        """
+        self.m_post.return_value = dict(header(), kvs=[kv("/a", "1")])
+        result = self.backend.read("/a", quorum=True)
+        assert_equal((result.key, result.value, result.modifiedIndex,
+                      result.createdIndex, result.etcd_index),
+                     ("/a", "1", 3, 2, 10))
+        self.m_post.assert_called_once_with("/kv/range",
+                                            {"key": b64encode("/a"),
+                                             "serializable": False})
+
+    def test_read_dir(self):
+        """
+        Test reading a directory builds it from the keys under it, and only
+        reads the values of its immediate children unless it is recursive.
+        """
+        kvs = [kv("/d/", ""), kv("/d/a", "1", mod_revision=4),
+               kv("/d/e/b", "2", mod_revision=6), kv("/d/e/c", "3")]
+        self.m_post.side_effect = [
+            header(),
+            dict(header(), kvs=[dict(item, value="") for item in kvs]),
+            dict(header(), succeeded=True, responses=[
+                {"response_range": {"kvs": [kvs[1]]}}])]
+        result = self.backend.read("/d/")
+        assert_true(result.dir)
+        assert_equal(result.modifiedIndex, 6)
+        assert_equal([(child.key, child.value, child.dir, child.modifiedIndex)
+                      for child in result.children],
+                     [("/d/a", "1", False, 4), ("/d/e", None, True, 6)])
+        assert_equal(self.m_post.call_args_list[1][0][1],
+                     {"key": b64encode("/d/"), "range_end": b64encode("/d0"),
+                      "keys_only": True, "serializable": True})
+        assert_equal(self.m_post.call_args[0][1]["success"],
+                     [{"request_range": {"key": b64encode("/d/a")}}])
+
+        self.m_post.reset_mock()
+        self.m_post.side_effect = [header(), dict(header(), kvs=kvs)]
+        result = self.backend.read("/d", recursive=True)
+        assert_equal([(leaf.key, leaf.value) for leaf in result.leaves],
+                     [("/d/a", "1"), ("/d/e/b", "2"), ("/d/e/c", "3")])
+        assert_equal(self.m_post.call_count, 2)
+
+    def test_read_not_found(self):
+        """
+        Test reading a key that doesn't exist.
+        """
+        self.m_post.return_value = header()
+        assert_raises(EtcdKeyNotFound, self.backend.read, "/d")
+        assert_equal(self.m_post.call_args[0][1],
+                     {"key": b64encode("/d/"), "range_end": b64encode("/d0"),
+                      "keys_only": True, "serializable": True})
+
+    def test_write_dir(self):
+        """
+        Test creating a directory writes its marker, unless it exists.
+        """
+        self.m_post.return_value = dict(header(), succeeded=True, responses=[
+            {"response_put": {}}])
+        result = self.backend.write("/d", None, dir=True)
+        assert_equal((result.key, result.dir, result.modifiedIndex),
+                     ("/d", True, 10))
+        body = self.m_post.call_args[0][1]
+        assert_equal(body["compare"],
+                     [{"key": b64encode("/d/"), "target": "CREATE",
+                       "result": "EQUAL", "create_revision": 0}])
+        assert_equal(body["success"],
+                     [{"request_put": {"key": b64encode("/d/"),
+                                       "value": ""}}])
+
+        self.m_post.return_value = dict(header(), responses=[])
+        assert_raises(EtcdNotFile, self.backend.write, "/d", None, dir=True)
+
+    def test_write(self):
+        """
+        Test an unconditional write is a put.
+        """
+        self.m_post.return_value = dict(header(), prev_kv=kv("/a", "1"))
+        result = self.backend.write("/a", "2")
+        assert_equal((result.action, result.value, result.modifiedIndex,
+                      result.createdIndex, result._prev_node.value),
+                     ("set", "2", 10, 2, "1"))
+        self.m_post.assert_called_once_with("/kv/put",
+                                            {"key": b64encode("/a"),
+                                             "value": b64encode("2"),
+                                             "prev_kv": True})
+
+    def test_compare_and_swap(self):
+        """
+        Test a compare-and-swap write is a transaction.
+        """
+        self.m_post.return_value = dict(header(), succeeded=True, responses=[
+            {"response_put": {"prev_kv": kv("/a", "1")}}])
+        result = self.backend.write("/a", "2", prevIndex=3)
+        assert_equal(result.action, "compareAndSwap")
+        body = self.m_post.call_args[0][1]
+        assert_equal(body["compare"],
+                     [{"key": b64encode("/a"), "target": "VERSION",
+                       "result": "GREATER", "version": 0},
+                      {"key": b64encode("/a"), "target": "MOD",
+                       "result": "EQUAL", "mod_revision": 3}])
+
+    @parameterized.expand([
+        ({"prevExist": False}, [kv("/a", "1")], EtcdAlreadyExist),
+        ({"prevExist": True}, [], EtcdKeyNotFound),
+        ({"prevIndex": 2}, [], EtcdKeyNotFound),
+        ({"prevIndex": 2}, [kv("/a", "1")], EtcdCompareFailed),
+        ({"prevValue": "0"}, [kv("/a", "1")], EtcdCompareFailed),
+    ])
+    def test_compare_and_swap_failed(self, kwargs, current, error):
+        """
+        Test failed compare-and-swap writes raise the etcd v2 errors.
+        """
+        self.m_post.return_value = dict(header(), responses=[
+            {"response_range": {"kvs": current}}])
+        assert_raises(error, self.backend.write, "/a", "2", **kwargs)
+
+    def test_compare_and_swap_failed_current(self):
+        """
+        Test a failed compare-and-swap reports the current version of the
+        key.
+        """
+        self.m_post.return_value = dict(header(), responses=[
+            {"response_range": {"kvs": [kv("/a", "1", mod_revision=7)]}}])
+        with assert_raises(EtcdCompareFailed) as cm:
+            self.backend.write("/a", "2", prevIndex=5)
+        assert_equal(compare_failed_indexes(cm.exception), (5, 7))
+        node = current_node(cm.exception, "/a")
+        assert_equal((node["value"], node["modifiedIndex"]), ("1", 7))
+        assert_equal(cm.exception.payload["index"], 10)
+
+    def test_delete(self):
+        """
+        Test deleting a key, and a directory.
+        """
+        self.m_post.return_value = dict(header(), succeeded=True, responses=[
+            {"response_delete_range": {"deleted": "1",
+                                       "prev_kvs": [kv("/a", "1")]}}])
+        result = self.backend.delete("/a", prevIndex=3)
+        assert_equal((result.action, result._prev_node.value),
+                     ("delete", "1"))
+
+        self.m_post.return_value = dict(header(), succeeded=True, responses=[
+            {"response_delete_range": {}},
+            {"response_delete_range": {"deleted": "2"}}])
+        result = self.backend.delete("/d", dir=True, recursive=True)
+        assert_true(result.dir)
+        requests = self.m_post.call_args[0][1]["success"]
+        assert_equal(requests[1]["request_delete_range"],
+                     {"key": b64encode("/d/"),
+                      "range_end": b64encode("/d0")})
+
+        self.m_post.return_value = dict(header(), succeeded=True, responses=[
+            {"response_delete_range": {}}])
+        assert_raises(EtcdKeyNotFound, self.backend.delete, "/a")
+
+    def test_transaction(self):
+        """
+        Test a transaction is a single v3 transaction.
+        """
+        self.m_post.return_value = dict(header(), succeeded=True, responses=[
+            {"response_put": {}}, {"response_delete_range": {}}])
+        results = self.backend.transaction([
+            TxnWrite("/a", "1", prevExist=False), TxnDelete("/b")])
+        assert_equal([(result.action, result.modifiedIndex)
+                      for result in results],
+                     [("create", 10), ("delete", 10)])
+        body = self.m_post.call_args[0][1]
+        assert_equal(len(body["compare"]), 2)
+        assert_equal(body["success"],
+                     [{"request_put": {"key": b64encode("/a"),
+                                       "value": b64encode("1")}},
+                      {"request_delete_range": {"key": b64encode("/b")}}])
+
+        self.m_post.return_value = dict(header(), responses=[
+            {"response_range": {"kvs": [kv("/a", "2")]}}])
+        with assert_raises(EtcdCompareFailed) as cm:
+            self.backend.transaction([TxnWrite("/a", "1", prevExist=False)])
+        assert_equal(current_node(cm.exception, "/a")["value"], "2")
+        assert_equal(self.m_post.call_args[0][1]["failure"],
+                     [{"request_range": {"key": b64encode("/a")}}])
+
+    def test_watch(self):
+        """
+        Test a watch returns the first change in the stream.
+        """
+        m_response = Mock()
+        messages = [{"result": dict(header(), created=True)},
+                    {"result": dict(header(), events=[
+                        {"type": "DELETE",
+                         "kv": {"key": b64encode("/w/a"),
+                                "mod_revision": "7"},
+                         "prev_kv": kv("/w/a", "1")}])}]
+        data = "\n".join(json.dumps(message) for message in messages)
+        m_response.stream.return_value = [data[:20], data[20:]]
+        self.backend._request = Mock(return_value=m_response)
+
+        result = self.backend.watch("/w", index=5, recursive=True, timeout=1)
+        assert_equal((result.action, result.key, result.modifiedIndex,
+                      result._prev_node.value),
+                     ("delete", "/w/a", 7, "1"))
+        self.backend._request.assert_called_once_with(
+            "/watch", {"create_request": {"key": b64encode("/w"),
+                                          "range_end": b64encode("/w0"),
+                                          "start_revision": 5}},
+            timeout=1, stream=True)
+        assert_true(m_response.close.called)
+
+        m_response.stream.side_effect = ReadTimeoutError(None, None, "")
+        assert_raises(EtcdWatchTimedOut, self.backend.watch, "/w", timeout=1)
+
+    def test_failover(self):
+        """
+        Test requests fail over to the next host.
+        """
+        backend = Etcd3Backend(host=(("127.0.0.1", 2379),
+                                     ("127.0.0.2", 2379)))
+        m_response = Mock(status=200, data=json.dumps(header()))
+        backend._http = Mock()
+        backend._http.request.side_effect = [MaxRetryError(None, ""),
+                                             m_response]
+        assert_equal(backend._post("/kv/range", {}), header())
+        assert_equal(backend.hosts, [("127.0.0.2", 2379),
+                                     ("127.0.0.1", 2379)])
+        assert_equal(backend._http.request.call_args[0][1],
+                     "http://127.0.0.2:2379/v3/kv/range")
+
+        backend._http.request.side_effect = MaxRetryError(None, "")
+        assert_raises(EtcdConnectionFailed, backend._post, "/kv/range", {})
+
+
+class TestEtcd3BackendContract(BackendContract, unittest.TestCase):
+    """
+    Runs the backend tests against a fake JSON gateway.
+    """
+
+    def setUp(self):
+        self.gateway = FakeEtcd3Gateway()
+        self.client = Etcd3Backend()
+        self.client._request = self.gateway.request
+
+    def test_datastore_dirs(self):
+        """
+        Test the empty directories the datastore client creates exist.
+        """
+        datastore = DatastoreClient(backend=self.client)
+        datastore.create_host("host1", "10.0.0.1", None, None)
+        assert_true(self.client.read(
+                            "/calico/v1/host/host1/workload").dir)
+        datastore.remove_host("host1")
+        assert_raises(EtcdKeyNotFound, self.client.read,
+                      "/calico/v1/host/host1/workload")
+
+
+class TestEtcd3BackendIntegration(BackendContract, unittest.TestCase):
+    """
+    Runs the backend tests against a local etcd, if there is an etcd binary
+    on the path.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        etcd_binary = find_executable("etcd")
+        if etcd_binary is None:
+            raise SkipTest("No etcd binary")
+        client_port, peer_port = _free_port(), _free_port()
+        cls.data_dir = tempfile.mkdtemp()
+        cls.etcd = subprocess.Popen(
+            [etcd_binary, "--data-dir", cls.data_dir,
+             "--listen-client-urls", "http://127.0.0.1:%d" % client_port,
+             "--advertise-client-urls", "http://127.0.0.1:%d" % client_port,
+             "--listen-peer-urls", "http://127.0.0.1:%d" % peer_port,
+             "--initial-advertise-peer-urls",
+             "http://127.0.0.1:%d" % peer_port,
+             "--initial-cluster", "default=http://127.0.0.1:%d" % peer_port],
+            stdout=open("/dev/null", "w"), stderr=subprocess.STDOUT)
+        cls.backend = Etcd3Backend(port=client_port, read_timeout=5)
+        for _ in xrange(100):
+            try:
+                cls.backend.write("/ready", "true")
+                break
+            except EtcdConnectionFailed:
+                time.sleep(0.1)
+        else:
+            cls.tearDownClass()
+            raise AssertionError("etcd did not start")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.etcd.kill()
+        cls.etcd.wait()
+        shutil.rmtree(cls.data_dir)
+
+    def setUp(self):
+        self.client = self.backend
+        try:
+            self.client.delete("/", recursive=True)
+        except EtcdKeyNotFound:
+            pass
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
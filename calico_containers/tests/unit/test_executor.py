@@ -0,0 +1,124 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from nose.tools import *
+from mock import Mock
+import threading
+import unittest
+
+from pycalico.executor import (ClientExecutor, Future, OperationTimeout,
+                               ExecutorShutdown)
+from pycalico.ipam import IPAMClient
+from pycalico.datastore_errors import PoolNotFound
+
+
+class TestClientExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.m_client = Mock(spec=IPAMClient)
+        self.executor = ClientExecutor(self.m_client, workers=4)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_call(self):
+        """
+        Test calling a client method returns a future for its result.
+        """
+        self.m_client.auto_assign_ips.return_value = (["10.0.0.1"], [])
+        future = self.executor.auto_assign_ips(1, 0, "handle", {})
+        assert_equal(future.result(timeout=5), (["10.0.0.1"], []))
+        assert_true(future.done())
+        assert_is_none(future.exception())
+        self.m_client.auto_assign_ips.assert_called_once_with(1, 0, "handle",
+                                                              {})
+
+    def test_call_error(self):
+        """
+        Test an exception raised by a client method is raised by the future.
+        """
+        self.m_client.assign_ip.side_effect = PoolNotFound()
+        future = self.executor.assign_ip("10.0.0.1", None, {})
+        assert_raises(PoolNotFound, future.result, 5)
+        assert_is_instance(future.exception(), PoolNotFound)
+
+    def test_concurrent_calls(self):
+        """
+        Test calls run concurrently, up to the number of workers.
+        """
+        started = threading.Semaphore(0)
+        release = threading.Event()
+        # Count the calls here: Mock's call_count isn't thread safe.
+        calls = []
+        calls_lock = threading.Lock()
+
+        def m_release_ips(addresses):
+            with calls_lock:
+                calls.append(addresses)
+            started.release()
+            release.wait(5)
+            return set()
+        self.m_client.release_ips.side_effect = m_release_ips
+
+        futures = [self.executor.release_ips({i}) for i in range(6)]
+        for _ in range(4):
+            started.acquire()
+        assert_false(any(future.done() for future in futures))
+        release.set()
+        for future in futures:
+            assert_equal(future.result(timeout=5), set())
+        assert_equal(sorted(i for addresses in calls for i in addresses),
+                     range(6))
+
+    def test_timeout(self):
+        """
+        Test waiting for a future times out.
+        """
+        future = Future()
+        assert_raises(OperationTimeout, future.result, 0)
+        assert_raises(OperationTimeout, future.exception, 0)
+
+    def test_callbacks(self):
+        """
+        Test callbacks are called once the operation completes, or straight
+        away if it already has.
+        """
+        future = Future()
+        m_callback = Mock(side_effect=Exception())
+        future.add_done_callback(m_callback)
+        assert_false(m_callback.called)
+        future._complete(5, None)
+        m_callback.assert_called_once_with(future)
+
+        m_callback2 = Mock()
+        future.add_done_callback(m_callback2)
+        m_callback2.assert_called_once_with(future)
+
+    def test_private_and_attributes(self):
+        """
+        Test only public methods of the client can be called.
+        """
+        self.m_client.block_summaries = False
+        assert_raises(AttributeError, getattr, self.executor, "_read_block")
+        assert_raises(AttributeError, getattr, self.executor,
+                      "block_summaries")
+
+    def test_shutdown(self):
+        """
+        Test queued calls complete on shutdown, and later calls are rejected.
+        """
+        self.m_client.get_ipam_config.return_value = "config"
+        future = self.executor.get_ipam_config()
+        self.executor.shutdown()
+        assert_equal(future.result(timeout=0), "config")
+        assert_raises(ExecutorShutdown, self.executor.get_ipam_config)
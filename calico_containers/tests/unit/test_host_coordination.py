@@ -0,0 +1,234 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from mock import patch
+from netaddr import IPNetwork
+from nose.tools import *
+
+from pycalico.datastore_datatypes import IPPool
+from pycalico.host_coordination import HostCoordinator, SLOT_SIZE
+from pycalico.ipam import IPAMClient, _block_datastore_key
+from pycalico.memory_etcd import MemoryEtcdClient
+
+KEY = "/calico/ipam/v2/assignment/ipv4/block/10.0.0.0-26"
+
+
+class TestHostCoordinator(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.runtime_dir = os.path.join(self.tmp_dir, "ipam")
+        self.coordinator = HostCoordinator(self.runtime_dir, lock_timeout=0)
+
+    def tearDown(self):
+        self.coordinator.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lock_threads(self):
+        """
+        Test a lease excludes other threads until it is released, and leases
+        for other hosts and versions are independent.
+        """
+        results = []
+
+        def try_lock(host, *versions):
+            with self.coordinator.lock(host, *versions) as acquired:
+                results.append(acquired)
+
+        def try_lock_in_thread(host, *versions):
+            thread = threading.Thread(target=try_lock, args=(host,) + versions)
+            thread.start()
+            thread.join()
+            return results.pop()
+
+        with self.coordinator.lock("host/1", 4) as acquired:
+            assert_true(acquired)
+            assert_false(try_lock_in_thread("host/1", 4))
+            assert_false(try_lock_in_thread("host/1", 6, 4))
+            assert_true(try_lock_in_thread("host/1", 6))
+            assert_true(try_lock_in_thread("host2", 4))
+        assert_true(try_lock_in_thread("host/1", 4, 6))
+        assert_equal(sorted(os.listdir(self.runtime_dir)),
+                     ["blocks", "host%2F1-v4.lock", "host%2F1-v6.lock",
+                      "host2-v4.lock"])
+
+    def test_lock_processes(self):
+        """
+        Test a lease excludes other processes, and is released when the
+        process holding it exits.
+        """
+        code = ("import sys; from pycalico.host_coordination import "
+                "HostCoordinator; c = HostCoordinator(sys.argv[1], 0); "
+                "l = c.lock('host1', 4); print(l.__enter__()); "
+                "sys.stdout.flush(); sys.stdin.read()")
+        with self.coordinator.lock("host1", 4):
+            process = subprocess.Popen(
+                            [sys.executable, "-c", code, self.runtime_dir],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            output, _ = process.communicate("")
+            assert_equal(output.strip(), "False")
+
+        # The other process exits while holding the lease.
+        process = subprocess.Popen(
+                            [sys.executable, "-c", code, self.runtime_dir],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        assert_equal(process.stdout.readline().strip(), "True")
+        with self.coordinator.lock("host1", 4) as acquired:
+            assert_false(acquired)
+        process.communicate("")
+        with self.coordinator.lock("host1", 4) as acquired:
+            assert_true(acquired)
+
+    def test_publish(self):
+        """
+        Test published blocks are seen by other coordinators, and aren't
+        replaced by older versions.
+        """
+        other = HostCoordinator(self.runtime_dir)
+        assert_is_none(other.lookup(KEY))
+        self.coordinator.publish(KEY, u"value", 5)
+        assert_equal(other.lookup(KEY), ("value", 5))
+        other.publish(KEY, "older", 4)
+        assert_equal(self.coordinator.lookup(KEY), ("value", 5))
+        other.publish(KEY, "newer", 7)
+        assert_equal(self.coordinator.lookup(KEY), ("newer", 7))
+
+        # Blocks too large for a slot are unpublished.
+        other.publish(KEY, "x" * SLOT_SIZE, 8)
+        assert_is_none(self.coordinator.lookup(KEY))
+
+        self.coordinator.publish(KEY, "value", 9)
+        self.coordinator.unpublish(KEY)
+        assert_is_none(other.lookup(KEY))
+        other.close()
+
+    def test_publish_collision(self):
+        """
+        Test a block replaces another published in the same slot, which is
+        then no longer found.
+        """
+        other_key = KEY + "-other"
+        with patch("pycalico.host_coordination.NUM_SLOTS", 1):
+            self.coordinator.publish(KEY, "value", 5)
+            self.coordinator.publish(other_key, "other", 3)
+            assert_is_none(self.coordinator.lookup(KEY))
+            assert_equal(self.coordinator.lookup(other_key), ("other", 3))
+            self.coordinator.unpublish(KEY)
+            assert_equal(self.coordinator.lookup(other_key), ("other", 3))
+
+
+class TestIPAMHostCoordination(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.etcd = MemoryEtcdClient()
+        self.clients = [IPAMClient(backend=self.etcd,
+                                   host_coordinator=HostCoordinator(
+                                                            self.tmp_dir))
+                        for _ in range(2)]
+        self.clients[0].add_ip_pool(4, IPPool(IPNetwork("10.0.0.0/24")))
+        self.clients[0].add_ip_pool(6, IPPool(IPNetwork("fd00::/120")))
+
+    def tearDown(self):
+        for client in self.clients:
+            client.host_coordinator.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def reads(self, client, *args):
+        self.etcd.reset_round_trips()
+        result = client.auto_assign_ips(*args)
+        return result, self.etcd.round_trips().get("read", 0)
+
+    def test_published_blocks(self):
+        """
+        Test a client writes a block published by another client on the host
+        without reading it, and recovers if the published version is out of
+        date.
+        """
+        first, second = self.clients
+        uncoordinated = IPAMClient(backend=self.etcd)
+        v4, _ = first.auto_assign_ips(1, 0, None, {}, host="host1")
+        block_key = _block_datastore_key(IPNetwork("%s/26" % v4[0]).cidr)
+        assert_equal(second.host_coordinator.lookup(block_key)[1],
+                     self.etcd.read(block_key).modifiedIndex)
+
+        (v4_2, _), coordinated_reads = self.reads(second, 1, 0, None, {},
+                                                  (None, None), "host1")
+        (v4_3, _), reads = self.reads(uncoordinated, 1, 0, None, {},
+                                      (None, None), "host1")
+        assert_equal(coordinated_reads, reads - 1)
+
+        # The uncoordinated client's write wasn't published, so the next
+        # compare-and-swap against the published version fails.
+        v4_4, _ = first.auto_assign_ips(1, 0, None, {}, host="host1")
+        assert_equal(len(set(v4 + v4_2 + v4_3 + v4_4)), 4)
+        assert_equal(first.host_coordinator.lookup(block_key)[1],
+                     self.etcd.read(block_key).modifiedIndex)
+
+    def test_concurrent_clients(self):
+        """
+        Test clients assigning concurrently on one host, each with its own
+        coordinator, assign distinct addresses from a single block of each
+        version.
+        """
+        results = []
+
+        def assign(client):
+            for _ in range(5):
+                v4, v6 = client.auto_assign_ips(1, 1, None, {}, host="host1")
+                results.extend(v4 + v6)
+
+        threads = [threading.Thread(target=assign, args=(client,))
+                   for client in self.clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(len(set(results)), 20)
+        assert_equal(len(self.clients[0].get_ip_pools(4, ipam=True)), 1)
+        blocks = self.etcd.read("/calico/ipam/v2/assignment",
+                                recursive=True).leaves
+        assert_equal(len([leaf for leaf in blocks if "/block/" in leaf.key]),
+                     2)
+
+    def test_release_unpublishes(self):
+        """
+        Test deleting a block unpublishes it.
+        """
+        client = self.clients[0]
+        v4, _ = client.auto_assign_ips(1, 0, None, {}, host="host1")
+        block_key = _block_datastore_key(IPNetwork("%s/26" % v4[0]).cidr)
+        assert_is_not_none(client.host_coordinator.lookup(block_key))
+        client.release_ips(set(v4))
+        client.release_host_affinities("host1")
+        assert_is_none(client.host_coordinator.lookup(block_key))
+
+    def test_lease_per_version(self):
+        """
+        Test assigning one version doesn't take the other version's lease.
+        """
+        client, other = self.clients
+        with other.host_coordinator.lock("host1", 4):
+            with patch.object(client.host_coordinator, "lock",
+                              wraps=client.host_coordinator.lock) as m_lock:
+                _, v6 = client.auto_assign_ips(0, 1, None, {}, host="host1")
+        assert_equal(len(v6), 1)
+        m_lock.assert_called_once_with("host1", 6)
@@ -16,20 +16,32 @@ import copy
 from netaddr import IPNetwork, IPAddress
 from nose.tools import *
 from mock import patch, ANY, call, Mock
+from nose_parameterized import parameterized
 import unittest
+import hashlib
+import threading
 import json
-from etcd import EtcdResult, Client, EtcdAlreadyExist, EtcdKeyNotFound, EtcdCompareFailed
+from etcd import EtcdResult, Client, EtcdAlreadyExist, EtcdKeyNotFound, EtcdCompareFailed, EtcdEventIndexCleared
 
 from pycalico.ipam import (IPAMClient, BlockHandleReaderWriter,
                            CASError, NoFreeBlocksError, _block_datastore_key,
+                           _block_host_key, ATTRIBUTES_REF, SUMMARY_FREE,
+                           SUMMARY_GENERATION,
                            _handle_datastore_key, HostAffinityClaimedError,
                            IPAMConfigConflictError, _random_subnets_from_cidr,
-                           _random_subnets_from_cidrs)
+                           _random_subnets_from_cidrs, _HandleUpdates,
+                           CONSISTENCY_SERIALIZABLE, CONFLICT_WATCH_TIMEOUT,
+                           BatchAssignment)
 from pycalico.datastore_errors import PoolNotFound, InvalidBlockSizeError
-from pycalico.block import AllocationBlock, AddressNotAssignedError, BLOCK_SIZE
+from pycalico.block import (AllocationBlock, AddressNotAssignedError,
+                            BLOCK_SIZE, BLOCK_SIZE_BITS, ENCODING_COMPACT,
+                            COMPACT_PREFIX)
+from pycalico.backend import compare_failed
 from pycalico.handle import AllocationHandle, AddressCountTooLow
 from pycalico.datastore import IPAM_CONFIG_PATH
 from pycalico.datastore_datatypes import IPPool, IPAMConfig
+from pycalico.memory_etcd import MemoryEtcdClient
+from pycalico.retry import RetryPolicy
 from tests.unit.test_block import (_test_block_empty_v4, _test_block_empty_v6,
                          BLOCK_V6_1, BLOCK_V4_1, _test_block_not_empty_v4)
 from tests.unit.test_block import BLOCK_V4_1
@@ -46,11 +58,28 @@ def gen_subnets(cidrs, prefixlen, seed=None):
     easier UT.
     """
     hash(seed)  # Seed should be hashable.
-    for cidr in cidrs:
-        for subnet in cidr.subnet(prefixlen):
+    if isinstance(prefixlen, int):
+        prefixlen = [prefixlen] * len(cidrs)
+    for cidr, length in zip(cidrs, prefixlen):
+        for subnet in cidr.subnet(length):
             yield subnet
 
 
+def block_listing(block_cidrs):
+    """
+    Mock result for a recursive read of the blocks directory, listing the
+    given blocks.
+    """
+    leaves = []
+    for block_cidr in block_cidrs:
+        leaf = Mock(spec=EtcdResult)
+        leaf.key = _block_datastore_key(block_cidr)
+        leaves.append(leaf)
+    result = Mock(spec=EtcdResult)
+    result.leaves = iter(leaves)
+    return result
+
+
 class TestIPAMClient(unittest.TestCase):
 
     def setUp(self):
@@ -62,13 +91,19 @@ class TestIPAMClient(unittest.TestCase):
         # out the get_ipam_config() method,
         self.client.get_ipam_config = Mock(return_value=IPAMConfig())
 
+        # Likewise, most tests use pools with the default block size.
+        self.client._get_pool_block_size_bits = Mock(return_value=None)
+
+        # Retry compare-and-swap failures immediately.
+        self.client.retry_policy = RetryPolicy(initial_delay=0)
+
     @patch("pycalico.ipam.get_hostname", return_value=TEST_HOST)
     def test_auto_assign(self, m_get_hostname):
         """
         Mainline test of auto assign.
         """
 
-        def m_get_affine_blocks(self, host, ip_version, pool):
+        def m_get_affine_blocks(self, host, ip_version, pool, summaries=None):
             return [BLOCK_V4_1,
                     BLOCK_V4_2]
 
@@ -87,37 +122,62 @@ class TestIPAMClient(unittest.TestCase):
         Test of auto assign with both IPv4 and IPv6 requests.
         """
 
-        def m_get_affine_blocks(self, host, ip_version, pool):
-            assert ip_version in [4, 6]
-            if ip_version == 4:
-                return [BLOCK_V4_1,
-                        BLOCK_V4_2]
-            else:
-                return [IPNetwork("2001:abcd:def0::/122"),
-                        IPNetwork("2001:abcd:def0::4500/122")]
+        def m_get_host_affine_blocks(self, host, pool):
+            assert_equal(pool, (None, None))
+            return {4: ([BLOCK_V4_1, BLOCK_V4_2], {}),
+                    6: ([IPNetwork("2001:abcd:def0::/122"),
+                         IPNetwork("2001:abcd:def0::4500/122")], {})}
 
-        block0 = _test_block_empty_v4()
-        m_result0 = Mock(spec=EtcdResult)
-        m_result0.value = block0.to_json()
-        block1 = _test_block_empty_v6()
-        m_result1 = Mock(spec=EtcdResult)
-        m_result1.value = block1.to_json()
-        self.m_etcd_client.read.side_effect = [m_result0, m_result1]
+        blocks = {BLOCK_V4_1: _test_block_empty_v4(),
+                  BLOCK_V6_1: _test_block_empty_v6()}
 
-        with patch("pycalico.ipam.BlockHandleReaderWriter._get_affine_blocks",
-                   m_get_affine_blocks):
+        def m_read_block(self, block_cidr):
+            # The versions are assigned concurrently, so key the reads by
+            # block.
+            result = Mock(spec=EtcdResult)
+            result.value = blocks[block_cidr].to_json()
+            return AllocationBlock.from_etcd_result(result)
+
+        with patch("pycalico.ipam.BlockHandleReaderWriter."
+                   "_get_host_affine_blocks", m_get_host_affine_blocks), \
+                patch("pycalico.ipam.BlockHandleReaderWriter._read_block",
+                      m_read_block):
             (ipv4s, ipv6s) = self.client.auto_assign_ips(1, 2, None, {},
                                                          host=TEST_HOST)
             assert_list_equal([IPAddress("10.11.12.0")], ipv4s)
             assert_list_equal([IPAddress("2001:abcd:def0::"),
                                IPAddress("2001:abcd:def0::1")], ipv6s)
 
+    @parameterized.expand([(4,), (6,)])
+    def test_auto_assign_dual_error(self, failed_version):
+        """
+        Test an error auto assigning either version is raised once both
+        versions are done.
+        """
+        done = []
+
+        def m_auto_assign(ip_version, num, handle_id, attributes, pool, host,
+                          affine_blocks):
+            assert_equal(affine_blocks, ([], {}))
+            done.append(ip_version)
+            if ip_version == failed_version:
+                raise NoFreeBlocksError()
+            return [IPAddress(1, ip_version)] * num
+        self.client._auto_assign = m_auto_assign
+        self.client._get_host_affine_blocks = Mock(
+                                        return_value={4: ([], {}),
+                                                      6: ([], {})})
+
+        assert_raises(NoFreeBlocksError, self.client.auto_assign_ips,
+                      1, 2, None, {}, host=TEST_HOST)
+        assert_list_equal(sorted(done), [4, 6])
+
     def test_auto_assign_1st_block_full(self):
         """
         Test auto assign when 1st block is full.
         """
 
-        def m_get_affine_blocks(self, host, ip_version, pool):
+        def m_get_affine_blocks(self, host, ip_version, pool, summaries=None):
             return [BLOCK_V4_1, BLOCK_V4_2]
 
         block0 = _test_block_empty_v4()
@@ -142,7 +202,7 @@ class TestIPAMClient(unittest.TestCase):
         Test auto assign when 1st block has fewer than requested addresses.
         """
 
-        def m_get_affine_blocks(self, host, ip_version, pool):
+        def m_get_affine_blocks(self, host, ip_version, pool, summaries=None):
             return [BLOCK_V4_1, BLOCK_V4_2]
 
         # 1st block has 2 free addresses.
@@ -174,7 +234,7 @@ class TestIPAMClient(unittest.TestCase):
         blocks.
         """
 
-        def m_get_affine_blocks(self, host, ip_version, pool):
+        def m_get_affine_blocks(self, host, ip_version, pool, summaries=None):
             return [BLOCK_V4_1, BLOCK_V4_2]
 
         def m_get_ip_pools(self, version, ipam, include_disabled):
@@ -197,11 +257,11 @@ class TestIPAMClient(unittest.TestCase):
         m_result1 = Mock(spec=EtcdResult)
         m_result1.value = block1.to_json()
 
-        # Total of 4 reads: first two are checking blocks with affinity
-        # second two are trying to find free blocks in the pool (but there
+        # Total of 3 reads: first two are checking blocks with affinity, the
+        # third lists the blocks to find free blocks in the pool (but there
         # aren't any).
-        self.m_etcd_client.read.side_effect = [m_result0, m_result1,
-                                               m_result0, m_result1]
+        self.m_etcd_client.read.side_effect = [
+            m_result0, m_result1, block_listing([BLOCK_V4_1, BLOCK_V4_2])]
 
         with patch("pycalico.ipam.BlockHandleReaderWriter._get_affine_blocks",
                    m_get_affine_blocks),\
@@ -218,7 +278,7 @@ class TestIPAMClient(unittest.TestCase):
         Test auto assign when 1st block compare-and-swap fails.
         """
 
-        def m_get_affine_blocks(self, host, ip_version, pool):
+        def m_get_affine_blocks(self, host, ip_version, pool, summaries=None):
             return [BLOCK_V4_1, BLOCK_V4_2]
 
         # 1st read, 1st block has 2 free addresses.
@@ -257,7 +317,7 @@ class TestIPAMClient(unittest.TestCase):
         Test of auto assign with an existing handle, and transient CAS errors.
         """
 
-        def m_get_affine_blocks(self, host, ip_version, pool):
+        def m_get_affine_blocks(self, host, ip_version, pool, summaries=None):
             return [BLOCK_V4_1,
                     BLOCK_V4_2]
 
@@ -322,7 +382,7 @@ class TestIPAMClient(unittest.TestCase):
         Test of auto assign with persistent CAS errors.
         """
 
-        def m_get_affine_blocks(self, host, ip_version, pool):
+        def m_get_affine_blocks(self, host, ip_version, pool, summaries=None):
             return [BLOCK_V4_1,
                     BLOCK_V4_2]
 
@@ -357,7 +417,7 @@ class TestIPAMClient(unittest.TestCase):
             5 CAS update with allocated ips.
         """
 
-        def m_get_affine_blocks(self, host, ip_version, pool):
+        def m_get_affine_blocks(self, host, ip_version, pool, summaries=None):
             return []
 
         def m_get_ip_pools(self, version, ipam, include_disabled):
@@ -393,7 +453,7 @@ class TestIPAMClient(unittest.TestCase):
         affine_blocks = [BLOCK_V4_1,
                          BLOCK_V4_2]
 
-        def m_get_affine_blocks(self, host, ip_version, pool):
+        def m_get_affine_blocks(self, host, ip_version, pool, summaries=None):
             return affine_blocks
 
         rando_blocks = set()
@@ -414,6 +474,10 @@ class TestIPAMClient(unittest.TestCase):
             assert not include_disabled
             return [IPPool("10.11.0.0/18")]
 
+        # All blocks already exist.
+        self.m_etcd_client.read.return_value = block_listing(
+                                        IPNetwork("10.11.0.0/18").subnet(26))
+
         with patch("pycalico.ipam.BlockHandleReaderWriter._get_affine_blocks",
                    m_get_affine_blocks),\
              patch("pycalico.datastore.DatastoreClient.get_ip_pools",
@@ -474,7 +538,7 @@ class TestIPAMClient(unittest.TestCase):
                          BLOCK_V4_2,
                          BLOCK_V4_3]
 
-        def m_get_affine_blocks(self, host, ip_version, pool):
+        def m_get_affine_blocks(self, host, ip_version, pool, summaries=None):
             return affine_blocks
 
         def m_read_block(self, block_cidr):
@@ -521,7 +585,7 @@ class TestIPAMClient(unittest.TestCase):
 
         affine_blocks = [BLOCK_V4_1]
 
-        def m_get_affine_blocks(self, host, ip_version, pool):
+        def m_get_affine_blocks(self, host, ip_version, pool, summaries=None):
             return affine_blocks
 
         # 4 attempts to read BLOCK_V4_1, then one attempt to read
@@ -695,7 +759,7 @@ class TestIPAMClient(unittest.TestCase):
 
         def m_get_ip_pools(self, version, ipam, include_disabled):
             assert ipam
-            assert not include_disabled
+            assert include_disabled
             return [IPPool("10.11.0.0/16"), IPPool("192.168.0.0/16")]
 
         # 1st read, doesn't exist.  2nd read, does exist, empty.
@@ -740,7 +804,7 @@ class TestIPAMClient(unittest.TestCase):
 
         def m_get_ip_pools(self, version, ipam, include_disabled):
             assert ipam
-            assert not include_disabled
+            assert include_disabled
             return [IPPool("10.11.0.0/16"), IPPool("192.168.0.0/16")]
 
         # 2nd read.
@@ -775,8 +839,9 @@ class TestIPAMClient(unittest.TestCase):
 
         def m_get_ip_pools(self, version, ipam, include_disabled):
             assert ipam
-            assert not include_disabled
-            return [IPPool("10.11.0.0/16"), IPPool("192.168.0.0/16")]
+            assert include_disabled
+            return [IPPool("10.11.0.0/16"), IPPool("192.168.0.0/16"),
+                    IPPool("10.12.0.0/16", disabled=True)]
 
         # block doesn't exist.
         self.m_etcd_client.read.side_effect = EtcdKeyNotFound()
@@ -822,6 +887,52 @@ class TestIPAMClient(unittest.TestCase):
                                                     call(m_result6)],
                                                    any_order=True)
 
+    @parameterized.expand([(1,), (3,)])
+    def test_release_ips_handles(self, parallelism):
+        """
+        Test release_ips() decrements each handle once for all the blocks it
+        had addresses released from, and a failure releasing one block
+        doesn't stop the others being released.
+        """
+        blocks = [IPNetwork("10.11.0.0/26"), IPNetwork("10.11.0.64/26"),
+                  IPNetwork("10.11.0.128/26"), IPNetwork("10.11.0.192/26")]
+        handles = {blocks[0]: "h1", blocks[1]: "h1", blocks[2]: "h2"}
+
+        def m_read_block(self, block_cidr):
+            if block_cidr == blocks[3]:
+                raise RuntimeError()
+            block = AllocationBlock(block_cidr, TEST_HOST, False)
+            block.assign(block_cidr[1], handles[block_cidr], {}, TEST_HOST)
+            block.assign(block_cidr[2], None, {}, TEST_HOST)
+            block.db_result = Mock(spec=EtcdResult)
+            return block
+
+        # Record the calls here: Mock's call recording isn't thread safe.
+        updates = []
+        handle_updates = []
+        calls_lock = threading.Lock()
+
+        def m_update(db_result):
+            with calls_lock:
+                updates.append(db_result)
+
+        def m_update_handle_blocks(handle_id, deltas):
+            with calls_lock:
+                handle_updates.append((handle_id, deltas))
+
+        self.m_etcd_client.update.side_effect = m_update
+        self.client._update_handle_blocks = m_update_handle_blocks
+        ips = set(block_cidr[i] for block_cidr in blocks for i in (1, 2))
+        with patch("pycalico.ipam.BlockHandleReaderWriter._read_block",
+                   m_read_block):
+            assert_raises(RuntimeError, self.client.release_ips, ips,
+                          parallelism=parallelism)
+
+        assert_equal(len(updates), 3)
+        assert_equal(sorted(handle_updates),
+                     sorted([("h1", {blocks[0]: -1, blocks[1]: -1}),
+                             ("h2", {blocks[2]: -1})]))
+
     def test_release_no_affinity(self):
         """
         Test release of an IP from a block with no affinity.
@@ -894,6 +1005,8 @@ class TestIPAMClient(unittest.TestCase):
                 return block6
             assert_true(False, "Unexpected block CIDR")
 
+        # No blocks are stored either.
+        self.m_etcd_client.read.side_effect = EtcdKeyNotFound()
         with patch("pycalico.ipam.BlockHandleReaderWriter._read_block",
                    m_read_block):
             ips = {ip4, ip6}
@@ -1088,9 +1201,9 @@ class TestIPAMClient(unittest.TestCase):
         self.m_etcd_client.read.side_effect = read
 
         # Mock out update, so we can fail the first one.  We should then get
-        # a successful update for the block, an update for the handle, an
-        # update for the next block.  The handle is then deleted.
-        update_errors = [EtcdCompareFailed(), None, None, None]
+        # a successful update for the block and an update for the next block.
+        # The handle is then deleted.
+        update_errors = [EtcdCompareFailed(), None, None]
 
         def update(result):
             error = update_errors.pop(0)
@@ -1209,8 +1322,9 @@ class TestIPAMClient(unittest.TestCase):
         handle0.increment_block(cidr4, 5)
         handle0.increment_block(cidr6, 3)
 
-        def m_read_handle(_self, handle_id):
+        def m_read_handle(_self, handle_id, quorum=False):
             assert_equal(handle_id0, handle_id)
+            assert_true(quorum)
             return handle0
 
         with patch("pycalico.ipam.BlockHandleReaderWriter._read_block",
@@ -1253,6 +1367,8 @@ class TestIPAMClient(unittest.TestCase):
                 return block6
             raise KeyError(str(block_cidr))
 
+        self.m_etcd_client.read.return_value = block_listing([block4.cidr,
+                                                              block6.cidr])
         with patch("pycalico.ipam.BlockHandleReaderWriter._read_block",
                    m_read_block):
             attr = self.client.get_assignment_attributes(ip4)
@@ -1264,6 +1380,316 @@ class TestIPAMClient(unittest.TestCase):
                           self.client.get_assignment_attributes,
                           IPAddress("10.11.13.13"))
 
+    def test_auto_assign_ips_in_block_cached_full(self):
+        """
+        Test a full block in the block cache is confirmed against the
+        datastore before giving up on it.
+        """
+        self.client.cache_blocks = True
+        full_block = _test_block_empty_v4()
+        full_block.auto_assign(BLOCK_SIZE, None, {}, TEST_HOST)
+        self.client._cache_block(BLOCK_V4_1, full_block.to_json(), 3)
+
+        result = Mock(spec=EtcdResult)
+        result.value = _test_block_not_empty_v4().to_json()
+        result.modifiedIndex = 4
+        self.m_etcd_client.read.return_value = result
+        self.m_etcd_client.update.return_value = result
+
+        ips = self.client._auto_assign_ips_in_block(BLOCK_V4_1, 1, None, {},
+                                                    TEST_HOST)
+        assert_equal(ips, [BLOCK_V4_1[0]])
+        self.m_etcd_client.read.assert_called_once_with(
+                                _block_datastore_key(BLOCK_V4_1), quorum=True)
+        assert_equal(self.m_etcd_client.update.call_count, 1)
+
+    @patch("pycalico.ipam.get_hostname", return_value=TEST_HOST)
+    def test_auto_assign_ips_batch(self, m_get_hostname):
+        """
+        Test a batch of requests is assigned from a block with a single CAS,
+        and each handle is incremented once.
+        """
+        def m_get_affine_blocks(self, host, ip_version, pool, summaries=None):
+            return [BLOCK_V4_1]
+
+        m_result = Mock(spec=EtcdResult)
+        m_result.value = _test_block_empty_v4().to_json()
+        self.m_etcd_client.read.return_value = m_result
+        self.client._increment_handle = Mock()
+
+        requests = [("h1", {"pod": "a"}, 2, 0),
+                    ("h2", {"pod": "b"}, 1, 0),
+                    ("h1", {"pod": "a"}, 1, 0)]
+        with patch("pycalico.ipam.BlockHandleReaderWriter._get_affine_blocks",
+                   m_get_affine_blocks):
+            results = self.client.auto_assign_ips_batch(requests)
+
+        assert_list_equal([(len(v4), len(v6)) for v4, v6 in results],
+                          [(2, 0), (1, 0), (1, 0)])
+        ips = set(ip for v4, _ in results for ip in v4)
+        assert_equal(len(ips), 4)
+        assert_true(all(ip in BLOCK_V4_1 for ip in ips))
+        self.m_etcd_client.update.assert_called_once_with(m_result)
+        assert_equal(self.client._increment_handle.call_count, 2)
+        self.client._increment_handle.assert_has_calls(
+                                            [call("h1", BLOCK_V4_1, 3),
+                                             call("h2", BLOCK_V4_1, 1)],
+                                            any_order=True)
+
+    def test_auto_assign_ips_batch_partial(self):
+        """
+        Test requests are satisfied in order when there are too few addresses.
+        """
+        def m_get_affine_blocks(self, host, ip_version, pool, summaries=None):
+            return [BLOCK_V4_1]
+
+        block = _test_block_empty_v4()
+        block.auto_assign(BLOCK_SIZE - 3, None, {}, TEST_HOST)
+        m_result = Mock(spec=EtcdResult)
+        m_result.value = block.to_json()
+        self.m_etcd_client.read.return_value = m_result
+        self.client.get_ipam_config.return_value = IPAMConfig(
+                                                    auto_allocate_blocks=False,
+                                                    strict_affinity=True)
+
+        requests = [(None, {}, 2, 0), (None, {}, 2, 0), (None, {}, 1, 0)]
+        with patch("pycalico.ipam.BlockHandleReaderWriter._get_affine_blocks",
+                   m_get_affine_blocks):
+            results = self.client.auto_assign_ips_batch(requests,
+                                                        host=TEST_HOST)
+
+        assert_list_equal([len(v4) for v4, _ in results], [2, 1, 0])
+        assert_list_equal([r.shortfall for r in results],
+                          [(0, 0), (1, 0), (1, 0)])
+        assert_equal(self.m_etcd_client.update.call_count, 1)
+
+    def test_auto_assign_ips_batch_invalid(self):
+        """
+        Test a request with invalid input fails on its own, without failing
+        the rest of the batch.
+        """
+        def m_get_affine_blocks(self, host, ip_version, pool, summaries=None):
+            return [BLOCK_V4_1]
+
+        m_result = Mock(spec=EtcdResult)
+        m_result.value = _test_block_empty_v4().to_json()
+        self.m_etcd_client.read.return_value = m_result
+
+        requests = [("h1", {"a": object()}, 1, 0),
+                    ("h2", {}, 1, 0),
+                    (5, {}, 1, 0)]
+        with patch("pycalico.ipam.BlockHandleReaderWriter._get_affine_blocks",
+                   m_get_affine_blocks):
+            results = self.client.auto_assign_ips_batch(requests,
+                                                        host=TEST_HOST)
+
+        assert_is_instance(results[0].error, TypeError)
+        assert_equal(results[0].v4_addresses, [])
+        assert_is_none(results[1].error)
+        assert_equal(len(results[1].v4_addresses), 1)
+        assert_equal(results[1].shortfall, (0, 0))
+        assert_is_instance(results[2].error, TypeError)
+
+    def test_auto_assign_ips_in_block_retry_stats(self):
+        """
+        Test CAS failures are retried according to the retry policy, and
+        recorded against the block key.
+        """
+        m_result = Mock(spec=EtcdResult)
+        m_result.value = _test_block_empty_v4().to_json()
+        self.m_etcd_client.read.return_value = m_result
+        self.m_etcd_client.update.side_effect = [EtcdCompareFailed(),
+                                                 EtcdCompareFailed(), None]
+
+        ips = self.client._auto_assign_ips_in_block(BLOCK_V4_1, 1, None, {},
+                                                    TEST_HOST)
+        assert_equal(len(ips), 1)
+        stats = self.client.retry_policy.stats()
+        assert_dict_equal(stats["retries"],
+                          {_block_datastore_key(BLOCK_V4_1): 2})
+        assert_dict_equal(stats["attempts"], {3: 1})
+
+        # Running out of attempts fails the operation.
+        self.client.retry_policy = RetryPolicy(retries=2, initial_delay=0)
+        self.m_etcd_client.update.side_effect = EtcdCompareFailed()
+        assert_raises(RuntimeError, self.client._auto_assign_ips_in_block,
+                      BLOCK_V4_1, 1, None, {}, TEST_HOST)
+        assert_equal(self.client.retry_policy.stats()["exhausted"], 1)
+
+    def test_auto_assign_ips_in_block_transaction(self):
+        """
+        Test the block and the handle are written in one transaction when
+        the backend supports transactions, and retried together.
+        """
+        self.client.etcd_client = Mock(spec=MemoryEtcdClient)
+        m_result = Mock(spec=EtcdResult)
+        m_result.value = _test_block_empty_v4().to_json()
+        self.client.etcd_client.read.return_value = m_result
+        self.client._compare_and_swap_block_and_handles = Mock(
+            side_effect=[CASError(), None])
+        self.client._increment_handle = Mock()
+
+        ips = self.client._auto_assign_ips_in_block(BLOCK_V4_1, 2, "h1", {},
+                                                    TEST_HOST)
+        assert_equal(len(ips), 2)
+        calls = self.client._compare_and_swap_block_and_handles.call_args_list
+        assert_equal(len(calls), 2)
+        assert_dict_equal(calls[1][0][1], {"h1": 2})
+        assert_false(self.client._increment_handle.called)
+
+    def test_auto_assign_batch_in_block_cas_error(self):
+        """
+        Test handle increments are undone and the block is re-read when the
+        block CAS fails.
+        """
+        m_result0 = Mock(spec=EtcdResult)
+        m_result0.value = _test_block_empty_v4().to_json()
+        m_result1 = Mock(spec=EtcdResult)
+        m_result1.value = _test_block_not_empty_v4().to_json()
+        self.m_etcd_client.read.side_effect = [m_result0, m_result1]
+        self.m_etcd_client.update.side_effect = [EtcdCompareFailed(), None]
+        self.client._increment_handle = Mock()
+        self.client._decrement_handle = Mock()
+
+        allocated = {0: [], 1: [IPAddress("10.11.12.60")]}
+        wanted = [(0, "h1", {}, 3), (1, "h2", {}, 2)]
+        self.client._auto_assign_batch_in_block(BLOCK_V4_1, wanted,
+                                                allocated, TEST_HOST)
+
+        assert_equal(len(allocated[0]), 3)
+        assert_equal(len(allocated[1]), 2)
+        self.client._decrement_handle.assert_has_calls(
+                                            [call("h1", BLOCK_V4_1, 3),
+                                             call("h2", BLOCK_V4_1, 1)],
+                                            any_order=True)
+        assert_equal(self.client._increment_handle.call_count, 4)
+        self.m_etcd_client.update.assert_called_with(m_result1)
+
+    def test_auto_assign_ips_grouped(self):
+        """
+        Test concurrent auto_assign_ips() calls are assigned with a single
+        batch when group commit is enabled, and the results are passed back
+        to each caller.
+        """
+        self.client.group_commit_window = 0.01
+        key = (TEST_HOST, (None, None))
+
+        def m_sleep(secs):
+            assert_equal(secs, 0.01)
+            # Wait for all the requests to join the group.
+            while len(self.client._groups[key].requests) < 3:
+                threading.Event().wait(0.001)
+
+        def m_auto_assign_ips_batch(requests, pool, host):
+            assert_equal(host, TEST_HOST)
+            results = []
+            for handle_id, _, num_v4, num_v6 in requests:
+                result = BatchAssignment(num_v4, num_v6)
+                if handle_id == "10.11.12.3":
+                    result.error = NoFreeBlocksError()
+                else:
+                    result.v4_addresses.append(IPAddress(handle_id))
+                results.append(result)
+            return results
+        self.client.auto_assign_ips_batch = Mock(
+                                        side_effect=m_auto_assign_ips_batch)
+
+        results = {}
+
+        def assign(handle_id):
+            try:
+                results[handle_id] = self.client.auto_assign_ips(
+                                        1, 0, handle_id, {}, host=TEST_HOST)
+            except NoFreeBlocksError as e:
+                results[handle_id] = e
+
+        threads = [threading.Thread(target=assign, args=(h,))
+                   for h in ("10.11.12.1", "10.11.12.2", "10.11.12.3")]
+        with patch("pycalico.ipam.time.sleep", m_sleep):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert_equal(self.client.auto_assign_ips_batch.call_count, 1)
+        for handle_id in ("10.11.12.1", "10.11.12.2"):
+            assert_equal(results[handle_id], ([IPAddress(handle_id)], []))
+        # Only the failed request's caller sees its error.
+        assert_is_instance(results["10.11.12.3"], NoFreeBlocksError)
+        assert_dict_equal(self.client._groups, {})
+
+    def test_auto_assign_ips_grouped_invalid(self):
+        """
+        Test a request with invalid attributes fails before joining a group,
+        and equal pools given as different objects share a group.
+        """
+        self.client.group_commit_window = 0
+        self.client.auto_assign_ips_batch = Mock(
+                                        return_value=[BatchAssignment(1, 0)])
+        assert_raises(TypeError, self.client.auto_assign_ips,
+                      1, 0, None, {"a": object()}, host=TEST_HOST)
+        assert_false(self.client.auto_assign_ips_batch.called)
+        assert_dict_equal(self.client._groups, {})
+
+        pool = IPPool("10.11.0.0/16")
+        keys = []
+
+        def m_sleep(secs):
+            keys.extend(self.client._groups)
+        with patch("pycalico.ipam.time.sleep", m_sleep):
+            self.client.auto_assign_ips(1, 0, None, {}, pool=(pool, None),
+                                        host=TEST_HOST)
+        assert_equal(keys, [(TEST_HOST, ("10.11.0.0/16", None))])
+
+    def test_auto_assign_ips_grouped_error(self):
+        """
+        Test an error assigning a group is raised to the caller.
+        """
+        self.client.group_commit_window = 0
+        self.client.auto_assign_ips_batch = Mock(
+                                        side_effect=NoFreeBlocksError())
+        assert_raises(NoFreeBlocksError, self.client.auto_assign_ips,
+                      1, 0, None, {}, host=TEST_HOST)
+        assert_dict_equal(self.client._groups, {})
+
+    def test_get_assignment_attributes_ref(self):
+        """
+        Test get_assignment_attributes() resolves attributes held in the
+        attribute store.
+        """
+        ip4 = BLOCK_V4_1[13]
+        attr4 = {"pod": "pod1", "namespace": "default"}
+        value = json.dumps(attr4, sort_keys=True, separators=(",", ":"))
+        digest = hashlib.sha256(value).hexdigest()
+
+        block4 = _test_block_empty_v4()
+        block4.assign(ip4, "handle_id_4", {ATTRIBUTES_REF: digest}, TEST_HOST)
+        m_result = Mock(spec=EtcdResult)
+        m_result.value = value
+        self.m_etcd_client.read.return_value = m_result
+
+        with patch("pycalico.ipam.BlockHandleReaderWriter._read_block",
+                   return_value=block4):
+            attr = self.client.get_assignment_attributes(ip4)
+            assert_dict_equal(attr, attr4)
+
+            # Modifying the result doesn't affect later lookups, which are
+            # served from the cache.
+            attr["pod"] = "pod2"
+            attr = self.client.get_assignment_attributes(ip4)
+            assert_dict_equal(attr, attr4)
+
+        self.m_etcd_client.read.assert_called_once_with(
+            "/calico/ipam/v2/attributes/" + digest, quorum=True)
+
+        # A reference to missing attributes is an error.
+        self.client._attributes_cache.clear()
+        self.m_etcd_client.read.side_effect = EtcdKeyNotFound()
+        with patch("pycalico.ipam.BlockHandleReaderWriter._read_block",
+                   return_value=block4):
+            assert_raises(KeyError, self.client.get_assignment_attributes,
+                          ip4)
+
     def test_claim_affinity(self):
         """
         Mainline test of claim_affinity()
@@ -1272,7 +1698,7 @@ class TestIPAMClient(unittest.TestCase):
 
         def m_get_ip_pools(self, version, ipam, include_disabled):
             assert ipam
-            assert not include_disabled
+            assert include_disabled
             return [IPPool("10.11.0.0/16"), IPPool("192.168.0.0/16")]
 
         with patch("pycalico.ipam.BlockHandleReaderWriter.get_ipam_config",
@@ -1288,14 +1714,40 @@ class TestIPAMClient(unittest.TestCase):
         assert_equal(not_claimed,
                      [IPNetwork("10.11.0.128/26")])
 
+    def test_claim_affinity_pool_block_size(self):
+        """
+        Test claim_affinity() uses the block size of the pool.
+        """
+        self.client._get_pool_block_size_bits.return_value = 4
+
+        def m_get_ip_pools(self, version, ipam, include_disabled):
+            return [IPPool("10.11.0.0/16", block_size_bits=4)]
+
+        with patch("pycalico.ipam.BlockHandleReaderWriter._claim_block_affinity"
+                   ) as m_claim_block_affinity, \
+             patch("pycalico.datastore.DatastoreClient.get_ip_pools",
+                   m_get_ip_pools):
+            claimed, not_claimed = self.client.claim_affinity(
+                                                IPNetwork("10.11.0.0/26"))
+
+        assert_equal(claimed, list(IPNetwork("10.11.0.0/26").subnet(28)))
+        assert_equal(not_claimed, [])
+        assert_equal(m_claim_block_affinity.call_count, 4)
+
+        # A CIDR smaller than the pool block size is rejected.
+        assert_raises(InvalidBlockSizeError,
+                      self.client.claim_affinity,
+                      IPNetwork("10.11.0.0/29"))
+
     def test_claim_affinity_invalid_pool(self):
         """
         Test of claim_affinity() with a CIDR not in a pool.
         """
         def m_get_ip_pools(self, version, ipam, include_disabled):
             assert ipam
-            assert not include_disabled
-            return [IPPool("10.11.0.0/16"), IPPool("192.168.0.0/16")]
+            assert include_disabled
+            return [IPPool("10.11.0.0/16"), IPPool("192.168.0.0/16"),
+                    IPPool("100.11.0.0/16", disabled=True)]
 
         with patch("pycalico.datastore.DatastoreClient.get_ip_pools",
                    m_get_ip_pools):
@@ -1389,6 +1841,36 @@ class TestIPAMClient(unittest.TestCase):
                 recursive=True, dir=True
             )
 
+    def test_allocate_ips_explicit_blocks_summaries(self):
+        """
+        Test blocks are tried emptiest first, and blocks summarised as full
+        are only tried once the others are exhausted.
+        """
+        blocks = [IPNetwork("10.11.0.0/26"), IPNetwork("10.11.0.64/26"),
+                  IPNetwork("10.11.0.128/26"), IPNetwork("10.11.0.192/26")]
+        summaries = {blocks[0]: (0, 11),
+                     blocks[2]: (10, 12),
+                     blocks[3]: (40, 13)}
+        tried = []
+
+        def m_auto_assign_ips_in_block(block_cidr, num, handle_id,
+                                       attributes, host):
+            tried.append(block_cidr)
+            return [block_cidr[1]]
+        self.client._auto_assign_ips_in_block = m_auto_assign_ips_in_block
+
+        ips = self.client._allocate_ips_explicit_blocks(blocks, 1, {}, None,
+                                                        TEST_HOST,
+                                                        summaries=summaries)
+        assert_list_equal(ips, [IPAddress("10.11.0.193")])
+        assert_list_equal(tried, [blocks[3]])
+
+        del tried[:]
+        self.client._allocate_ips_explicit_blocks(blocks, 4, {}, None,
+                                                  TEST_HOST,
+                                                  summaries=summaries)
+        assert_list_equal(tried, [blocks[3], blocks[2], blocks[1], blocks[0]])
+
 
 class TestBlockHandleReaderWriter(unittest.TestCase):
 
@@ -1397,6 +1879,9 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
         self.m_etcd_client = Mock(spec=Client)
         self.client.etcd_client = self.m_etcd_client
 
+        # Retry compare-and-swap failures immediately.
+        self.client.retry_policy = RetryPolicy(initial_delay=0)
+
     def test_delete_block(self):
         """
         Test _delete_block().
@@ -1407,6 +1892,336 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
         block.db_result.modifiedIndex = 111
         assert_raises(CASError, self.client._delete_block, block)
 
+    def test_compare_and_swap_block_compact(self):
+        """
+        Test blocks are written in the configured encoding.
+        """
+        self.client.block_encoding = ENCODING_COMPACT
+
+        # New block.
+        block = _test_block_not_empty_v4()
+        self.client._compare_and_swap_block(block)
+        key, value = self.m_etcd_client.write.call_args[0]
+        assert_equal(key, _block_datastore_key(BLOCK_V4_1))
+        assert_true(value.startswith(COMPACT_PREFIX))
+
+        # Existing block.
+        result = Mock(spec=EtcdResult)
+        result.value = value
+        block = AllocationBlock.from_etcd_result(result)
+        block.auto_assign(1, None, {}, "test_host1")
+        self.client._compare_and_swap_block(block)
+        self.m_etcd_client.update.assert_called_once_with(result)
+        assert_true(result.value.startswith(COMPACT_PREFIX))
+        block = AllocationBlock.from_etcd_result(result)
+        assert_equal(block.count_free_addresses(), BLOCK_SIZE - 3)
+
+    def test_compare_and_swap_block_summary(self):
+        """
+        Test a free-space summary is written to the host affinity key when
+        summaries are enabled.
+        """
+        self.client.block_summaries = True
+        block = _test_block_not_empty_v4()
+        result = Mock(spec=EtcdResult)
+        result.value = block.to_json()
+        block = AllocationBlock.from_etcd_result(result)
+        self.m_etcd_client.update.return_value.modifiedIndex = 7
+
+        self.client._compare_and_swap_block(block)
+        key, value = self.m_etcd_client.write.call_args[0]
+        assert_equal(key, _block_host_key("test_host1", BLOCK_V4_1))
+        assert_dict_equal(json.loads(value),
+                          {SUMMARY_FREE: BLOCK_SIZE - 2,
+                           SUMMARY_GENERATION: 7})
+        assert_dict_equal(self.m_etcd_client.write.call_args[1],
+                          {"prevExist": True})
+
+        # The affinity has been released; the write is not retried.
+        self.m_etcd_client.write.side_effect = EtcdKeyNotFound()
+        self.client._compare_and_swap_block(block)
+
+        # No summary for blocks without affinity.
+        self.m_etcd_client.write.reset_mock()
+        block.host_affinity = None
+        self.client._compare_and_swap_block(block)
+        assert_false(self.m_etcd_client.write.called)
+
+    def test_compare_and_swap_block_and_handles(self):
+        """
+        Test a block and its handles are written in a single transaction.
+        """
+        m_backend = Mock(spec=MemoryEtcdClient)
+        self.client.etcd_client = m_backend
+        block = _test_block_empty_v4()
+        result = Mock(spec=EtcdResult)
+        result.key = _block_datastore_key(BLOCK_V4_1)
+        result.value = block.to_json()
+        result.modifiedIndex = 5
+        block = AllocationBlock.from_etcd_result(result)
+        block.auto_assign(3, "h1", {}, TEST_HOST)
+
+        handle = AllocationHandle("h1")
+        handle.increment_block(BLOCK_V4_1, 1)
+        handle_result = Mock(spec=EtcdResult)
+        handle_result.value = handle.to_json()
+        handle_result.modifiedIndex = 3
+
+        def m_read(key, **kwargs):
+            if key == _handle_datastore_key("h1"):
+                return handle_result
+            raise EtcdKeyNotFound()
+        m_backend.read.side_effect = m_read
+        m_backend.transaction.return_value = [Mock(modifiedIndex=9),
+                                              Mock(), Mock()]
+
+        self.client._compare_and_swap_block_and_handles(block,
+                                                        {"h1": 2, "h2": 1})
+        ops = dict((op.key, op)
+                   for op in m_backend.transaction.call_args[0][0])
+        block_op = ops[_block_datastore_key(BLOCK_V4_1)]
+        assert_equal(block_op.prevIndex, 5)
+        assert_equal(block_op.value, block.to_json())
+        h1_op = ops[_handle_datastore_key("h1")]
+        assert_equal(h1_op.prevIndex, 3)
+        assert_dict_equal(json.loads(h1_op.value)["block"],
+                          {str(BLOCK_V4_1): 3})
+        h2_op = ops[_handle_datastore_key("h2")]
+        assert_false(h2_op.prevExist)
+        assert_dict_equal(json.loads(h2_op.value)["block"],
+                          {str(BLOCK_V4_1): 1})
+
+        m_backend.transaction.side_effect = EtcdCompareFailed()
+        assert_raises(CASError,
+                      self.client._compare_and_swap_block_and_handles,
+                      block, {"h1": 2})
+
+    def test_block_cache(self):
+        """
+        Test blocks are cached by modifiedIndex, and CAS failures remove them
+        from the cache.
+        """
+        self.client.cache_blocks = True
+        block = _test_block_not_empty_v4()
+        result = Mock(spec=EtcdResult)
+        result.value = block.to_json()
+        result.modifiedIndex = 5
+        self.m_etcd_client.read.return_value = result
+
+        block = self.client._read_block(BLOCK_V4_1)
+        assert_false(block.from_cache)
+        block = self.client._read_block(BLOCK_V4_1)
+        assert_true(block.from_cache)
+        assert_equal(block.count_free_addresses(), BLOCK_SIZE - 2)
+        self.m_etcd_client.read.assert_called_once_with(
+                                _block_datastore_key(BLOCK_V4_1), quorum=True)
+
+        # CAS directly against the cached version, and cache the new one.
+        block.auto_assign(1, None, {}, TEST_HOST)
+        new_result = Mock(spec=EtcdResult)
+        new_result.modifiedIndex = 6
+        self.m_etcd_client.update.return_value = new_result
+        self.client._compare_and_swap_block(block)
+        db_result = self.m_etcd_client.update.call_args[0][0]
+        assert_equal(db_result.key, _block_datastore_key(BLOCK_V4_1))
+        assert_equal(db_result.modifiedIndex, 5)
+
+        block = self.client._read_block(BLOCK_V4_1)
+        assert_true(block.from_cache)
+        assert_equal(block.db_result.modifiedIndex, 6)
+        assert_equal(block.count_free_addresses(), BLOCK_SIZE - 3)
+
+        # A failed CAS goes back to the datastore.
+        self.m_etcd_client.update.side_effect = EtcdCompareFailed()
+        assert_raises(CASError, self.client._compare_and_swap_block, block)
+        block = self.client._read_block(BLOCK_V4_1)
+        assert_false(block.from_cache)
+        assert_equal(self.m_etcd_client.read.call_count, 2)
+
+        # As does a deleted block.
+        self.m_etcd_client.update.side_effect = EtcdKeyNotFound()
+        assert_raises(CASError, self.client._compare_and_swap_block, block)
+        assert_not_in(BLOCK_V4_1, self.client._block_cache)
+
+    def test_block_cache_disabled(self):
+        """
+        Test blocks are not cached by default.
+        """
+        block = _test_block_not_empty_v4()
+        result = Mock(spec=EtcdResult)
+        result.value = block.to_json()
+        self.m_etcd_client.read.return_value = result
+
+        self.client._read_block(BLOCK_V4_1)
+        block = self.client._read_block(BLOCK_V4_1)
+        assert_false(block.from_cache)
+        assert_equal(self.m_etcd_client.read.call_count, 2)
+
+    def test_serializable_reads(self):
+        """
+        Test serializable block reads are treated as unconfirmed, and a block
+        is read at quorum after a CAS on it fails.
+        """
+        self.client.read_consistency = CONSISTENCY_SERIALIZABLE
+        key = _block_datastore_key(BLOCK_V4_1)
+        result = Mock(spec=EtcdResult)
+        result.value = _test_block_not_empty_v4().to_json()
+        self.m_etcd_client.read.return_value = result
+
+        block = self.client._read_block(BLOCK_V4_1)
+        assert_true(block.from_cache)
+        self.m_etcd_client.read.assert_called_once_with(key, quorum=False)
+
+        self.m_etcd_client.update.side_effect = EtcdCompareFailed()
+        assert_raises(CASError, self.client._compare_and_swap_block, block)
+        block = self.client._read_block(BLOCK_V4_1)
+        assert_false(block.from_cache)
+        self.m_etcd_client.read.assert_called_with(key, quorum=True)
+
+        # Only the next read is escalated.
+        self.client._read_block(BLOCK_V4_1)
+        self.m_etcd_client.read.assert_called_with(key, quorum=False)
+
+    def test_serializable_read_not_found(self):
+        """
+        Test a serializable read that doesn't find a key is repeated at
+        quorum.
+        """
+        self.client.read_consistency = CONSISTENCY_SERIALIZABLE
+        key = _block_datastore_key(BLOCK_V4_1)
+        result = Mock(spec=EtcdResult)
+        result.value = _test_block_not_empty_v4().to_json()
+        self.m_etcd_client.read.side_effect = [EtcdKeyNotFound(), result]
+
+        block = self.client._read_block(BLOCK_V4_1)
+        assert_false(block.from_cache)
+        self.m_etcd_client.read.assert_has_calls([call(key, quorum=False),
+                                                  call(key, quorum=True)])
+
+        self.m_etcd_client.read.side_effect = EtcdKeyNotFound()
+        assert_raises(KeyError, self.client._read_block, BLOCK_V4_1)
+        assert_equal(self.m_etcd_client.read.call_count, 4)
+
+    def test_cas_conflict_watch(self):
+        """
+        Test the block a CAS conflicted with is fetched by waiting on the
+        index in the error, and used by the next read of the block.
+        """
+        key = _block_datastore_key(BLOCK_V4_1)
+        block = _test_block_empty_v4()
+        block.db_result = EtcdResult(node={"key": key,
+                                           "value": block.to_json(),
+                                           "modifiedIndex": 5})
+        conflicting = _test_block_not_empty_v4()
+        self.m_etcd_client.update.side_effect = compare_failed("[5 != 7]")
+        self.m_etcd_client.watch.return_value = EtcdResult(
+            "compareAndSwap", {"key": key, "value": conflicting.to_json(),
+                               "modifiedIndex": 7})
+
+        assert_raises(CASError, self.client._compare_and_swap_block, block)
+        self.m_etcd_client.watch.assert_called_once_with(
+                            key, index=7, timeout=CONFLICT_WATCH_TIMEOUT)
+        block = self.client._read_block(BLOCK_V4_1)
+        assert_false(self.m_etcd_client.read.called)
+        assert_true(block.from_cache)
+        assert_equal(block.db_result.modifiedIndex, 7)
+        assert_equal(block.count_free_addresses(), BLOCK_SIZE - 2)
+
+        # Only the next read uses it.
+        self.m_etcd_client.read.return_value = block.db_result
+        self.client._read_block(BLOCK_V4_1)
+        assert_true(self.m_etcd_client.read.called)
+
+        # Uncaching the block discards it.
+        self.m_etcd_client.read.reset_mock()
+        assert_raises(CASError, self.client._compare_and_swap_block, block)
+        self.client._uncache_block(BLOCK_V4_1)
+        self.client._read_block(BLOCK_V4_1)
+        assert_true(self.m_etcd_client.read.called)
+
+    @parameterized.expand([
+        (EtcdEventIndexCleared(), None),
+        (None, "delete"),
+        (None, "compareAndSwap"),
+    ])
+    def test_cas_conflict_watch_fallback(self, error, action):
+        """
+        Test the block is read as normal if the conflicting write can't be
+        fetched: the history is compacted, the block was deleted, or the
+        index doesn't match.
+        """
+        key = _block_datastore_key(BLOCK_V4_1)
+        block = _test_block_empty_v4()
+        block.db_result = EtcdResult(node={"key": key,
+                                           "value": block.to_json(),
+                                           "modifiedIndex": 5})
+        self.m_etcd_client.update.side_effect = compare_failed("[5 != 7]")
+        self.m_etcd_client.watch.side_effect = error
+        self.m_etcd_client.watch.return_value = EtcdResult(
+            action, {"key": key, "value": block.to_json(),
+                     "modifiedIndex": 8})
+
+        assert_raises(CASError, self.client._compare_and_swap_block, block)
+        self.m_etcd_client.read.return_value = block.db_result
+        self.client._read_block(BLOCK_V4_1)
+        self.m_etcd_client.read.assert_called_once_with(key, quorum=True)
+
+    def test_cas_conflict_in_error(self):
+        """
+        Test the block a CAS conflicted with is taken from the error when
+        the backend includes it, without waiting for it.
+        """
+        m_backend = Mock(spec=MemoryEtcdClient)
+        self.client.etcd_client = m_backend
+        key = _block_datastore_key(BLOCK_V4_1)
+        block = _test_block_empty_v4()
+        block.db_result = EtcdResult(node={"key": key,
+                                           "value": block.to_json(),
+                                           "modifiedIndex": 5})
+        node = {"key": key, "value": _test_block_not_empty_v4().to_json(),
+                "modifiedIndex": 7}
+        m_backend.transaction.side_effect = compare_failed("[5 != 7]", 9,
+                                                           {key: node})
+
+        assert_raises(CASError,
+                      self.client._compare_and_swap_block_and_handles,
+                      block, {})
+        block = self.client._read_block(BLOCK_V4_1)
+        assert_false(m_backend.watch.called)
+        assert_false(m_backend.read.called)
+        assert_equal(block.db_result.modifiedIndex, 7)
+
+        # The conflicting blocks are bounded like the block cache.
+        self.client._conflicting_blocks[BLOCK_V4_2] = ("value", 3)
+        with patch("pycalico.ipam.BLOCK_CACHE_SIZE", 1):
+            assert_raises(CASError,
+                          self.client._compare_and_swap_block_and_handles,
+                          block, {})
+        assert_equal(self.client._conflicting_blocks.keys(), [BLOCK_V4_1])
+
+    def test_serializable_handle_cas_failure(self):
+        """
+        Test a handle is read at quorum after a CAS on it fails, and when
+        the caller requires it.
+        """
+        self.client.read_consistency = CONSISTENCY_SERIALIZABLE
+        key = _handle_datastore_key("h1")
+        handle = AllocationHandle("h1")
+        handle.increment_block(BLOCK_V4_1, 1)
+        result = Mock(spec=EtcdResult)
+        result.value = handle.to_json()
+        self.m_etcd_client.read.return_value = result
+
+        self.client._read_handle("h1")
+        self.m_etcd_client.read.assert_called_with(key, quorum=False)
+        self.client._read_handle("h1", quorum=True)
+        self.m_etcd_client.read.assert_called_with(key, quorum=True)
+
+        self.m_etcd_client.write.side_effect = EtcdAlreadyExist()
+        assert_raises(CASError, self.client._compare_and_swap_handle, handle)
+        self.client._read_handle("h1")
+        self.m_etcd_client.read.assert_called_with(key, quorum=True)
+
     def test_get_affine_blocks(self):
         """
         Test _get_affine_blocks mainline.
@@ -1431,6 +2246,30 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
         block_ids = self.client._get_affine_blocks("test_host", 4, None)
         assert_list_equal(block_ids, map(IPNetwork, expected_ids))
 
+    def test_get_affine_blocks_summaries(self):
+        """
+        Test _get_affine_blocks returns the summaries stored on the affinity
+        keys, ignoring missing or invalid ones.
+        """
+        path = "/calico/ipam/v2/host/test_host/ipv4/block/"
+        values = {"192.168.3.0/26": json.dumps({SUMMARY_FREE: 3,
+                                                 SUMMARY_GENERATION: 10}),
+                  "192.168.4.0/26": "",
+                  "192.168.5.0/26": "{"}
+        children = []
+        for net, value in values.iteritems():
+            node = Mock(spec=EtcdResult)
+            node.value = value
+            node.key = path + net.replace("/", "-")
+            children.append(node)
+        self.m_etcd_client.read.return_value.children = iter(children)
+
+        summaries = {}
+        block_ids = self.client._get_affine_blocks("test_host", 4, None,
+                                                   summaries=summaries)
+        assert_equal(len(block_ids), 3)
+        assert_dict_equal(summaries, {IPNetwork("192.168.3.0/26"): (3, 10)})
+
     def test_get_affine_blocks_empty(self):
         """
         Test _get_affine_blocks when there are no stored blocks.
@@ -1486,6 +2325,41 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
         block_ids = self.client._get_affine_blocks("test_host", 4, ip_pool)
         assert_list_equal(block_ids, expected_ids)
 
+    def test_get_host_affine_blocks(self):
+        """
+        Test _get_host_affine_blocks() reads both versions with a single
+        recursive read.
+        """
+        path = "/calico/ipam/v2/host/test_host"
+        keys = {path + "/ipv4/block/10.10.1.0-26":
+                    json.dumps({SUMMARY_FREE: 5, SUMMARY_GENERATION: 3}),
+                path + "/ipv4/block/192.168.3.0-26": "",
+                path + "/ipv6/block/2001:abcd:def0::-122": "",
+                # Empty directories are returned as leaves.
+                path + "/ipv6/block": None}
+        leaves = []
+        for key, value in sorted(keys.iteritems()):
+            node = Mock(spec=EtcdResult)
+            node.key = key
+            node.value = value
+            leaves.append(node)
+        self.m_etcd_client.read.return_value.leaves = iter(leaves)
+
+        ip_pool = IPPool(IPNetwork("10.0.0.0/8"))
+        affine_blocks = self.client._get_host_affine_blocks("test_host",
+                                                            (ip_pool, None))
+        self.m_etcd_client.read.assert_called_once_with(path, quorum=True,
+                                                        recursive=True)
+        assert_equal(affine_blocks,
+                     {4: ([IPNetwork("10.10.1.0/26")],
+                          {IPNetwork("10.10.1.0/26"): (5, 3)}),
+                      6: ([IPNetwork("2001:abcd:def0::/122")], {})})
+
+        self.m_etcd_client.read.side_effect = EtcdKeyNotFound()
+        affine_blocks = self.client._get_host_affine_blocks("test_host",
+                                                            (None, None))
+        assert_equal(affine_blocks, {4: ([], {}), 6: ([], {})})
+
     def test_get_host_block_pairs(self):
         """
         Mainline test of _get_host_block_pairs()
@@ -1661,12 +2535,12 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
         Test _new_affine_block when another host claims it between reading
         and writing.
 
-        1 Read shows block is free (EtcdKeyNotFound)
+        1 Listing shows no blocks (EtcdKeyNotFound)
         2 Write host affinity
         3 Try to write the new block, but this fails
         4 Re-read the block, discover another host owns it
         5 Delete key from 2
-        6 Read next block, find it free
+        6 Next block is free in the listing
         7 Write host affinity
         8 Try to write the new block, success
         """
@@ -1675,11 +2549,10 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
         m_result0 = Mock(spec=EtcdResult)
         m_result0.value = block.to_json()
 
-        # Reads at 1, 4, 6
+        # Reads at 1, 4
         self.m_etcd_client.read.side_effect = [
             EtcdKeyNotFound(),  # 1
             m_result0,  # 4
-            EtcdKeyNotFound()  # 6
         ]
         # Write at 2, 3, 7, 8
         self.m_etcd_client.write.side_effect = [
@@ -1748,8 +2621,10 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
             assert not include_disabled
             return [IPPool("10.11.0.0/16"), IPPool("192.168.0.0/16")]
 
-        # Reads are always successful
-        self.m_etcd_client.read.return_value = Mock(spec=AllocationBlock)
+        # All the blocks in both pools exist.
+        self.m_etcd_client.read.return_value = block_listing(
+            list(IPNetwork("10.11.0.0/16").subnet(26)) +
+            list(IPNetwork("192.168.0.0/16").subnet(26)))
 
         with patch("pycalico.datastore.DatastoreClient.get_ip_pools",
                    m_get_ip_pools):
@@ -1757,13 +2632,41 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
                           self.client._new_affine_block,
                           "test_host1", 4, IPPool("10.11.0.0/16"), IPAMConfig())
 
+            # The blocks are listed with a single read.
+            self.m_etcd_client.read.assert_called_once_with(
+                "/calico/ipam/v2/assignment/ipv4/block/",
+                quorum=True, recursive=True)
+            assert_false(self.m_etcd_client.write.called)
+
             # Two /16 pools means 2048 blocks to try.  Assert that we only
             # work the one pool, or 1024 blocks.
-            assert_equal(self.m_etcd_client.read.call_count, 1024)
+            assert_equal(self.client.new_block_probes, 1024)
+
+    @patch("pycalico.ipam._random_subnets_from_cidrs",
+           side_effect=gen_subnets)
+    def test_new_affine_block_skips_existing(self, m_rand_subn):
+        """
+        Test _new_affine_block claims the first block missing from the
+        listing, in the random order.
+        """
+        def m_get_ip_pools(_self, version, ipam, include_disabled):
+            return [IPPool("10.11.0.0/16")]
+
+        self.m_etcd_client.read.return_value = block_listing(
+                            list(IPNetwork("10.11.0.0/16").subnet(26))[:5])
 
-            # Spot check last call is the last subnet in 10.11.0.0/16 pool.
-            assert_equal(self.m_etcd_client.read.call_args[0][0],
-                         _block_datastore_key(IPNetwork("10.11.255.192/26")))
+        with patch("pycalico.datastore.DatastoreClient.get_ip_pools",
+                   m_get_ip_pools):
+            cidr = self.client._new_affine_block("test_host1", 4, None,
+                                                 IPAMConfig())
+
+        assert_equal(cidr, IPNetwork("10.11.1.64/26"))
+        assert_equal(self.client.new_block_probes, 6)
+        self.m_etcd_client.read.assert_called_once_with(
+            "/calico/ipam/v2/assignment/ipv4/block/",
+            quorum=True, recursive=True)
+        self.m_etcd_client.write.assert_called_with(
+            _block_datastore_key(cidr), ANY, prevExist=False)
 
     def test_read_blocks(self):
         """
@@ -1811,7 +2714,8 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
         with patch("pycalico.datastore.DatastoreClient.get_ip_pools",
                    m_get_ip_pools):
             random_blocks = list(
-                self.client._random_blocks(4, None, excluded_ids)
+                self.client._random_blocks(4, None, excluded_ids,
+                                           ipam_config=IPAMConfig())
             )
 
             # Excluded 3, but only 2 in the pool, so 1024 - 2 = 1022 blocks.
@@ -1830,7 +2734,8 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
             # check we aren't doing something stupid, like returning the same
             # order every time.
             random_blocks2 = list(
-                self.client._random_blocks(4, None, excluded_ids)
+                self.client._random_blocks(4, None, excluded_ids,
+                                           ipam_config=IPAMConfig())
             )
             assert_equal(len(random_blocks2), 1022)
 
@@ -1841,6 +2746,110 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
                     differs = True
             assert_true(differs)
 
+    def test_store_attributes(self):
+        """
+        Test _store_attributes() writes each distinct set of attributes to the
+        attribute store once.
+        """
+        attrs = {"pod": "pod1", "namespace": "default"}
+
+        # Disabled by default.
+        assert_equal(self.client._store_attributes(attrs), attrs)
+        assert_false(self.m_etcd_client.write.called)
+
+        self.client.dedup_attributes = True
+        assert_equal(self.client._store_attributes({}), {})
+        assert_equal(self.client._store_attributes(None), None)
+        assert_false(self.m_etcd_client.write.called)
+
+        ref = self.client._store_attributes(attrs)
+        value = '{"namespace":"default","pod":"pod1"}'
+        digest = hashlib.sha256(value).hexdigest()
+        assert_equal(ref, {ATTRIBUTES_REF: digest})
+        self.m_etcd_client.write.assert_called_once_with(
+            "/calico/ipam/v2/attributes/" + digest, value, prevExist=False)
+
+        # Equal attributes give the same reference without another write.
+        ref2 = self.client._store_attributes({"namespace": "default",
+                                              "pod": "pod1"})
+        assert_equal(ref2, ref)
+        assert_equal(self.m_etcd_client.write.call_count, 1)
+
+        # Attributes already written by another client are fine.
+        self.m_etcd_client.write.side_effect = EtcdAlreadyExist()
+        ref3 = self.client._store_attributes({"pod": "pod2"})
+        assert_equal(self.client._resolve_attributes(ref3), {"pod": "pod2"})
+        assert_false(self.m_etcd_client.read.called)
+
+    def test_resolve_attributes_not_ref(self):
+        """
+        Test _resolve_attributes() returns attributes held in the block.
+        """
+        for attrs in [None, {}, {"pod": "pod1"},
+                      {ATTRIBUTES_REF: "abc", "pod": "pod1"}]:
+            assert_equal(self.client._resolve_attributes(attrs), attrs)
+        assert_false(self.m_etcd_client.read.called)
+
+    def test_random_blocks_block_size(self):
+        """
+        Test _random_blocks() splits each pool using its own block size.
+        """
+        def m_get_ip_pools(_self, version, ipam, include_disabled):
+            return [IPPool("10.11.0.0/24", block_size_bits=4),
+                    IPPool("10.12.0.0/24")]
+
+        with patch("pycalico.datastore.DatastoreClient.get_ip_pools",
+                   m_get_ip_pools):
+            random_blocks = list(
+                self.client._random_blocks(4, ipam_config=IPAMConfig())
+            )
+            assert_equal(len(random_blocks), 16 + 4)
+            assert_equal(
+                set(random_blocks),
+                set(IPNetwork("10.11.0.0/24").subnet(28)) |
+                set(IPNetwork("10.12.0.0/24").subnet(26)))
+
+            # Pools without a block size use the IPAM config default.
+            random_blocks = list(self.client._random_blocks(
+                4, ipam_config=IPAMConfig(block_size_bits=5)))
+            assert_equal(len(random_blocks), 16 + 8)
+
+    def test_get_block_size_bits(self):
+        """
+        Test _get_block_size_bits() uses the pool block size, falling back to
+        the IPAM config default.
+        """
+        pools = [IPPool("10.11.0.0/16", block_size_bits=4),
+                 IPPool("10.12.0.0/16")]
+        m_get_ip_pools = Mock(return_value=pools)
+        self.client.get_ipam_config = Mock(
+                                    return_value=IPAMConfig(block_size_bits=8))
+        with patch("pycalico.datastore.DatastoreClient.get_ip_pools",
+                   m_get_ip_pools):
+            assert_equal(
+                self.client._get_block_size_bits(IPAddress("10.11.1.1")), 4)
+            assert_false(self.client.get_ipam_config.called)
+            assert_equal(
+                self.client._get_block_size_bits(IPNetwork("10.12.0.0/24")), 8)
+            assert_equal(
+                self.client._get_block_size_bits(IPAddress("10.13.1.1")), 8)
+
+            # The pools and IPAM config are read once, and cached.
+            m_get_ip_pools.assert_called_once_with(4, ipam=True,
+                                                   include_disabled=True)
+            assert_equal(self.client.get_ipam_config.call_count, 1)
+
+            # Refreshing reads both again.
+            pools[1] = IPPool("10.12.0.0/16", block_size_bits=5)
+            self.client.get_ipam_config.return_value = IPAMConfig()
+            assert_equal(
+                self.client._get_block_size_bits(IPNetwork("10.12.0.0/24"),
+                                                 refresh=True), 5)
+            assert_equal(
+                self.client._get_block_size_bits(IPAddress("10.13.1.1")), 6)
+            assert_equal(m_get_ip_pools.call_count, 2)
+            assert_equal(self.client.get_ipam_config.call_count, 2)
+
     def test_random_blocks_bad_pool(self):
         """
         Test _random_blocks when the requested pool isn't in IPPools.
@@ -1875,7 +2884,8 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
                    m_get_ip_pools):
             ip_pool = IPPool("10.11.0.0/16")
             random_blocks = list(
-                self.client._random_blocks(4, ip_pool, excluded_ids)
+                self.client._random_blocks(4, ip_pool, excluded_ids,
+                                           ipam_config=IPAMConfig())
             )
 
             # Excluded 3, but only 2 in the pool, so 1024 - 2 = 1022 blocks.
@@ -2019,6 +3029,25 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
         handle2 = AllocationHandle.from_etcd_result(m_result0)
         assert_equal(handle2.decrement_block(block_cidr, amount), 0)
 
+    def test_update_handle_blocks(self):
+        """
+        Test _update_handle_blocks updates several blocks with a single CAS.
+        """
+        handle0 = AllocationHandle("handle_id_1")
+        handle0.increment_block(BLOCK_V4_1, 3)
+        handle0.increment_block(BLOCK_V4_2, 2)
+        m_result0 = Mock(spec=EtcdResult)
+        m_result0.value = handle0.to_json()
+        self.m_etcd_client.read.return_value = m_result0
+
+        self.client._update_handle_blocks("handle_id_1",
+                                          {BLOCK_V4_1: -1, BLOCK_V4_2: -2,
+                                           BLOCK_V4_3: 4})
+        self.m_etcd_client.update.assert_called_once_with(m_result0)
+        handle1 = AllocationHandle.from_etcd_result(m_result0)
+        assert_dict_equal(handle1.block, {str(BLOCK_V4_1): 2,
+                                          str(BLOCK_V4_3): 4})
+
     def test_decrement_handle_does_not_exist(self):
         """
         Test _decrement_handle when it does not exist.
@@ -2133,6 +3162,129 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
                           handle0)
 
 
+class TestIPAMConflicts(unittest.TestCase):
+    """
+    Test clients sharing a datastore after compare-and-swaps conflict.
+    """
+
+    def setUp(self):
+        self.etcd = MemoryEtcdClient()
+        self.client = IPAMClient(backend=self.etcd, cache_blocks=True)
+        self.other = IPAMClient(backend=self.etcd)
+        self.client.add_ip_pool(4, IPPool("10.0.0.0/24"))
+
+    def test_stale_conflicting_block(self):
+        """
+        Test the block version a failed compare-and-swap conflicted with
+        isn't trusted once it is out of date.
+        """
+        self.client.assign_ip(IPAddress("10.0.0.1"), None, {}, TEST_HOST)
+        self.other.assign_ip(IPAddress("10.0.0.2"), None, {}, TEST_HOST)
+
+        # The client's cached block is out of date, so its compare-and-swap
+        # fails on its only attempt, leaving the conflicting version.
+        self.client.retry_policy = RetryPolicy(retries=1, initial_delay=0)
+        assert_raises(RuntimeError, self.client.assign_ip,
+                      IPAddress("10.0.0.3"), None, {}, TEST_HOST)
+        assert_equal(self.client._conflicting_blocks.keys(),
+                     [IPNetwork("10.0.0.0/26")])
+
+        self.other.release_ips({IPAddress("10.0.0.2")})
+        self.client.retry_policy = RetryPolicy(initial_delay=0)
+        self.client.assign_ip(IPAddress("10.0.0.2"), None, {"pod": "pod1"},
+                              TEST_HOST)
+        assert_equal(self.other.get_assignment_attributes(
+                                    IPAddress("10.0.0.2")), {"pod": "pod1"})
+
+
+class TestIPAMBlockSizes(unittest.TestCase):
+    """
+    Test finding the blocks of addresses as the pools change.
+    """
+
+    def setUp(self):
+        self.etcd = MemoryEtcdClient()
+        self.client = IPAMClient(backend=self.etcd)
+
+    def reads(self, fn, *args):
+        self.etcd.reset_round_trips()
+        result = fn(*args)
+        return result, self.etcd.round_trips().get("read", 0)
+
+    def test_block_size_change(self):
+        """
+        Test the block size of a pool can't change while it has blocks.
+        """
+        cidr = IPNetwork("10.0.0.0/16")
+        self.client.add_ip_pool(4, IPPool(cidr))
+        self.client.assign_ip(IPAddress("10.0.0.5"), "handle", {}, TEST_HOST)
+        assert_raises(InvalidBlockSizeError, self.client.add_ip_pool, 4,
+                      IPPool(cidr, block_size_bits=8))
+        self.client.add_ip_pool(4, IPPool(cidr, block_size_bits=6))
+
+        # Pools that don't overlap the block may use any block size.
+        self.client.add_ip_pool(4, IPPool("10.1.0.0/16", block_size_bits=8))
+
+        # The block size may change once the blocks are gone.
+        self.client.release_ips({IPAddress("10.0.0.5")})
+        self.client.release_host_affinities(TEST_HOST)
+        self.client.add_ip_pool(4, IPPool(cidr, block_size_bits=8))
+        self.client.assign_ip(IPAddress("10.0.0.5"), "handle", {}, TEST_HOST)
+        assert_equal(self.client.get_ip_assignments_by_handle("handle"),
+                     [IPAddress("10.0.0.5")])
+        assert_equal(self.client._get_block_ids(4), {"10.0.0.0-24"})
+
+    def test_release_removed_pool(self):
+        """
+        Test addresses are released from their blocks after their pool, which
+        has its own block size, is removed.
+        """
+        cidr = IPNetwork("10.0.0.0/16")
+        self.client.add_ip_pool(4, IPPool(cidr, block_size_bits=8))
+        addresses = {IPAddress("10.0.1.5"), IPAddress("10.0.2.5")}
+        for address in addresses:
+            self.client.assign_ip(address, "handle", {"pod": "pod1"},
+                                  TEST_HOST)
+        self.client.remove_ip_pool(4, cidr)
+
+        # A new client has never seen the pool.
+        for client in (IPAMClient(backend=self.etcd), self.client):
+            assert_equal(client.get_assignment_attributes(
+                                    IPAddress("10.0.1.5")), {"pod": "pod1"})
+        assert_equal(self.client.release_ips(
+                        {IPAddress("10.0.1.5"), IPAddress("10.1.0.1")}),
+                     {IPAddress("10.1.0.1")})
+        assert_equal(IPAMClient(backend=self.etcd).release_ips(
+                        {IPAddress("10.0.2.5")}), set())
+        assert_raises(KeyError, self.client.get_ip_assignments_by_handle,
+                      "handle")
+
+    def test_reads(self):
+        """
+        Test the pools and IPAM config are only read when needed.
+        """
+        self.client.add_ip_pool(4, IPPool("10.0.0.0/16"))
+        self.client.add_ip_pool(4, IPPool("10.1.0.0/16", block_size_bits=8))
+        for address in ("10.0.0.1", "10.1.0.1"):
+            self.client.assign_ip(IPAddress(address), None, {}, TEST_HOST)
+
+        # Only the block is read once the pools and config are cached.
+        _, reads = self.reads(self.client.assign_ip, IPAddress("10.0.0.2"),
+                              None, {}, TEST_HOST)
+        assert_equal(reads, 1)
+        _, reads = self.reads(self.client.release_ips,
+                              {IPAddress("10.0.0.2"), IPAddress("10.1.0.1")})
+        assert_equal(reads, 2)
+
+        # The config isn't read for a pool with its own block size.
+        client = IPAMClient(backend=self.etcd)
+        _, reads = self.reads(client.assign_ip, IPAddress("10.1.0.2"),
+                              None, {}, TEST_HOST)
+        assert_equal(reads, 2)
+        _, reads = self.reads(client.release_ips, {IPAddress("10.0.0.1")})
+        assert_equal(reads, 2)
+
+
 class TestIPAMConfig(unittest.TestCase):
     """
     Test management of IPAM configuration.
@@ -2232,8 +3384,39 @@ class TestIPAMConfig(unittest.TestCase):
         cfg1 = IPAMConfig.from_json(cfg0.to_json())
         self.assertEquals(cfg0, cfg1)
 
+    def test_ipam_config_block_size_bits(self):
+        """
+        Test the IPAMConfig default block size.
+        """
+        # Older configuration does not include the block size.
+        cfg0 = IPAMConfig.from_json('{"auto_allocate_blocks": true, '
+                                    '"strict_affinity": false}')
+        self.assertEquals(cfg0.block_size_bits, BLOCK_SIZE_BITS)
+        self.assertEquals(cfg0, IPAMConfig())
+
+        cfg1 = IPAMConfig(block_size_bits=8)
+        self.assertNotEquals(cfg0, cfg1)
+        self.assertEquals(IPAMConfig.from_json(cfg1.to_json()), cfg1)
+
+        self.assertRaises(InvalidBlockSizeError, IPAMConfig,
+                          block_size_bits=13)
+
 
 class TestUtilityFunctions(unittest.TestCase):
+    def test_handle_updates(self):
+        """
+        Test _HandleUpdates sums the changes for each handle and block, and
+        drops changes that cancel out.
+        """
+        updates = _HandleUpdates()
+        updates.add("h1", BLOCK_V4_1, -2)
+        updates.add("h1", BLOCK_V4_2, -1)
+        updates.add("h1", BLOCK_V4_1, -3)
+        updates.add("h2", BLOCK_V4_1, 2)
+        updates.add("h2", BLOCK_V4_1, -2)
+        assert_dict_equal(updates.deltas(),
+                          {"h1": {BLOCK_V4_1: -5, BLOCK_V4_2: -1}})
+
     def test_random_subnets_from_cidr(self):
         for inputlen in xrange(16, 32):
             for subnet_len in xrange(inputlen, 33, 3):
@@ -2245,6 +3428,30 @@ class TestUtilityFunctions(unittest.TestCase):
                 # And exactly the same number of values.
                 self.assertEqual(len(rand_subnets), len(exp_subnets))
 
+    def test_random_subnets_from_cidr_v6(self):
+        cidr = IPNetwork("2001:abcd:def0::/118")
+        rand_subnets = list(_random_subnets_from_cidr(cidr, 122))
+        self.assertEqual(len(rand_subnets), 16)
+        self.assertEqual(set(rand_subnets), set(cidr.subnet(122)))
+        for subnet in rand_subnets:
+            self.assertEqual(subnet.version, 6)
+
+    def test_block_keys(self):
+        cidr = IPNetwork("10.11.12.0/26")
+        self.assertEqual(_block_datastore_key(cidr),
+                         "/calico/ipam/v2/assignment/ipv4/block/10.11.12.0-26")
+        self.assertEqual(_block_host_key("host1", cidr),
+                         "/calico/ipam/v2/host/host1/ipv4/block/10.11.12.0-26")
+        # Keys are memoized by value, so an equal CIDR gives the same key, and
+        # a CIDR with a different prefix length gives a different key.
+        self.assertEqual(_block_datastore_key(IPNetwork("10.11.12.0/26")),
+                         _block_datastore_key(cidr))
+        self.assertEqual(_block_datastore_key(IPNetwork("10.11.12.0/28")),
+                         "/calico/ipam/v2/assignment/ipv4/block/10.11.12.0-28")
+        self.assertEqual(
+            _block_datastore_key(IPNetwork("2001:abcd:def0::/122")),
+            "/calico/ipam/v2/assignment/ipv6/block/2001:abcd:def0::-122")
+
     def test_random_subnets_from_cidr_bad_prefixlen(self):
         with self.assertRaises(ValueError):
             next(_random_subnets_from_cidr(IPNetwork("10.0.0.1/16"), -1))
@@ -0,0 +1,182 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from netaddr import IPNetwork
+from nose.tools import *
+
+from pycalico.datastore_datatypes import IPPool
+from pycalico.ipam import IPAMClient
+from pycalico.ipam_service import IPAMService
+from pycalico.ipam_service_client import (IPAMServiceClient,
+                                          IPAMServiceError, read_message,
+                                          write_message, MAX_MESSAGE_SIZE,
+                                          _HEADER)
+from pycalico.memory_etcd import MemoryEtcdClient
+
+
+class TestIPAMService(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmp_dir, "ipam.sock")
+        self.ipam = IPAMClient(backend=MemoryEtcdClient())
+        self.ipam.add_ip_pool(4, IPPool(IPNetwork("10.0.0.0/24")))
+        self.ipam.add_ip_pool(4, IPPool(IPNetwork("10.1.0.0/24")))
+        self.ipam.add_ip_pool(6, IPPool(IPNetwork("fd00::/120")))
+
+        self.service = IPAMService(self.ipam, self.socket_path)
+        self.thread = threading.Thread(target=self.service.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.client = IPAMServiceClient(self.socket_path, timeout=5)
+
+    def tearDown(self):
+        self.client.close()
+        self.service.shutdown()
+        self.service.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_assign_release(self):
+        """
+        Test addresses are assigned, queried and released through the
+        service, on one connection.
+        """
+        assert_equal(stat.S_IMODE(os.stat(self.socket_path).st_mode), 0o600)
+
+        v4, v6 = self.client.auto_assign_ips(2, 1, "handle", {"a": "b"},
+                                             pool=("10.1.0.0/24", None),
+                                             host="host1")
+        assert_equal(len(v4), 2)
+        assert_equal(len(v6), 1)
+        for address in v4:
+            assert_in(address, IPNetwork("10.1.0.0/24"))
+        assert_equal(self.client.get_assignment_attributes(v4[0]),
+                     {"a": "b"})
+        assert_equal(sorted(self.client.get_ip_assignments_by_handle(
+                                                                "handle")),
+                     sorted(v4 + v6))
+
+        self.client.assign_ip("10.0.0.5", "handle2", {}, host="host1")
+        assert_equal(self.client.release_ips(["10.0.0.5", "10.0.0.6"]),
+                     set(["10.0.0.6"]))
+        self.client.release_ip_by_handle("handle")
+        assert_raises(IPAMServiceError,
+                      self.client.get_ip_assignments_by_handle, "handle")
+
+    def test_errors(self):
+        """
+        Test exceptions raised by the IPAM client are returned as errors,
+        and the connection can still be used.
+        """
+        with assert_raises(IPAMServiceError) as cm:
+            self.client.release_ip_by_handle("missing")
+        assert_equal(cm.exception.error_type, "KeyError")
+
+        with assert_raises(IPAMServiceError) as cm:
+            self.client.auto_assign_ips(1, 0, None, {},
+                                        pool=("192.168.0.0/24", None))
+        assert_equal(cm.exception.error_type, "PoolNotFound")
+
+        with assert_raises(IPAMServiceError) as cm:
+            self.client.call("delete_everything")
+        assert_equal(cm.exception.error_type, "ValueError")
+
+        with assert_raises(IPAMServiceError) as cm:
+            self.client.call("release_ips", bad_param=1)
+        assert_equal(cm.exception.error_type, "TypeError")
+
+        assert_equal(self.client.release_ips(["10.0.0.1"]),
+                     set(["10.0.0.1"]))
+
+    def test_concurrent_connections(self):
+        """
+        Test several clients are served at once.
+        """
+        results = []
+
+        def assign(i):
+            client = IPAMServiceClient(self.socket_path, timeout=5)
+            v4, _ = client.auto_assign_ips(3, 0, "handle%d" % i, {},
+                                           host="host1")
+            client.close()
+            results.extend(v4)
+
+        threads = [threading.Thread(target=assign, args=(i,))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(len(set(results)), 15)
+
+    def test_service_restart(self):
+        """
+        Test the client reconnects after the service restarts.
+        """
+        self.client.release_ips(["10.0.0.1"])
+        self.service.shutdown()
+        self.service.server_close()
+        self.thread.join()
+        assert_raises(IPAMServiceError, self.client.release_ips,
+                      ["10.0.0.1"])
+        assert_raises(IPAMServiceError, self.client.release_ips,
+                      ["10.0.0.1"])
+
+        self.service = IPAMService(self.ipam, self.socket_path)
+        self.thread = threading.Thread(target=self.service.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        assert_equal(self.client.release_ips(["10.0.0.1"]),
+                     set(["10.0.0.1"]))
+
+    def test_bad_messages(self):
+        """
+        Test the service closes connections that send malformed messages.
+        """
+        for data in (_HEADER.pack(MAX_MESSAGE_SIZE + 1),
+                     _HEADER.pack(3) + "{]}",
+                     _HEADER.pack(10) + "{}"):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(5)
+            sock.connect(self.socket_path)
+            sock.sendall(data)
+            sock.shutdown(socket.SHUT_WR)
+            assert_equal(sock.recv(1), "")
+            sock.close()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        write_message(sock, ["not", "a", "request"])
+        assert_equal(read_message(sock)["error"]["type"], "ValueError")
+        sock.close()
+
+    def test_client_imports(self):
+        """
+        Test the client doesn't import the IPAM client, or its dependencies.
+        """
+        code = ("import sys; import pycalico.ipam_service_client; "
+                "print(sorted(m for m in ('pycalico.ipam', 'etcd', "
+                "'netaddr') if m in sys.modules))")
+        output = subprocess.check_output([sys.executable, "-c", code])
+        assert_equal(output.strip(), "[]")
@@ -0,0 +1,331 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from etcd import (EtcdKeyNotFound, EtcdAlreadyExist, EtcdCompareFailed,
+                  EtcdNotFile, EtcdNotDir, EtcdDirNotEmpty,
+                  EtcdEventIndexCleared, EtcdWatchTimedOut)
+from nose.tools import *
+from mock import Mock, patch
+import threading
+import unittest
+
+from netaddr import IPNetwork
+
+from pycalico.backend import (TxnWrite, TxnDelete, current_node,
+                              compare_failed_indexes)
+from pycalico.datastore_datatypes import IPPool
+from pycalico.ipam import IPAMClient
+from pycalico.memory_etcd import MemoryEtcdClient, EVENT_HISTORY
+from tests.bench.ipam_bench import run_benchmark
+
+
+class BackendContract(object):
+    """
+    Tests of the etcd v2 semantics every datastore backend provides.  Mixed
+    into a TestCase whose setUp() sets self.client to an empty backend.
+    """
+
+    def test_write_read(self):
+        """
+        Test keys can be written and read back, with increasing indexes.
+        """
+        result = self.client.write("/a/b", "1")
+        assert_equal(result.action, "set")
+        assert_equal(result.key, "/a/b")
+        result2 = self.client.write("a/b/", 2)
+        assert_greater(result2.modifiedIndex, result.modifiedIndex)
+        assert_equal(result2.createdIndex, result.createdIndex)
+        assert_equal(result2._prev_node.value, "1")
+
+        read = self.client.read("/a/b", quorum=True)
+        assert_equal(read.value, "2")
+        assert_equal(read.modifiedIndex, result2.modifiedIndex)
+        assert_raises(EtcdKeyNotFound, self.client.read, "/a/c")
+
+    def test_prev_exist(self):
+        """
+        Test create-only and update-only writes.
+        """
+        result = self.client.write("/a", "1", prevExist=False)
+        assert_equal(result.action, "create")
+        assert_raises(EtcdAlreadyExist, self.client.write, "/a", "2",
+                      prevExist=False)
+        assert_raises(EtcdKeyNotFound, self.client.write, "/b", "2",
+                      prevExist=True)
+        assert_equal(self.client.write("/a", "2", prevExist=True).action,
+                     "update")
+
+    def test_compare_and_swap(self):
+        """
+        Test writes and deletes conditional on the index and value.
+        """
+        result = self.client.write("/a", "1")
+        self.client.write("/a", "2", prevIndex=result.modifiedIndex)
+        assert_raises(EtcdCompareFailed, self.client.write, "/a", "3",
+                      prevIndex=result.modifiedIndex)
+        assert_raises(EtcdCompareFailed, self.client.write, "/a", "3",
+                      prevValue="1")
+        assert_raises(EtcdKeyNotFound, self.client.write, "/b", "3",
+                      prevValue="1")
+
+        read = self.client.read("/a")
+        read.value = "3"
+        new = self.client.update(read)
+        with assert_raises(EtcdCompareFailed) as cm:
+            self.client.update(read)
+        # The error gives the index of the conflicting write, as etcd does.
+        assert_equal(compare_failed_indexes(cm.exception),
+                     (read.modifiedIndex, new.modifiedIndex))
+
+        assert_raises(EtcdCompareFailed, self.client.delete, "/a",
+                      prevValue="2")
+        read = self.client.read("/a")
+        assert_raises(EtcdCompareFailed, self.client.delete, "/a",
+                      prevIndex=read.modifiedIndex - 1)
+        self.client.delete("/a", prevIndex=read.modifiedIndex)
+        assert_raises(EtcdKeyNotFound, self.client.read, "/a")
+        assert_raises(EtcdKeyNotFound, self.client.delete, "/a")
+
+    def test_recursive(self):
+        """
+        Test reading and deleting the keys under a directory.
+        """
+        self.client.write("/d/a", "1")
+        self.client.write("/d/e/b", "2")
+        self.client.write("/d/e/c", "3")
+        self.client.write("/d.f", "4")
+
+        result = self.client.read("/d")
+        assert_true(result.dir)
+        assert_equal([(child.key, child.value, child.dir)
+                      for child in result.children],
+                     [("/d/a", "1", False), ("/d/e", None, True)])
+
+        result = self.client.read("/d", recursive=True)
+        assert_equal([(leaf.key, leaf.value) for leaf in result.leaves],
+                     [("/d/a", "1"), ("/d/e/b", "2"), ("/d/e/c", "3")])
+
+        self.client.delete("/d/e", dir=True, recursive=True)
+        assert_raises(EtcdKeyNotFound, self.client.read, "/d/e/b")
+        assert_equal([leaf.key for leaf in
+                      self.client.read("/d", recursive=True).leaves],
+                     ["/d/a"])
+        assert_equal(self.client.read("/d.f").value, "4")
+
+    def test_read_siblings(self):
+        """
+        Test reading a key or directory doesn't return the keys beside it
+        that share its prefix.
+        """
+        self.client.write("/abc", "1")
+        self.client.write("/abc-d", "2")
+        self.client.write("/ab/c", "3")
+        assert_equal(self.client.read("/abc").value, "1")
+        assert_equal([(child.key, child.value)
+                      for child in self.client.read("/ab").children],
+                     [("/ab/c", "3")])
+        assert_raises(EtcdKeyNotFound, self.client.read, "/a")
+
+    def test_empty_directories(self):
+        """
+        Test directories can be created empty, and exist until they are
+        deleted.
+        """
+        result = self.client.write("/d", None, dir=True)
+        assert_true(result.dir)
+        assert_raises(EtcdNotFile, self.client.write, "/d", None, dir=True)
+        self.client.write("/e/f", None, dir=True)
+        assert_true(self.client.read("/d").dir)
+        assert_equal([leaf.key for leaf in
+                      self.client.read("/d", recursive=True).leaves], ["/d"])
+        assert_equal([(child.key, child.dir)
+                      for child in self.client.read("/e").children],
+                     [("/e/f", True)])
+
+        # The directory remains after the keys under it are deleted.
+        self.client.write("/d/a", "1")
+        self.client.delete("/d/a")
+        assert_true(self.client.read("/d").dir)
+        self.client.delete("/d", dir=True)
+        assert_raises(EtcdKeyNotFound, self.client.read, "/d")
+        self.client.delete("/e", dir=True, recursive=True)
+        assert_raises(EtcdKeyNotFound, self.client.read, "/e/f")
+
+    def test_transaction(self):
+        """
+        Test transactions apply all their changes if all their conditions
+        hold, and none otherwise.
+        """
+        a = self.client.write("/a", "1")
+        self.client.write("/b", "1")
+
+        results = self.client.transaction([
+            TxnWrite("/a", "2", prevIndex=a.modifiedIndex),
+            TxnWrite("/b", "2", prevExist=True),
+            TxnWrite("/c", "2", prevExist=False)])
+        assert_equal([result.key for result in results], ["/a", "/b", "/c"])
+        for result in results:
+            read = self.client.read(result.key)
+            assert_equal(read.value, "2")
+            assert_equal(read.modifiedIndex, result.modifiedIndex)
+
+        for ops in ([TxnWrite("/a", "3", prevIndex=a.modifiedIndex),
+                     TxnWrite("/d", "3")],
+                    [TxnWrite("/d", "3"),
+                     TxnWrite("/c", "3", prevExist=False)],
+                    [TxnWrite("/d", "3"),
+                     TxnWrite("/e", "3", prevExist=True)],
+                    [TxnWrite("/d", "3"), TxnDelete("/e")]):
+            with assert_raises(EtcdCompareFailed) as cm:
+                self.client.transaction(ops)
+            assert_raises(EtcdKeyNotFound, self.client.read, "/d")
+            assert_equal(self.client.read("/a").value, "2")
+
+        # The error includes the current nodes of the keys.
+        assert_equal(current_node(cm.exception, "/d"), None)
+        assert_equal(current_node(cm.exception, "/e"), None)
+        with assert_raises(EtcdCompareFailed) as cm:
+            self.client.transaction([TxnWrite("/a", "3",
+                                              prevIndex=a.modifiedIndex)])
+        node = current_node(cm.exception, "/a")
+        assert_equal((node["value"], node["modifiedIndex"]),
+                     ("2", results[0].modifiedIndex))
+
+        b_index = results[1].modifiedIndex
+        self.client.transaction([TxnDelete("/a"),
+                                 TxnDelete("/b", prevIndex=b_index)])
+        assert_raises(EtcdKeyNotFound, self.client.read, "/a")
+        assert_raises(EtcdKeyNotFound, self.client.read, "/b")
+
+    def test_watch_index(self):
+        """
+        Test watching from a past index returns the change at that index.
+        """
+        result = self.client.write("/w/a", "1")
+        self.client.write("/w/b", "2")
+        change = self.client.watch("/w/a", index=result.modifiedIndex,
+                                   timeout=5)
+        assert_equal((change.key, change.value), ("/w/a", "1"))
+
+        change = self.client.watch("/w", index=result.modifiedIndex + 1,
+                                   timeout=5, recursive=True)
+        assert_equal((change.key, change.value), ("/w/b", "2"))
+
+        self.client.delete("/w/a")
+        change = self.client.read("/w/a", wait=True,
+                                  waitIndex=result.modifiedIndex + 1,
+                                  timeout=5)
+        assert_equal((change.action, change.key), ("delete", "/w/a"))
+
+
+class TestMemoryEtcdClient(BackendContract, unittest.TestCase):
+
+    def setUp(self):
+        self.client = MemoryEtcdClient()
+
+    def test_directories(self):
+        """
+        Test etcd v2 directory errors.
+        """
+        self.client.write("/d/e/b", "2")
+        assert_raises(EtcdNotDir, self.client.write, "/d/e/b/c", "3")
+        assert_raises(EtcdNotFile, self.client.write, "/d", "4")
+        assert_raises(EtcdNotFile, self.client.write, "/d", None, dir=True)
+        assert_raises(EtcdNotFile, self.client.delete, "/d/e")
+        assert_raises(EtcdDirNotEmpty, self.client.delete, "/d/e", dir=True)
+        assert_raises(EtcdNotFile, self.client.transaction,
+                      [TxnWrite("/d", "4")])
+
+    def test_append(self):
+        """
+        Test appending creates keys in order.
+        """
+        self.client.write("/q", None, dir=True)
+        key1 = self.client.write("/q", "1", append=True).key
+        key2 = self.client.write("/q", "2", append=True).key
+        assert_less(key1, key2)
+        assert_equal([leaf.value for leaf in self.client.read("/q").leaves],
+                     ["1", "2"])
+
+    def test_watch_wait(self):
+        """
+        Test watches wait for the next change, or time out.
+        """
+        self.client.write("/w/a", "1")
+        timer = threading.Timer(0.01, self.client.write, ("/w/a", "2"))
+        timer.start()
+        change = self.client.watch("/w/a", timeout=5)
+        timer.join()
+        assert_equal(change.value, "2")
+        assert_equal(change._prev_node.value, "1")
+
+        assert_raises(EtcdWatchTimedOut, self.client.watch, "/w/a",
+                      timeout=0.01)
+
+    def test_watch_cleared(self):
+        """
+        Test watching from an index older than the history fails.
+        """
+        for i in xrange(EVENT_HISTORY + 1):
+            self.client.write("/a", str(i))
+        assert_raises(EtcdEventIndexCleared, self.client.watch, "/a",
+                      index=2)
+
+    @patch("pycalico.memory_etcd.time.sleep", autospec=True)
+    def test_round_trips(self, m_sleep):
+        """
+        Test requests are counted, and delayed by the latency.
+        """
+        self.client.latency = Mock(return_value=0.01)
+        self.client.write("/a", "1")
+        self.client.read("/a")
+        assert_raises(EtcdKeyNotFound, self.client.delete, "/b")
+        self.client.transaction([TxnWrite("/b", "1")])
+        assert_equal(self.client.round_trips(),
+                     {"write": 1, "read": 1, "delete": 1, "txn": 1})
+        assert_equal(m_sleep.call_count, 4)
+        m_sleep.assert_called_with(0.01)
+        self.client.reset_round_trips()
+        assert_equal(self.client.round_trips(), {})
+
+    def test_ipam(self):
+        """
+        Test IPAMClient assigns and releases addresses against the backend,
+        writing each block and its handle in one transaction.
+        """
+        ipam = IPAMClient(backend=self.client)
+        ipam.add_ip_pool(4, IPPool(IPNetwork("10.0.0.0/24")))
+        v4, _ = ipam.auto_assign_ips(3, 0, "handle", {}, host="host1")
+        assert_equal(len(v4), 3)
+        assert_equal(self.client.round_trips()["txn"], 1)
+        assert_equal(set(ipam.get_ip_assignments_by_handle("handle")),
+                     set(v4))
+        ipam.assign_ip(IPNetwork("10.0.0.200/32").ip, "handle", {},
+                       host="host1")
+        assert_equal(len(ipam.get_ip_assignments_by_handle("handle")), 4)
+        ipam.release_ip_by_handle("handle")
+        assert_raises(KeyError, ipam.get_ip_assignments_by_handle, "handle")
+
+
+class TestIPAMBenchmark(unittest.TestCase):
+
+    def test_run_benchmark(self):
+        """
+        Smoke test a small benchmark run on a nearly full pool.
+        """
+        result = run_benchmark(fill=0.9, hosts=2, threads=2, operations=3,
+                               pool="10.0.0.0/24", block_size_bits=4)
+        assert_equal(result["allocations"], 12)
+        assert_equal(result["failures"], 0)
+        assert_greater(result["round_trips_per_op"], 0)
+        assert_less_equal(result["p50_ms"], result["p99_ms"])
@@ -0,0 +1,206 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from etcd import EtcdCompareFailed, EtcdKeyNotFound
+from nose.tools import *
+from mock import patch
+import threading
+import unittest
+
+from netaddr import IPNetwork
+
+from pycalico.backend import TxnWrite, is_transactional
+from pycalico.datastore import DatastoreClient
+from pycalico.datastore_datatypes import IPPool
+from pycalico.datastore_errors import DataStoreError
+from pycalico.ipam import IPAMClient
+from pycalico.memory_etcd import MemoryEtcdClient
+from pycalico.metrics import (MetricsRegistry, InstrumentedBackend,
+                              bind_operations)
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry(buckets=(0.1, 1))
+
+    def test_operations(self):
+        """
+        Test requests are recorded against every operation in progress.
+        """
+        self.registry.record_request("read", 1, 2, False)
+        outer = self.registry.start("outer")
+        self.registry.record_request("write", 10, 0, False)
+        inner = self.registry.start("inner")
+        self.registry.record_request("write", 5, 0, True)
+        self.registry.finish(inner, False)
+        self.registry.finish(outer, True)
+
+        snapshot = self.registry.snapshot()
+        outer_metrics = snapshot["operations"]["outer"]
+        assert_equal(outer_metrics["count"], 1)
+        assert_equal(outer_metrics["errors"], 0)
+        assert_equal(outer_metrics["writes"], 2)
+        assert_equal(outer_metrics["reads"], 0)
+        assert_equal(outer_metrics["cas_failures"], 1)
+        assert_equal(outer_metrics["bytes_sent"], 15)
+        assert_equal(outer_metrics["buckets"], [1, 1])
+        inner_metrics = snapshot["operations"]["inner"]
+        assert_equal(inner_metrics["errors"], 1)
+        assert_equal(inner_metrics["writes"], 1)
+        totals = snapshot["totals"]
+        assert_equal(totals["reads"], 1)
+        assert_equal(totals["writes"], 2)
+        assert_equal(totals["bytes_received"], 2)
+
+    def test_bind_operations(self):
+        """
+        Test requests made on another thread by a bound function are
+        recorded against the operations of the thread that bound it.
+        """
+        assert_equal(bind_operations(len), len)
+        operation = self.registry.start("op")
+        fn = bind_operations(
+            lambda: self.registry.record_request("delete", 0, 0, False))
+        thread = threading.Thread(target=fn)
+        thread.start()
+        thread.join()
+
+        # Calling the bound function on this thread leaves its operations in
+        # progress.
+        fn()
+        self.registry.finish(operation, True)
+        assert_equal(self.registry.snapshot()["operations"]["op"]["deletes"],
+                     2)
+
+    def test_to_prometheus(self):
+        """
+        Test the Prometheus text format export.
+        """
+        with patch("pycalico.metrics.time.time", side_effect=[0, 0.5]):
+            operation = self.registry.start('get_"x"')
+            self.registry.record_request("txn", 3, 4, False)
+            self.registry.finish(operation, True)
+
+        text = self.registry.to_prometheus(prefix="test")
+        lines = text.splitlines()
+        assert_in("# TYPE test_operation_duration_seconds histogram", lines)
+        assert_in('test_operation_duration_seconds_bucket'
+                  '{operation="get_\\"x\\"",le="0.1"} 0', lines)
+        assert_in('test_operation_duration_seconds_bucket'
+                  '{operation="get_\\"x\\"",le="1"} 1', lines)
+        assert_in('test_operation_duration_seconds_bucket'
+                  '{operation="get_\\"x\\"",le="+Inf"} 1', lines)
+        assert_in('test_operation_duration_seconds_sum'
+                  '{operation="get_\\"x\\""} 0.5', lines)
+        assert_in('test_operation_etcd_requests_total'
+                  '{operation="get_\\"x\\"",type="txn"} 1', lines)
+        assert_in('test_operation_etcd_received_bytes_total'
+                  '{operation="get_\\"x\\""} 4', lines)
+        assert_in('test_etcd_requests_total{type="txn"} 1', lines)
+        assert_in('test_etcd_cas_failures_total{} 0', lines)
+        assert_true(text.endswith("\n"))
+
+
+class TestInstrumentedBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.etcd = MemoryEtcdClient()
+        self.backend = InstrumentedBackend(self.etcd, self.registry)
+
+    def test_requests(self):
+        """
+        Test each type of request is recorded, with its payload size.
+        """
+        self.backend.write("/a/b", "123")
+        result = self.backend.read("/a", recursive=True)
+        assert_equal(result.children.next().value, "123")
+        result = self.backend.get("/a/b")
+        result.value = "4"
+        self.backend.update(result)
+        assert_raises(EtcdCompareFailed, self.backend.write, "/a/b", "5",
+                      prevIndex=1)
+        self.backend.transaction([TxnWrite("/c", "67")])
+        self.backend.delete("/c")
+        assert_raises(EtcdKeyNotFound, self.backend.delete, "/c")
+        self.backend.watch("/a/b", index=1)
+
+        totals = self.registry.snapshot()["totals"]
+        assert_equal(totals["reads"], 2)
+        assert_equal(totals["writes"], 3)
+        assert_equal(totals["txns"], 1)
+        assert_equal(totals["deletes"], 2)
+        assert_equal(totals["watches"], 1)
+        assert_equal(totals["cas_failures"], 1)
+        assert_equal(totals["bytes_sent"],
+                     len("/a/b123" "/a" "/a/b" "/a/b4" "/a/b5" "/c67" "/c/c"
+                         "/a/b"))
+        assert_true(is_transactional(self.backend))
+        assert_equal(self.backend.round_trips(), self.etcd.round_trips())
+
+
+class TestClientMetrics(unittest.TestCase):
+
+    def test_datastore_client(self):
+        """
+        Test DatastoreClient operations are recorded once metrics are enabled,
+        including those that fail.
+        """
+        client = DatastoreClient(backend=MemoryEtcdClient())
+        client.get_ip_pools(4)
+        assert_is_none(client.metrics)
+
+        registry = client.enable_metrics()
+        assert_is(client.metrics, registry)
+        client.add_ip_pool(4, IPPool(IPNetwork("10.0.0.0/24")))
+        client.get_ip_pools(4)
+        with patch.object(client.etcd_client, "backend") as m_backend:
+            m_backend.read.side_effect = EtcdCompareFailed()
+            assert_raises(DataStoreError, client.get_ip_pools, 4)
+
+        operations = registry.snapshot()["operations"]
+        assert_equal(operations["get_ip_pools"]["count"], 2)
+        assert_equal(operations["get_ip_pools"]["errors"], 1)
+        assert_greater(operations["add_ip_pool"]["writes"], 0)
+
+        # Enabling metrics again switches registry without wrapping the
+        # backend twice.
+        registry2 = client.enable_metrics(MetricsRegistry())
+        client.get_ip_pools(4)
+        assert_is(client.etcd_client.registry, registry2)
+        assert_is(client.etcd_client.backend.__class__, MemoryEtcdClient)
+        assert_equal(
+            registry2.snapshot()["operations"]["get_ip_pools"]["count"], 1)
+        assert_equal(
+            registry.snapshot()["operations"]["get_ip_pools"]["count"], 2)
+
+    def test_ipam_client(self):
+        """
+        Test IPAM operations record the etcd requests of the methods they
+        call, and of their helper threads.
+        """
+        ipam = IPAMClient(backend=MemoryEtcdClient())
+        ipam.add_ip_pool(4, IPPool(IPNetwork("10.0.0.0/24")))
+        ipam.add_ip_pool(6, IPPool(IPNetwork("fd00::/120")))
+        registry = ipam.enable_metrics()
+        ipam.auto_assign_ips(2, 2, "handle", {}, host="host1")
+
+        operations = registry.snapshot()["operations"]
+        auto_assign = operations["auto_assign_ips"]
+        assert_equal(auto_assign["count"], 1)
+        assert_equal(auto_assign["errors"], 0)
+        assert_greater(auto_assign["txns"], 0)
+        totals = registry.snapshot()["totals"]
+        for counter in ("reads", "writes", "txns", "bytes_sent"):
+            assert_equal(auto_assign[counter], totals[counter])
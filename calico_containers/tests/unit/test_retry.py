@@ -0,0 +1,106 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from nose.tools import *
+from mock import Mock, patch
+import unittest
+
+from pycalico import retry
+from pycalico.retry import RetryPolicy, OTHER_KEY
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = RetryPolicy(retries=5, initial_delay=0.01,
+                                  max_delay=0.03)
+        self.policy._sleep = Mock()
+        self.now = 100.0
+        self.policy._time = lambda: self.now
+
+    def test_attempts(self):
+        """
+        Test attempts are delayed with capped exponential backoff, and the
+        attempts are recorded when the caller stops.
+        """
+        for attempt in self.policy.attempts("key1"):
+            if attempt == 3:
+                break
+        delays = [c[0][0] for c in self.policy._sleep.call_args_list]
+        assert_equal(len(delays), 3)
+        for delay, limit in zip(delays, [0.01, 0.02, 0.03]):
+            assert_true(0 <= delay <= limit)
+        assert_dict_equal(self.policy.stats(),
+                          {"retries": {"key1": 3},
+                           "attempts": {4: 1},
+                           "exhausted": 0})
+
+    def test_first_attempt(self):
+        """
+        Test operations that succeed first time aren't delayed.
+        """
+        for _ in self.policy.attempts("key1"):
+            break
+        assert_false(self.policy._sleep.called)
+        assert_dict_equal(self.policy.stats(),
+                          {"retries": {}, "attempts": {1: 1},
+                           "exhausted": 0})
+
+    def test_exhausted(self):
+        """
+        Test the attempts stop at the retry limit.
+        """
+        assert_list_equal(list(self.policy.attempts("key1")), range(5))
+        stats = self.policy.stats()
+        assert_equal(stats["exhausted"], 1)
+        assert_dict_equal(stats["attempts"], {5: 1})
+
+    def test_deadline(self):
+        """
+        Test the attempts stop once the deadline would be passed.
+        """
+        self.policy.deadline = 1
+        self.policy.initial_delay = self.policy.max_delay = 0
+        attempts = []
+        for attempt in self.policy.attempts("key1"):
+            # Each attempt takes 0.4s.
+            attempts.append(attempt)
+            self.now += 0.4
+        assert_list_equal(attempts, range(3))
+        assert_equal(self.policy.stats()["exhausted"], 1)
+
+    def test_no_delay(self):
+        """
+        Test retries are immediate with no initial delay.
+        """
+        self.policy.initial_delay = 0
+        list(self.policy.attempts("key1"))
+        assert_false(self.policy._sleep.called)
+
+    def test_hot_keys(self):
+        """
+        Test the keys with the most retries are reported first, and retries
+        are counted against OTHER_KEY once too many keys are tracked.
+        """
+        for key, retries in (("key1", 1), ("key2", 3), ("key3", 2)):
+            for attempt in self.policy.attempts(key):
+                if attempt == retries:
+                    break
+        assert_list_equal(self.policy.hot_keys(2), [("key2", 3),
+                                                    ("key3", 2)])
+
+        with patch.object(retry, "MAX_TRACKED_KEYS", 3):
+            for attempt in self.policy.attempts("key4"):
+                if attempt == 1:
+                    break
+        assert_equal(self.policy.stats()["retries"][OTHER_KEY], 1)